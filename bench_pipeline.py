@@ -0,0 +1,521 @@
+"""Benchmark cả pipeline dịch (TranslationEngine.run) với server giả lập, không tốn quota.
+
+    python bench_pipeline.py --parts 200 --concurrency 8 --latency 1.5 --rate-429 0.05 --rate-500 0.02
+
+Server giả lập chạy trên máy (127.0.0.1) và trả lời theo định dạng OpenAI-compatible
+(/v1/chat/completions) lẫn Gemini (models/...:streamGenerateContent, :generateContent, :countTokens).
+Với --batch-api, job gửi qua Batch API và server giả lập cả endpoint batch (Gemini :batchGenerateContent,
+OpenAI /v1/files + /v1/batches): batch xong sau --batch-seconds, mỗi request trong batch lỗi theo --rate-429/--rate-500.
+Server cũng giả lập cache prefix: system message / system instruction đã gặp (từ --prefix-cache-min-tokens token trở lên)
+được báo là token cache trong usage, và có endpoint cachedContents của Gemini; --prompt-words kéo dài prompt chung để thử.
+Có thể chỉnh phân bố độ trễ (log-normal quanh --latency, thêm đuôi chậm --slow-rate/--slow-seconds),
+tỉ lệ lỗi 429 (kèm Retry-After) và 500, tỉ lệ request treo (để thử timeout) và độ dài câu trả lời.
+Engine chạy đúng vòng lặp thật (chia văn bản, scheduler API key, retry, fallback, hedging, ghi file)
+rồi báo số phần/giây, độ trễ đuôi từng phần và số lần retry/fallback (đọc từ trace của job).
+Cùng --seed thì server đưa ra cùng chuỗi độ trễ/lỗi, để so sánh số liệu giữa các lần sửa engine.
+"""
+import argparse
+import contextlib
+import email.parser
+import io
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import gem5
+from gem5 import JobConfig, TranslationEngine, EngineReporter, PROVIDER_CONFIG, SPLIT_BY_CHAPTER, \
+    MODE_WITH_CONTEXT, MODE_WITHOUT_CONTEXT
+
+
+class StubBehavior:
+    """Quyết định độ trễ và lỗi của từng request theo tham số dòng lệnh, với random có seed."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.batches = {} # id batch -> (thời điểm xong, kiểu "google"/"openai", kết quả)
+        self.files = {} # id file (OpenAI) -> nội dung
+        self.prefixes = set() # (model, phần prompt chung) đã gặp, lần sau được tính là token cache
+        self.cached_contents = {} # tên cachedContents (Gemini) -> phần prompt chung
+
+    def cached_tokens(self, model, prefix):
+        """Số token của prefix được tính là lấy từ cache: prefix đủ dài và đã gửi trước đó."""
+        tokens = len(prefix) // 4
+        if tokens < self.args.prefix_cache_min_tokens:
+            return 0
+        with self.lock:
+            seen = (model, prefix) in self.prefixes
+            self.prefixes.add((model, prefix))
+        return tokens if seen else 0
+
+    def next_outcome(self, model):
+        """(kết quả, số giây trả lời) cho request tới model: ok, slow, 429, 500 hoặc hang."""
+        args = self.args
+        with self.lock:
+            roll = self.rng.random()
+            latency = args.latency * math.exp(self.rng.gauss(0, args.latency_sigma))
+            slow_roll = self.rng.random()
+        outcome = "ok"
+        if not (args.healthy_fallback and model == args.fallback_model):
+            if roll < args.rate_429:
+                outcome = "429"
+            elif roll < args.rate_429 + args.rate_500:
+                outcome = "500"
+            elif roll < args.rate_429 + args.rate_500 + args.rate_hang:
+                outcome = "hang"
+            elif slow_roll < args.slow_rate:
+                outcome, latency = "slow", args.slow_seconds
+        with self.lock:
+            self.counts[(model, outcome)] = self.counts.get((model, outcome), 0) + 1
+        return outcome, latency
+
+
+def make_handler(behavior):
+    args = behavior.args
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *log_args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_error_outcome(self, outcome, gemini):
+            if outcome == "429":
+                message = "Resource has been exhausted (giả lập)."
+                if gemini:
+                    body = {"error": {"code": 429, "message": message, "status": "RESOURCE_EXHAUSTED",
+                                      "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                                   "retryDelay": f"{args.retry_after:g}s"}]}}
+                else:
+                    body = {"error": {"message": message, "type": "rate_limit_exceeded", "code": 429}}
+                self.send_json(429, body, {"retry-after": f"{args.retry_after:g}"})
+            else:
+                body = {"error": {"code": 500, "message": "Internal error (giả lập).", "status": "INTERNAL"}}
+                self.send_json(500, body)
+
+        def stream_events(self, events, latency, done_marker):
+            """Gửi events dạng SSE: event đầu sau 30% độ trễ, phần còn lại rải đều."""
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+            time.sleep(latency * 0.3)
+            gap = latency * 0.7 / max(1, len(events))
+            payloads = ["data: " + json.dumps(event) + "\n\n" for event in events]
+            if done_marker:
+                payloads.append("data: [DONE]\n\n")
+            for k, payload in enumerate(payloads):
+                if k:
+                    time.sleep(gap)
+                data = payload.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def reply_pieces(self, prompt):
+            """Câu trả lời --reply-words từ, chia thành tối đa 20 đoạn stream."""
+            words = ["dịch"] * max(1, args.reply_words)
+            if "---TÓM TẮT---" in prompt: # Chế độ có context: trả đúng định dạng bản dịch + tóm tắt
+                words = ["---DỊCH---"] + words + ["---TÓM TẮT---", "tóm", "tắt"]
+            size = max(1, math.ceil(len(words) / 20))
+            return [" ".join(words[k:k + size]) + " " for k in range(0, len(words), size)]
+
+        def new_id(self, prefix):
+            with behavior.lock:
+                return f"{prefix}{len(behavior.batches) + len(behavior.files) + 1}"
+
+        def batch_item(self, model, prompt):
+            """(câu trả lời, lỗi, usage kiểu Gemini/OpenAI) của một request trong batch: không chờ độ trễ,
+            request "treo" coi như thành công vì batch không có timeout của từng request."""
+            outcome, _ = behavior.next_outcome(model)
+            if outcome in ("429", "500"):
+                return None, {"code": int(outcome), "message": f"Lỗi {outcome} (giả lập)."}, None
+            prompt_tokens, output_tokens = len(prompt) // 4, args.reply_words * 2
+            return "".join(self.reply_pieces(prompt)), None, (prompt_tokens, output_tokens)
+
+        def gemini_prompt(self, model, request):
+            """(toàn bộ prompt, phần prompt chung) của request Gemini: system instruction hoặc cachedContents."""
+            def text_of(content):
+                return "".join(part.get("text", "") for part in (content or {}).get("parts", []))
+            prefix = text_of(request.get("systemInstruction"))
+            if request.get("cachedContent"):
+                prefix = behavior.cached_contents.get(request["cachedContent"], "")
+            contents = request.get("contents") or [{}]
+            return prefix + text_of(contents[0]), prefix
+
+        def create_cached_content(self, body):
+            prefix = "".join(part.get("text", "") for part in (body.get("systemInstruction") or {}).get("parts", []))
+            if len(prefix) // 4 < args.prefix_cache_min_tokens:
+                return self.send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                                      "message": "Cached content is too small (giả lập)."}})
+            name = self.new_id("cachedContents/bench-")
+            with behavior.lock:
+                behavior.cached_contents[name] = prefix
+            self.send_json(200, {"name": name, "model": body.get("model"), "displayName": body.get("displayName"),
+                                 "usageMetadata": {"totalTokenCount": len(prefix) // 4}})
+
+        def do_PATCH(self):
+            self.rfile.read(int(self.headers.get("content-length", 0)))
+            name = self.path.split("?")[0].split("/v1beta/", 1)[1]
+            self.send_json(200 if name in behavior.cached_contents else 404, {"name": name})
+
+        def do_DELETE(self):
+            name = self.path.split("?")[0].split("/v1beta/", 1)[1]
+            with behavior.lock:
+                found = behavior.cached_contents.pop(name, None) is not None
+            self.send_json(200 if found else 404, {})
+
+        def create_gemini_batch(self, model, body):
+            results = []
+            for item in body["batch"]["inputConfig"]["requests"]["requests"]:
+                prompt, _ = self.gemini_prompt(model, item["request"])
+                text, error, usage = self.batch_item(model, prompt)
+                if error:
+                    results.append({"error": error, "metadata": item.get("metadata")})
+                    continue
+                results.append({"response": {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"},
+                                                             "finishReason": "STOP"}],
+                                             "usageMetadata": {"promptTokenCount": usage[0], "candidatesTokenCount": usage[1]}},
+                                "metadata": item.get("metadata")})
+            name = self.new_id("batches/bench-")
+            with behavior.lock:
+                behavior.batches[name] = (time.time() + args.batch_seconds, "google", results)
+            self.send_gemini_batch(name)
+
+        def send_gemini_batch(self, name):
+            if name not in behavior.batches:
+                return self.send_json(404, {"error": {"code": 404, "message": "Batch not found.", "status": "NOT_FOUND"}})
+            done_at, _, results = behavior.batches[name]
+            metadata = {"@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+                        "name": name, "state": "BATCH_STATE_RUNNING"}
+            if time.time() >= done_at:
+                metadata["state"] = "BATCH_STATE_SUCCEEDED"
+                metadata["output"] = {"inlinedResponses": {"inlinedResponses": results}}
+            self.send_json(200, {"name": name, "metadata": metadata, "done": time.time() >= done_at})
+
+        def upload_file(self, data):
+            message = email.parser.BytesParser().parsebytes(
+                b"content-type: " + self.headers["content-type"].encode() + b"\r\n\r\n" + data)
+            content = next(part.get_payload(decode=True) for part in message.get_payload()
+                           if part.get_param("name", header="content-disposition") == "file")
+            file_id = self.new_id("file-bench-")
+            with behavior.lock:
+                behavior.files[file_id] = content
+            self.send_json(200, {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                                 "filename": "batch.jsonl", "purpose": "batch", "status": "processed"})
+
+        def create_openai_batch(self, body):
+            output, errors = [], []
+            for line in behavior.files[body["input_file_id"]].decode("utf-8").splitlines():
+                request = json.loads(line)
+                model = request["body"]["model"]
+                text, error, usage = self.batch_item(model, "".join(m["content"] for m in request["body"]["messages"]))
+                if error:
+                    errors.append({"id": "bench", "custom_id": request["custom_id"],
+                                   "response": {"status_code": error["code"], "body": {"error": error}}, "error": None})
+                    continue
+                output.append({"id": "bench", "custom_id": request["custom_id"], "error": None, "response": {
+                    "status_code": 200, "body": {
+                        "id": "bench", "object": "chat.completion", "created": 0, "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": usage[0], "completion_tokens": usage[1], "total_tokens": sum(usage)}}}})
+            batch_id = self.new_id("batch_bench_")
+            with behavior.lock:
+                behavior.batches[batch_id] = (time.time() + args.batch_seconds, "openai", (body, output, errors))
+            self.send_openai_batch(batch_id)
+
+        def send_openai_batch(self, batch_id):
+            if batch_id not in behavior.batches:
+                return self.send_json(404, {"error": {"message": "No batch found.", "type": "invalid_request_error"}})
+            done_at, _, (body, output, errors) = behavior.batches[batch_id]
+            batch = {"id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                     "completion_window": body["completion_window"], "created_at": int(done_at - args.batch_seconds),
+                     "status": "in_progress", "output_file_id": None, "error_file_id": None}
+            if time.time() >= done_at:
+                batch["status"] = "completed"
+                for field, lines in (("output_file_id", output), ("error_file_id", errors)):
+                    if lines:
+                        batch[field] = f"{batch_id}-{field}"
+                        with behavior.lock:
+                            behavior.files[batch[field]] = "".join(json.dumps(item) + "\n" for item in lines).encode()
+            self.send_json(200, batch)
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if "/batches/" in path and path.startswith("/v1beta/"):
+                return self.send_gemini_batch(path.split("/v1beta/", 1)[1])
+            if path.startswith("/v1/batches/"):
+                return self.send_openai_batch(path.rsplit("/", 1)[1])
+            if path.startswith("/v1/files/") and path.endswith("/content"):
+                data = behavior.files.get(path.split("/")[3], b"")
+                self.send_response(200)
+                self.send_header("content-type", "application/octet-stream")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                return self.wfile.write(data)
+            self.send_json(404, {"error": {"code": 404, "message": f"Không có endpoint {path} (giả lập)."}})
+
+        def do_POST(self):
+            length = int(self.headers.get("content-length", 0))
+            data = self.rfile.read(length)
+            if self.path.startswith("/v1/files"):
+                return self.upload_file(data)
+            body = json.loads(data or b"{}")
+            if self.path.startswith("/v1beta/cachedContents"):
+                return self.create_cached_content(body)
+            if self.path.startswith("/v1/batches"):
+                return self.create_openai_batch(body)
+            gemini = "/models/" in self.path and ":" in self.path
+            if gemini and ":batchGenerateContent" in self.path:
+                return self.create_gemini_batch(self.path.split("/models/")[1].split(":")[0], body)
+            if gemini and ":countTokens" in self.path:
+                text = json.dumps(body.get("contents", ""))
+                return self.send_json(200, {"totalTokens": max(1, len(text) // 4)})
+            if gemini:
+                model = self.path.split("/models/")[1].split(":")[0]
+                prompt, prefix = self.gemini_prompt(model, body)
+            else:
+                model = body.get("model", "")
+                messages = body.get("messages", [])
+                prompt = "".join(message.get("content", "") for message in messages)
+                prefix = messages[0].get("content", "") if messages and messages[0].get("role") == "system" else ""
+            outcome, latency = behavior.next_outcome(model)
+            if outcome in ("429", "500"):
+                time.sleep(min(latency, 0.05))
+                return self.send_error_outcome(outcome, gemini)
+            if outcome == "hang":
+                # Không trả lời gì cho tới khi engine timeout và ngắt kết nối
+                time.sleep(args.hang_seconds)
+                return
+            pieces = self.reply_pieces(prompt)
+            prompt_tokens = len(prompt) // 4
+            output_tokens = args.reply_words * 2
+            cached_tokens = behavior.cached_tokens(model, prefix) if prefix else 0
+            if gemini and body.get("cachedContent"):
+                cached_tokens = len(prefix) // 4 # Cached content tạo trước: mọi request đều trúng cache
+            if gemini:
+                usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                         "cachedContentTokenCount": cached_tokens}
+                if ":streamGenerateContent" in self.path:
+                    events = [{"candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}}],
+                               "usageMetadata": usage} for piece in pieces]
+                    return self.stream_events(events, latency, done_marker=False)
+                time.sleep(latency)
+                return self.send_json(200, {"candidates": [{"content": {"parts": [{"text": "".join(pieces)}], "role": "model"},
+                                                            "finishReason": "STOP"}], "usageMetadata": usage})
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens,
+                     "total_tokens": prompt_tokens + output_tokens, "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+            if body.get("stream"):
+                events = [{"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                           "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                          for piece in pieces]
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    events.append({"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                                   "choices": [], "usage": usage})
+                return self.stream_events(events, latency, done_marker=True)
+            time.sleep(latency)
+            self.send_json(200, {"id": "bench", "object": "chat.completion", "created": 0, "model": model,
+                                 "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                                              "finish_reason": "stop"}],
+                                 "usage": usage})
+
+    return StubHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # Engine ngắt kết nối khi timeout/hủy request: bình thường, không in traceback
+
+
+def start_stub_server(behavior):
+    server = StubServer(("127.0.0.1", 0), make_handler(behavior))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_text(parts, part_chars, rng):
+    words = ["anh", "ấy", "nói", "rằng", "sư", "huynh", "tông", "môn", "kiếm", "khí", "thiên", "địa"]
+    chapters = []
+    for i in range(1, parts + 1):
+        body = " ".join(rng.choice(words) for _ in range(max(1, part_chars // 5)))
+        chapters.append(f"Chương {i}\n{body}.")
+    return "\n\n".join(chapters)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(percent / 100 * (len(values) - 1))] if values else 0.0
+
+
+def summarize_trace(trace_path):
+    """Độ trễ từng phần (từ span đầu tới span cuối của phần đó) và số lần gọi API theo vai trò/kết quả.
+    Với Batch API, mỗi phần trong batch có độ trễ là thời gian chờ cả batch."""
+    part_spans = {}
+    batch_seconds = []
+    calls = {}
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            span = json.loads(line)
+            part = span.get("part")
+            if part is not None and span["name"] in ("key_wait", "api_call"):
+                first, last = part_spans.get(part, (span["start"], span["start"] + span["dur"]))
+                part_spans[part] = (min(first, span["start"]), max(last, span["start"] + span["dur"]))
+            if span["name"] == "api_call":
+                key = (span.get("role") or "primary", "ok" if span.get("ok") else "lỗi")
+                calls[key] = calls.get(key, 0) + 1
+            elif span["name"] in ("batch_submit", "batch_wait"):
+                key = (span["name"], span.get("state") or ("lỗi" if span.get("error") else "ok"))
+                calls[key] = calls.get(key, 0) + 1
+                if span["name"] == "batch_wait":
+                    batch_seconds += [span["dur"]] * span["parts"]
+    return [last - first for first, last in part_spans.values()] + batch_seconds, calls
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    behavior = StubBehavior(args)
+    server = start_stub_server(behavior)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    provider_config = PROVIDER_CONFIG[args.provider]
+    provider_config["base_url"] = base_url if args.provider == "Google" else base_url + "/v1"
+    provider_config["rate_limit"] = {"rpm": args.rpm or None, "tpm": None}
+    if args.batch_api and not provider_config.get("batch_api"):
+        provider_config["batch_api"] = "openai" # Server giả lập có /v1/batches cho mọi provider OpenAI-compatible
+    if args.fallback_model is not None:
+        provider_config["fallback_model"] = args.fallback_model or None
+    args.fallback_model = provider_config.get("fallback_model")
+    # Lịch sử thời gian gọi API và danh sách job của server giả lập không được lẫn vào dữ liệu thật
+    gem5.LATENCY_FILE = os.path.join(work_dir, ".latency.json")
+    gem5.RESULTS_INDEX_FILE = os.path.join(work_dir, ".jobs.jsonl")
+    gem5.STREAM_FIRST_TOKEN_TIMEOUT_SECONDS = args.first_token_timeout
+    gem5.STREAM_IDLE_TIMEOUT_SECONDS = args.idle_timeout
+    gem5.API_TIMEOUT_SECONDS = args.total_timeout
+    gem5.BATCH_POLL_SECONDS = args.batch_poll
+
+    text = make_text(args.parts, args.part_chars, random.Random(args.seed))
+    # Prompt chung dài (hướng dẫn, bảng tên riêng...) để thử cache prefix của provider
+    glossary = " ".join(f"tên{k}=name{k}" for k in range(max(0, args.prompt_words - 4)))
+    config = JobConfig(
+        text=text,
+        prompt="Dịch sang tiếng Việt." + (f"\nBảng tên riêng: {glossary}" if glossary else ""),
+        api_keys=[f"bench-key-{k + 1}" for k in range(args.keys)],
+        provider=args.provider,
+        model=args.model,
+        split_method=SPLIT_BY_CHAPTER,
+        context_mode=MODE_WITH_CONTEXT if args.mode == "context" else MODE_WITHOUT_CONTEXT,
+        two_phase=args.two_phase,
+        concurrency=args.concurrency,
+        use_cache=False,
+        results_dir=os.path.join(work_dir, "out"),
+        hedge_percentile=args.hedge_percentile,
+        batch_mode=args.batch_api
+    )
+    engine = TranslationEngine(EngineReporter())
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(log):
+        stats = engine.run(config)
+    wall_seconds = time.perf_counter() - start
+    server.shutdown()
+    if stats is None:
+        raise SystemExit(f"Job không chạy được: {engine.reporter.last_completion or log.getvalue()[-2000:]}")
+
+    part_seconds, calls = summarize_trace(stats["trace"])
+    report = {
+        "provider": args.provider, "model": config.model, "parts": stats["total_parts"],
+        "done": stats["done"], "failed": stats["failed"], "wall_seconds": round(wall_seconds, 3),
+        "parts_per_second": round(stats["done"] / wall_seconds, 3) if wall_seconds else 0.0,
+        "part_p50": round(percentile(part_seconds, 50), 3), "part_p95": round(percentile(part_seconds, 95), 3),
+        "part_p99": round(percentile(part_seconds, 99), 3), "part_max": round(max(part_seconds, default=0.0), 3),
+        "input_tokens": stats["input_tokens"], "cached_input_tokens": stats["cached_input_tokens"],
+        "api_calls": {f"{role}/{result}": count for (role, result), count in sorted(calls.items())},
+        "server": {f"{model}/{outcome}": count for (model, outcome), count in sorted(behavior.counts.items())}
+    }
+    if args.keep:
+        report["work_dir"] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def print_report(report):
+    print(f"{report['provider']} / {report['model']}: {report['done']}/{report['parts']} phần xong, "
+          f"{report['failed']} lỗi, {report['wall_seconds']:.1f} giây")
+    print(f"  Thông lượng : {report['parts_per_second']:.2f} phần/giây")
+    print(f"  Mỗi phần    : p50 {report['part_p50']:.2f}s, p95 {report['part_p95']:.2f}s, "
+          f"p99 {report['part_p99']:.2f}s, max {report['part_max']:.2f}s")
+    print(f"  Token vào   : {report['input_tokens']}, lấy từ cache prefix {report['cached_input_tokens']}")
+    print("  Gọi API     : " + ", ".join(f"{name} {count}" for name, count in report["api_calls"].items()))
+    print("  Server      : " + ", ".join(f"{name} {count}" for name, count in report["server"].items()))
+    if report.get("work_dir"):
+        print(f"  Kết quả, trace: {report['work_dir']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--provider", default="Open Router", choices=["Google", "MegaLLM", "Open Router", "POE", "Mistral", "Literouter"])
+    parser.add_argument("--model", help="Mặc định là model mặc định của provider")
+    parser.add_argument("--fallback-model", help="Model fallback (chuỗi rỗng = không có), mặc định theo PROVIDER_CONFIG")
+    parser.add_argument("--parts", type=int, default=100, help="Số chương của văn bản thử")
+    parser.add_argument("--part-chars", type=int, default=2000, help="Số ký tự mỗi chương")
+    parser.add_argument("--mode", choices=["context", "no-context"], default="no-context")
+    parser.add_argument("--two-phase", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--keys", type=int, default=4, help="Số API key giả")
+    parser.add_argument("--rpm", type=int, default=0, help="Giới hạn request/phút mỗi key của scheduler (0 = không giới hạn)")
+    parser.add_argument("--hedge-percentile", type=float, default=0)
+    parser.add_argument("--batch-api", action="store_true", help="Gửi job qua Batch API (chỉ với --mode no-context)")
+    parser.add_argument("--batch-seconds", type=float, default=3.0, help="Thời gian server giả lập xử lý mỗi batch")
+    parser.add_argument("--batch-poll", type=float, default=1.0, help="Thay BATCH_POLL_SECONDS")
+    parser.add_argument("--latency", type=float, default=1.0, help="Độ trễ trung vị mỗi request (giây)")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Độ lệch của log-normal quanh --latency")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Tỉ lệ request chậm bất thường (đuôi)")
+    parser.add_argument("--slow-seconds", type=float, default=10.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Tỉ lệ request trả 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After (giây) kèm lỗi 429")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="Tỉ lệ request trả 500")
+    parser.add_argument("--rate-hang", type=float, default=0.0, help="Tỉ lệ request treo không trả lời")
+    parser.add_argument("--hang-seconds", type=float, default=120.0)
+    parser.add_argument("--healthy-fallback", action="store_true", help="Model fallback không bị lỗi/treo giả lập")
+    parser.add_argument("--reply-words", type=int, default=300, help="Số từ mỗi câu trả lời")
+    parser.add_argument("--prompt-words", type=int, default=4, help="Số từ của prompt chung (thêm bảng tên riêng giả cho đủ)")
+    parser.add_argument("--prefix-cache-min-tokens", type=int, default=1024,
+                        help="Prompt chung từ chừng này token trở lên thì server giả lập tính là trúng cache prefix")
+    parser.add_argument("--first-token-timeout", type=float, default=10.0, help="Thay STREAM_FIRST_TOKEN_TIMEOUT_SECONDS")
+    parser.add_argument("--idle-timeout", type=float, default=5.0, help="Thay STREAM_IDLE_TIMEOUT_SECONDS")
+    parser.add_argument("--total-timeout", type=float, default=60.0, help="Thay API_TIMEOUT_SECONDS")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON (để so sánh giữa các lần chạy)")
+    parser.add_argument("--keep", action="store_true", help="Giữ thư mục kết quả và trace của job")
+    parser.add_argument("--verbose", action="store_true", help="Hiện log của engine")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
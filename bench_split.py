@@ -0,0 +1,111 @@
+"""Benchmark chia văn bản "Theo số ký tự": cách cũ (cắt lát + regex cho từng phần, sao chép
+từng phần) so với TranslationEngine.split_by_chars (tìm điểm cắt không cắt lát, trả về khoảng vị trí).
+
+    python bench_split.py --mb 20 --split-length 10000
+
+Văn bản thử được sinh ngẫu nhiên (tiếng Trung và tiếng Việt) hoặc đọc từ --input.
+"""
+import argparse
+import random
+import re
+import time
+import tracemalloc
+
+from gem5 import JobConfig, TranslationEngine, SPLIT_BY_CHARS
+
+
+def legacy_split_by_chars(text, split_length):
+    """Nhánh "Theo số ký tự" của split_text trước khi trả về TextChunks."""
+    result = []
+    start = 0
+    text_len = len(text)
+    while start < text_len:
+        end = min(start + split_length, text_len)
+        if end < text_len:
+            split_pos = end
+            search_start = max(start, end - 100)
+            possible_splits = [m.end() for m in re.finditer(r'[。!?！？\n\r]', text[search_start:end])]
+            if possible_splits:
+                split_pos = search_start + max(possible_splits)
+            else:
+                space_pos = text.rfind(' ', start, end)
+                if space_pos > start:
+                    split_pos = space_pos + 1
+            if split_pos > start:
+                end = split_pos
+        chunk = text[start:end].strip()
+        if chunk:
+            result.append(chunk)
+        if end <= start:
+            start += 1
+        else:
+            start = end
+    return result
+
+
+def chinese_text(chars, rng):
+    words = ["他", "说道", "你好", "我们", "师兄", "宗门", "剑气", "突然", "天地", "之间", "灵力", "修炼", "弟子", "长老"]
+    ends = ["，", "，", "。", "！", "？", "。\n"]
+    parts, size = [], 0
+    while size < chars:
+        sentence = "".join(rng.choice(words) for _ in range(rng.randint(4, 12))) + rng.choice(ends)
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:chars]
+
+
+def vietnamese_text(chars, rng):
+    words = ["anh", "ấy", "nói", "rằng", "chúng", "ta", "sư", "huynh", "tông", "môn", "kiếm", "khí", "đột", "nhiên", "thiên", "địa"]
+    ends = [", ", ". ", "! ", "? ", ".\n"]
+    parts, size = [], 0
+    while size < chars:
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(5, 15))) + rng.choice(ends)
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:chars]
+
+
+def measure(fn, repeat):
+    """(thời gian tốt nhất, bộ nhớ cấp phát đỉnh) của fn(); bộ nhớ đo ở lượt riêng vì tracemalloc làm chậm."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=float, default=20, help="Số triệu ký tự của văn bản sinh ngẫu nhiên")
+    parser.add_argument("--split-length", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--input", help="Dùng file văn bản (UTF-8) thay cho văn bản sinh ngẫu nhiên")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    chars = int(args.mb * 1000000)
+    if args.input:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            inputs = [(args.input, f.read())]
+    else:
+        inputs = [("Tiếng Trung", chinese_text(chars, rng)), ("Tiếng Việt", vietnamese_text(chars, rng))]
+
+    for name, text in inputs:
+        engine = TranslationEngine()
+        engine.config = JobConfig(text, "", [], split_method=SPLIT_BY_CHARS, split_length=args.split_length)
+        old_seconds, old_peak, old_chunks = measure(lambda: legacy_split_by_chars(text, args.split_length), args.repeat)
+        new_seconds, new_peak, new_chunks = measure(lambda: engine.split_by_chars(text, args.split_length), args.repeat)
+        same = list(new_chunks) == old_chunks
+        print(f"{name}: {len(text):,} ký tự, {len(old_chunks)} phần, kết quả giống nhau: {same}")
+        print(f"  cách cũ : {old_seconds * 1000:8.1f} ms, cấp phát đỉnh {old_peak / 1e6:8.1f} MB")
+        print(f"  khoảng  : {new_seconds * 1000:8.1f} ms, cấp phát đỉnh {new_peak / 1e6:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
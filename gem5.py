@@ -1,25 +1,37 @@
-import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox, filedialog
-import google.generativeai as genai
-from openai import OpenAI
+try:
+    import tkinter as tk
+    from tkinter import ttk, scrolledtext, messagebox, filedialog
+except ImportError: # Máy chủ không có giao diện vẫn chạy được chế độ dòng lệnh
+    tk = None
+from google import genai
+from google.genai import types as genai_types
+from openai import OpenAI, DefaultHttpxClient, Timeout
+import httpx
 import os
+import sys
 import time
 import re
+import json
+import hashlib
+import glob
+import copy
+import collections
+import contextlib
 from datetime import datetime
 import threading
-import queue
+import socket
 import concurrent.futures # Thêm thư viện để xử lý timeout
-# --- Thư viện cho export PDF/Word ---
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.units import inch
+import traceback
+import tempfile
 
 
 
 # --- Hằng số mới ---
 GOOGLE_FALLBACK_MODEL = "gemini-2.5-flash-lite"
 API_TIMEOUT_SECONDS = 7 * 60 # 7 phút
+STREAM_FIRST_TOKEN_TIMEOUT_SECONDS = 3 * 60 # Chờ token đầu tiên (model reasoning nghĩ khá lâu)
+STREAM_IDLE_TIMEOUT_SECONDS = 60 # Đang stream mà không có token mới quá lâu -> coi như treo
+CONNECT_TIMEOUT_SECONDS = 15 # Timeout kết nối HTTP truyền cho SDK
 DEFAULT_PROVIDER = "Google"
 MEGALLM_BASE_URL = "https://ai.megallm.io/v1"
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
@@ -126,1038 +138,4452 @@ PROVIDER_CONFIG = {
     "Google": {
         "models": GOOGLE_MODELS,
         "fallback_model": GOOGLE_FALLBACK_MODEL,
-        "base_url": None
+        "summary_model": GOOGLE_FALLBACK_MODEL,
+        "base_url": None,
+        "batch_api": "google", # Gemini batch mode; "openai" = /v1/files + /v1/batches kiểu OpenAI
+        "context_cache": True, # Phần prompt chung đủ dài được gửi một lần thành cached content của Gemini
+        "rate_limit": {"rpm": 10, "tpm": 250000}
     },
     "MegaLLM": {
         "models": MEGALLM_MODELS,
         "fallback_model": None,
-        "base_url": MEGALLM_BASE_URL
+        "base_url": MEGALLM_BASE_URL,
+        "rate_limit": {"rpm": 60, "tpm": 1000000}
     },
     "Open Router": {
         "models": OPENROUTER_MODELS,
         "fallback_model": "tngtech/deepseek-r1t2-chimera:free",
+        "summary_model": "meta-llama/llama-3.3-70b-instruct:free",
         "base_url": OPENROUTER_BASE_URL,
-        "headers": OPENROUTER_HEADERS
+        "headers": OPENROUTER_HEADERS,
+        "rate_limit": {"rpm": 20, "tpm": None}
     },
     "POE": {
         "models": POE_MODELS,
         "fallback_model": "Gemini-2.5-Flash-Lite",
-        "base_url": POE_BASE_URL
+        "summary_model": "Gemini-2.5-Flash-Lite",
+        "base_url": POE_BASE_URL,
+        "rate_limit": {"rpm": 500, "tpm": None}
     },
     "Mistral": {
         "models": MISTRAL_MODELS,
         "fallback_model": None,
-        "base_url": MISTRAL_BASE_URL
+        "summary_model": "mistral-small-latest",
+        "base_url": MISTRAL_BASE_URL,
+        "stream_usage": False, # Không nhận stream_options, usage có sẵn ở event cuối
+        "rate_limit": {"rpm": 60, "tpm": 500000}
     },
     "Literouter": {
         "models": LITEROUTER_MODELS,
         "fallback_model": None,
-        "base_url": LITEROUTER_BASE_URL
+        "base_url": LITEROUTER_BASE_URL,
+        "rate_limit": {"rpm": 20, "tpm": None}
     }
 }
 # --- Kết thúc hằng số mới ---
 
 MODE_WITH_CONTEXT = "With previous context"
 MODE_WITHOUT_CONTEXT = "Without previous context"
+SPLIT_BY_CHAPTER = "Theo chương (第X章/Chương X)"
+SPLIT_BY_CHARS = "Theo số ký tự"
+SPLIT_BY_TOKENS = "Theo token"
+SPLIT_METHODS = [SPLIT_BY_CHAPTER, SPLIT_BY_CHARS, SPLIT_BY_TOKENS]
+RESULTS_DIR = os.path.join(os.path.expanduser("~"), "Downloads", "gemini_results")
 
-class GeminiInterface:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Gemini Pro v6 API Interface (with Retry)") # Cập nhật title
-        self.root.geometry("800x900")
-
-        self.root.option_add('*Font', ('Arial', 12))
-        if os.name == 'nt':
-            self.root.option_add('*Dialog.msg.font', ('Arial', 12))
+DEFAULT_CONCURRENCY = 4 # Số phần gửi song song (chỉ áp dụng cho chế độ không context)
+MAX_CONCURRENCY = 32
+RATE_LIMIT_DEFAULT_COOLDOWN = 60 # Giây nghỉ khi bị 429 mà không có Retry-After
+RATE_LIMIT_MAX_KEY_SWITCHES = 5 # Số lần đổi key tối đa cho một request bị 429
+CLIENT_KEEPALIVE_SECONDS = 300 # Giữ kết nối HTTP mở giữa các lần gọi cùng key
+CACHE_MAX_BYTES = 500 * 1024 * 1024 # Dung lượng tối đa của cache kết quả
+CACHE_MAX_AGE_DAYS = 30
+LATENCY_MIN_SAMPLES = 5 # Số lần gọi thành công của model cần có trước khi hedging / dùng timeout theo lịch sử
+LATENCY_HISTORY_SIZE = 200 # Số mẫu thời gian gọi API giữ lại cho mỗi (provider, model)
+LATENCY_FILE = os.path.join(RESULTS_DIR, ".latency.json") # Lịch sử thời gian gọi API, dùng chung giữa các lần chạy
+TIMEOUT_SAFETY_FACTOR = 3 # Timeout theo lịch sử = hệ số này x p99 thời gian đã gặp
+ADAPTIVE_TIMEOUT_MIN_SECONDS = 15 # Timeout theo lịch sử không nhỏ hơn giá trị này
+# (tiền tố tên model, context tối đa, output tối đa) tính bằng token, dùng cho chia "Theo token".
+# Khớp tiền tố đầu tiên của tên model viết thường, bỏ phần "nhà-cung-cấp/" (Open Router).
+MODEL_TOKEN_LIMITS = [
+    ("gemini-2.0", 1048576, 8192),
+    ("gemini", 1048576, 65536),
+    ("gpt-5", 400000, 128000),
+    ("gpt-4.1", 1047576, 32768),
+    ("gpt-4o", 128000, 16384),
+    ("gpt-oss", 131072, 32768),
+    ("claude", 200000, 32000),
+    ("grok-4", 256000, 32768),
+    ("deepseek-r1", 163840, 32768),
+    ("deepseek", 131072, 8192),
+    ("kimi", 262144, 32768),
+    ("glm", 131072, 32768),
+    ("qwen", 131072, 8192),
+    ("mistral", 131072, 32768),
+    ("llama", 131072, 8192),
+]
+DEFAULT_MODEL_TOKEN_LIMITS = (32768, 8192) # Model không có trong MODEL_TOKEN_LIMITS
+TRANSLATION_OUTPUT_RATIO = 2.0 # Số token bản dịch cho mỗi token văn bản gốc (ước tính dư)
+SUMMARY_TOKEN_RESERVE = 1000 # Token output dành cho tóm tắt ở chế độ có context
+TOKEN_BUDGET_SAFETY = 0.8 # Chỉ dùng 80% giới hạn của model
+TOKEN_CALIBRATION_SAMPLE_CHARS = 20000 # Độ dài đoạn mẫu gửi count_tokens để hiệu chỉnh ước lượng
 
-        self.processing = False
-        self.should_stop = False
-        self.queue = queue.Queue()
-        self.api_key = None  # Single API key (legacy)
-        self.api_keys = []   # List of API keys for round robin
-        self.api_key_index = 0  # Current index for round robin
-        self.api_key = None  # Single API key (legacy)
-        self.api_keys = []   # List of API keys for round robin
-        self.api_key_index = 0  # Current index for round robin
-        self.provider_var = tk.StringVar(value=DEFAULT_PROVIDER)
 
-        self.create_menu_export() # Thêm menu Export phía trên cùng
-        self.create_main_frame()
-        self.create_widgets()
-        self.setup_periodic_queue_check()
-    def create_menu_export(self):
-        menubar = tk.Menu(self.root)
-        export_menu = tk.Menu(menubar, tearoff=0)
-        export_menu.add_command(label="Export to PDF", command=self.export_to_pdf)
-        export_menu.add_command(label="Export to Word", command=self.export_to_word)
-        menubar.add_cascade(label="Export", menu=export_menu)
-        self.root.config(menu=menubar)
+CJK_PATTERN = re.compile(r'[\u3000-\u9fff\uf900-\ufaff]')
+SENTENCE_END_PATTERN = re.compile(r'[。!?！？\n\r]') # Dấu ngắt câu dùng làm điểm cắt khi chia văn bản
+# Tiêu đề chương: "第...章", "Chương <số>" hoặc "Chapter <số>" (hỗ trợ cả số La Mã), không phân biệt hoa thường
+CHAPTER_PATTERN = r'(?:第.*?章|Chương\s*\d+|Chapter\s*(?:\d+|[IVXLCDM]+))\b'
+BLANK_LINE_PATTERN = r'\n\s*\n'
+NON_SPACE_PATTERN = re.compile(r'\S')
+INPUT_PREVIEW_CHARS = 5000 # Số ký tự đầu file hiển thị trong ô nhập văn bản khi mở file
+UI_UPDATE_INTERVAL_MS = 100 # Chu kỳ check_queue cập nhật giao diện
+UI_PENDING_MAX_CHARS = 200000 # Text chờ hiển thị của mỗi ô trong một chu kỳ, quá thì chỉ giữ phần cuối
+UI_LOG_MAX_LINES = 3000 # Số dòng tối đa giữ trong mỗi ô log, dòng cũ bị xóa dần
+METRICS_LATENCY_SAMPLES = 500 # Số mẫu thời gian gọi API giữ cho mỗi dòng thống kê (p50/p95)
+METRICS_ETA_WINDOW = 20 # Số phần xong gần nhất dùng để tính tốc độ và thời gian còn lại
+METRICS_REFRESH_MS = 1000 # Chu kỳ cập nhật bảng thống kê trên giao diện
+PROMPT_PREVIEW_CHARS = 2000 # Số ký tự prompt hiện ở ô tiến trình, prompt đầy đủ ghi vào file .prompts.log
+RESULTS_INDEX_FILE = os.path.join(RESULTS_DIR, ".jobs.jsonl") # Danh sách job đã chạy, ghi thêm khi job bắt đầu/kết thúc
+RESULTS_PAGE_PARTS = 20 # Số phần mỗi trang khi duyệt kết quả của job
+RESULTS_PAGE_BYTES = 64 * 1024 # Số byte mỗi trang khi duyệt file kết quả cũ không có manifest
+BATCH_POLL_SECONDS = 30 # Chu kỳ hỏi trạng thái batch ở chế độ Batch API
+BATCH_MAX_REQUESTS = 5000 # Số phần tối đa mỗi batch gửi lên provider
+BATCH_MAX_BYTES = 15 * 1024 * 1024 # Dung lượng prompt tối đa mỗi batch (Gemini nhận tối đa 20 MB request inline)
+BATCH_POLL_MAX_ERRORS = 5 # Hỏi trạng thái một batch lỗi liên tiếp chừng này lần thì báo lỗi các phần của batch
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = 1024 # Phần prompt chung ngắn hơn thì không tạo cached content (Gemini không nhận cache quá nhỏ)
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = 3600 # Thời gian sống của cached content, được gia hạn khi job còn dùng
+EXPORT_PROGRESS_LINES = 200 # Báo tiến độ export PDF/Word sau mỗi chừng này dòng
+EXPORT_PDF_BATCH = 50 # Số đoạn đọc trước khi dàn trang PDF
 
-    def export_to_pdf(self):
-        try:
-            # Lấy nội dung file kết quả mới nhất
-            results_dir = os.path.join(os.path.expanduser("~"), "Downloads", "gemini_results")
-            if not os.path.exists(results_dir):
-                messagebox.showwarning("Không có dữ liệu", "Thư mục 'gemini_results' không tồn tại.")
-                return
-            files = [f for f in os.listdir(results_dir) if f.startswith("gemini_result_") and f.endswith(".txt")]
-            if not files:
-                messagebox.showwarning("Không có dữ liệu", "Không tìm thấy file kết quả nào trong thư mục 'gemini_results'.")
-                return
-            files.sort(reverse=True)
-            latest_file = files[0]
-            latest_file_path = os.path.join(results_dir, latest_file)
-            with open(latest_file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-            if not content:
-                messagebox.showwarning("Không có dữ liệu", "File kết quả rỗng.")
-                return
-            # Chọn nơi lưu file PDF
-            file_path = filedialog.asksaveasfilename(
-                defaultextension=".pdf",
-                filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")],
-                initialdir=os.path.expanduser("~")
-            )
-            if not file_path:
-                return
-            # Tạo PDF
-            doc = SimpleDocTemplate(file_path, pagesize=letter)
-            styles = getSampleStyleSheet()
-            # Tạo style tùy chỉnh cho tiêu đề
-            title_style = ParagraphStyle(
-                'CustomTitle',
-                parent=styles['Heading1'],
-                fontSize=16,
-                textColor='black',
-                spaceAfter=12,
-                alignment=1  # Center alignment
-            )
-            # Tạo style cho nội dung
-            body_style = ParagraphStyle(
-                'CustomBody',
-                parent=styles['BodyText'],
-                fontSize=11,
-                leading=14,
-                spaceAfter=6
-            )
-            # Xây dựng danh sách các phần tử cho PDF
-            elements = []
-            elements.append(Paragraph("Gemini Processing Results", title_style))
-            elements.append(Spacer(1, 0.3*inch))
-            # Thêm nội dung
-            for line in content.split('\n'):
-                if line.strip():
-                    elements.append(Paragraph(line, body_style))
-                else:
-                    elements.append(Spacer(1, 0.1*inch))
-            # Xây dựng PDF
-            doc.build(elements)
-            messagebox.showinfo("Thành công", f"Đã export sang PDF:\n{file_path}")
-        except Exception as e:
-            messagebox.showerror("Lỗi", f"Lỗi khi export sang PDF: {str(e)}")
 
-    def export_to_word(self):
-        try:
-            from docx import Document
-        except ImportError:
-            messagebox.showerror("Thiếu thư viện", "Vui lòng cài đặt python-docx: pip install python-docx")
-            return
-        # Lấy nội dung file kết quả mới nhất
-        results_dir = os.path.join(os.path.expanduser("~"), "Downloads", "gemini_results")
-        if not os.path.exists(results_dir):
-            messagebox.showwarning("Không có dữ liệu", "Thư mục 'gemini_results' không tồn tại.")
-            return
-        files = [f for f in os.listdir(results_dir) if f.startswith("gemini_result_") and f.endswith(".txt")]
-        if not files:
-            messagebox.showwarning("Không có dữ liệu", "Không tìm thấy file kết quả nào trong thư mục 'gemini_results'.")
-            return
-        files.sort(reverse=True)
-        latest_file = files[0]
-        latest_file_path = os.path.join(results_dir, latest_file)
-        try:
-            with open(latest_file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-        except Exception as e:
-            messagebox.showerror("Lỗi đọc file", f"Không thể đọc file kết quả: {str(e)}")
-            return
-        if not content:
-            messagebox.showwarning("Không có dữ liệu", "File kết quả rỗng.")
-            return
-        # Chọn nơi lưu file Word
-        file_path = filedialog.asksaveasfilename(
-            defaultextension=".docx",
-            filetypes=[("Word files", "*.docx")],
-            title="Chọn nơi lưu file Word"
-        )
-        if not file_path:
-            return
-        try:
-            doc = Document()
-            for line in content.splitlines():
-                doc.add_paragraph(line)
-            doc.save(file_path)
-            messagebox.showinfo("Thành công", f"Đã xuất ra Word: {file_path}")
-        except Exception as e:
-            messagebox.showerror("Lỗi xuất Word", str(e))
+def estimate_tokens(text, start=0, end=None):
+    """Ước lượng số token của text[start:end] (không cắt chuỗi): chữ Hán ~1 token/ký tự, chữ Latin ~4 ký tự/token."""
+    end = len(text) if end is None else end
+    cjk = len(CJK_PATTERN.findall(text, start, end))
+    return cjk + (end - start - cjk) // 4 + 1
 
-    def create_main_frame(self):
-        self.main_canvas = tk.Canvas(self.root)
-        self.scrollbar = ttk.Scrollbar(self.root, orient="vertical",
-                                     command=self.main_canvas.yview)
-        self.scrollable_frame = ttk.Frame(self.main_canvas)
 
-        self.scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.main_canvas.configure(scrollregion=self.main_canvas.bbox("all"))
-        )
+def strip_range(text, start, end):
+    """Như text[start:end].strip() nhưng trả về khoảng vị trí, không tạo chuỗi mới."""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
 
-        self.main_canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.main_canvas.configure(yscrollcommand=self.scrollbar.set)
 
-        self.main_canvas.bind_all("<MouseWheel>",
-                                lambda e: self.main_canvas.yview_scroll(
-                                    int(-1*(e.delta/120)), "units"))
+def find_cut_position(text, start, end):
+    """Vị trí cắt phần text[start:end]: ngay sau dấu ngắt câu gần end nhất trong 100 ký tự cuối,
+    không có thì sau khoảng trắng gần nhất, không có nữa thì giữ nguyên end (cắt cứng).
 
-        self.scrollbar.pack(side="right", fill="y")
-        self.main_canvas.pack(side="left", fill="both", expand=True)
+    Regex và rfind chạy trực tiếp trên text với giới hạn vị trí, không cắt lát chuỗi.
+    """
+    split_pos = end
+    last_match = None
+    for last_match in SENTENCE_END_PATTERN.finditer(text, max(start, end - 100), end):
+        pass
+    if last_match is not None:
+        split_pos = last_match.end()
+    else:
+        space_pos = text.rfind(' ', start, end)
+        if space_pos > start:
+            split_pos = space_pos + 1
+    return split_pos if split_pos > start else end
 
-    def create_text_widget(self, parent, height=4):
-        text_widget = tk.Text(parent, height=height, font=('Arial', 12),
-                            wrap=tk.WORD)
-        scrollbar = ttk.Scrollbar(parent, orient="vertical", command=text_widget.yview)
-        text_widget.configure(yscrollcommand=scrollbar.set)
-        text_widget.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
-        return text_widget
 
-    def create_widgets(self):
-        main_container = ttk.Frame(self.scrollable_frame, padding="10")
-        main_container.pack(fill="both", expand=True)
+class TextChunks:
+    """Các phần của một văn bản lưu dưới dạng khoảng vị trí [start, end) trong văn bản gốc.
 
-        # Language & provider selection (row layout, fixed width)
-        lang_frame = ttk.LabelFrame(main_container, text="Chọn ngôn ngữ / Provider", padding="5")
-        lang_frame.pack(fill="x", pady=5)
-        lang_provider_frame = ttk.Frame(lang_frame)
-        lang_provider_frame.pack(fill="x")
-        self.language = ttk.Combobox(lang_provider_frame, values=["中文", "ENG", "Việt Nam"],
-                                   font=('Arial', 12), state="readonly", width=10)
-        self.language.set("中文")
-        self.language.pack(side="left", padx=(0, 5))
-        self.language.bind("<<ComboboxSelected>>", self.on_language_change)
-        self.provider_combo = ttk.Combobox(
-            lang_provider_frame,
-            textvariable=self.provider_var,
-            values=list(PROVIDER_CONFIG.keys()),
-            font=('Arial', 12),
-            state="readonly",
-            width=12
-        )
-        self.provider_combo.pack(side="left", padx=(0, 5))
-        self.provider_combo.bind("<<ComboboxSelected>>", self.on_provider_change)
+    Chuỗi của một phần chỉ được cắt ra khi lấy phần đó (lúc gửi API), nên việc chia văn bản
+    không tạo thêm bản sao nào của văn bản.
+    """
 
-        # Model selection (row layout, fixed width)
-        model_frame = ttk.LabelFrame(main_container, text="Chọn model chính", padding="5")
-        model_frame.pack(fill="x", pady=5)
-        model_row = ttk.Frame(model_frame)
-        model_row.pack(fill="x")
-        self.model = ttk.Combobox(model_row, values=[], font=('Arial', 12), state="readonly", width=22)
-        self.update_model_options(self.provider_var.get())
-        self.model.pack(side="left", padx=(0, 5))
+    def __init__(self, text, ranges):
+        self.text = text # Chuỗi văn bản, hoặc InputFile khi đọc thẳng từ file
+        self.ranges = ranges
 
-        # API Key Frame (row layout, fixed width)
-        api_frame = ttk.LabelFrame(main_container, text="API Key", padding="5")
-        api_frame.pack(fill="x", pady=5)
-        api_row = ttk.Frame(api_frame)
-        api_row.pack(fill="x")
-        self.api_key_label = ttk.Label(api_row, text="Chưa có API Key nào được chọn", font=('Arial', 12), width=32, anchor="w")
-        self.api_key_label.pack(side="left", padx=(0, 5))
-        self.browse_api_key_button = ttk.Button(api_row, text="Chọn File API Key", command=self.browse_api_key_file, width=18)
-        self.browse_api_key_button.pack(side="left")
+    def __len__(self):
+        return len(self.ranges)
 
-        # Split method & length (row layout, fixed width)
-        split_row = ttk.Frame(main_container)
-        split_row.pack(fill="x", pady=5)
-        split_frame = ttk.LabelFrame(split_row, text="Phương thức chia văn bản", padding="5")
-        split_frame.pack(side="left", padx=(0, 5))
-        self.split_method = ttk.Combobox(split_frame,
-                    values=["Theo chương (第X章/Chương X)", "Theo số ký tự"],
-                    font=('Arial', 12), width=20, state="readonly")
-        self.split_method.set("Theo chương (第X章/Chương X)")
-        self.split_method.pack()
+    def __getitem__(self, index):
+        start, end = self.ranges[index]
+        return self.text[start:end]
 
-        split_length_frame = ttk.LabelFrame(split_row, text="Số ký tự/số từ mỗi phần", padding="5")
-        split_length_frame.pack(side="left")
-        self.split_length_entry = ttk.Entry(split_length_frame, font=('Arial', 12), width=10)
-        self.split_length_entry.pack()
-        self.split_length_entry.insert(0, "10000")
+    def __iter__(self):
+        for start, end in self.ranges:
+            yield self.text[start:end]
 
-        # Progress bar
-        self.progress_bar = ttk.Progressbar(main_container, orient="horizontal",
-                                          mode="determinate")
-        self.progress_bar.pack(fill="x", pady=5)
+    def offsets(self, index):
+        """Vị trí của phần trong văn bản gốc, ghi vào kho kết quả của job."""
+        start, end = self.ranges[index]
+        return {"source_chars": [start, end]}
 
-        mode_frame = ttk.LabelFrame(main_container, text="Chọn phiên bản", padding="5")
-        mode_frame.pack(fill="x", pady=5)
-        self.context_mode = tk.StringVar(value=MODE_WITH_CONTEXT)
-        ttk.Radiobutton(
-            mode_frame,
-            text="1. With previous context",
-            variable=self.context_mode,
-            value=MODE_WITH_CONTEXT,
-            command=self.on_context_mode_change
-        ).pack(anchor="w")
-        ttk.Radiobutton(
-            mode_frame,
-            text="2. Without previous context",
-            variable=self.context_mode,
-            value=MODE_WITHOUT_CONTEXT,
-            command=self.on_context_mode_change
-        ).pack(anchor="w")
 
-        # Prompt input + context input
-        prompt_context_frame = ttk.Frame(main_container)
-        prompt_context_frame.pack(fill="x", pady=5)
+class _TextWindow:
+    """Một đoạn đã giải mã của file văn bản đang đọc tuần tự, kèm vị trí byte của ký tự đầu đoạn."""
 
-        prompt_frame = ttk.LabelFrame(prompt_context_frame, text="Nhập prompt", padding="5")
-        prompt_frame.pack(side="left", fill="both", expand=True)
-        self.prompt_text = self.create_text_widget(prompt_frame, height=4)
+    def __init__(self, handle):
+        self.handle = handle
+        self.buffer = ""
+        self.byte_start = 0
+        self.eof = False
+        self._mark = (0, 0) # (vị trí ký tự, vị trí byte) đã tính gần nhất, để byte() chỉ mã hóa phần mới
 
-        context_frame = ttk.LabelFrame(prompt_context_frame, text="Bối cảnh chương trước (tóm tắt)", padding="5")
-        context_frame.pack(side="left", fill="both", expand=True, padx=5)
-        self.prev_summary_text = self.create_text_widget(context_frame, height=4)
-        self.prev_summary_text.insert("1.0", "")
-        self.on_context_mode_change()
+    def read_more(self):
+        block = self.handle.read(InputFile.BLOCK_CHARS)
+        if not block:
+            self.eof = True
+            return False
+        self.buffer += block
+        return True
 
-        # Additional text input
-        additional_frame = ttk.LabelFrame(main_container,
-                                        text="Nhập văn bản cần xử lý", # Sửa label
-                                        padding="5")
-        additional_frame.pack(fill="x", pady=5)
-        self.additional_text = self.create_text_widget(additional_frame, height=10) # Tăng chiều cao
+    def byte(self, pos):
+        """Vị trí byte trong file của ký tự thứ pos trong đoạn."""
+        mark_pos, mark_byte = self._mark
+        if pos < mark_pos:
+            mark_pos, mark_byte = 0, self.byte_start
+        mark_byte += len(self.buffer[mark_pos:pos].encode('utf-8'))
+        self._mark = (pos, mark_byte)
+        return mark_byte
 
-        # Buttons
-        button_frame = ttk.Frame(main_container)
-        button_frame.pack(fill="x", pady=10)
-        self.submit_button = ttk.Button(button_frame, text="Gửi yêu cầu",
-                                      command=self.start_processing)
-        self.submit_button.pack(side=tk.LEFT, padx=5)
-        self.stop_button = ttk.Button(button_frame, text="Dừng",
-                                    command=self.stop_processing, state='disabled') # Bắt đầu ở trạng thái disabled
-        self.stop_button.pack(side=tk.LEFT, padx=5)
-        self.load_button = ttk.Button(button_frame, text="Tải kết quả mới nhất", # Sửa label
-                                    command=self.load_results)
-        self.load_button.pack(side=tk.LEFT, padx=5)
+    def drop(self, pos):
+        """Bỏ phần đầu đoạn đã xử lý xong để bộ nhớ không tăng theo kích thước file."""
+        self.byte_start = self.byte(pos)
+        self.buffer = self.buffer[pos:]
+        self._mark = (0, self.byte_start)
 
-        # Progress display
-        progress_frame = ttk.LabelFrame(main_container, text="Tiến trình xử lý hiện tại",
-                                      padding="5")
-        progress_frame.pack(fill="x", pady=5)
-        self.progress_text = self.create_text_widget(progress_frame, height=2)
 
-        # Current result display
-        result_frame = ttk.LabelFrame(main_container, text="Kết quả xử lý phần hiện tại",
-                                    padding="5")
-        result_frame.pack(fill="x", pady=5)
-        self.result_text = self.create_text_widget(result_frame, height=4)
+class InputFile:
+    """Văn bản đầu vào đọc thẳng từ file UTF-8, không nạp cả file vào bộ nhớ.
 
-        # Completion status
-        completion_frame = ttk.LabelFrame(main_container, text="Kết quả cuối cùng và trạng thái", # Sửa label
-                                        padding="5")
-        completion_frame.pack(fill="x", pady=5)
-        self.completion_text = self.create_text_widget(completion_frame, height=4) # Tăng chiều cao
-    def build_translation_prompt(self, chapter_text, prev_summary):
-        prompt = self.prompt_text.get("1.0", tk.END).strip()
-        context = prev_summary.strip()
-        use_context = self.context_mode.get() == MODE_WITH_CONTEXT
-        prompt_parts = [prompt]
-        if use_context and context:
-            prompt_parts.append(f"\nBối cảnh chương trước: {context}")
-        prompt_parts.append("\nNội dung cần dịch:\n" + chapter_text)
-        if use_context:
-            prompt_parts.append("\nYêu cầu:\n1. Trả về bản dịch tiếng Việt của chương trên, không dùng Markdown.\n2. Trả về tóm tắt nội dung chương vừa dịch, tối đa 350 từ, giữ nguyên đại từ nhân xưng được sử dụng trong văn bản dịch. Tuyệt đối không ghép đại từ trước tên riêng (ví dụ: chỉ viết 'Yến Dịch', không được viết 'anh Yến Dịch') Giữ đúng đại từ khi dẫn truyện. \nTrả kết quả theo đúng thứ tự:\n---DỊCH---\n[Bản dịch]\n---TÓM TẮT---\n[Tóm tắt chương]")
-        return "\n".join(prompt_parts)
+    Dùng thay cho chuỗi văn bản trong JobConfig.text: TranslationEngine chia file theo từng khối
+    và nhận về FileChunks (khoảng byte), nội dung từng phần chỉ được đọc từ đĩa khi gửi đi.
+    Nội dung được hiểu như chuỗi đã strip(), nên fingerprint, số phần và nội dung từng phần
+    giống hệt khi dán cùng văn bản vào ô nhập (job chạy từ file hay từ ô nhập đều tiếp tục được cho nhau).
+    """
 
-    def extract_translation_and_summary(self, response_text):
-        import re
-        parts = re.split(r'---DỊCH---|---TÓM TẮT---', response_text)
-        if len(parts) >= 3:
-            translation = parts[1].strip()
-            summary = parts[2].strip()
-        else:
-            translation = response_text.strip()
-            summary = ""
-        return translation, summary
+    BLOCK_CHARS = 1 << 20 # Số ký tự đọc mỗi lần
+    PATTERN_OVERLAP = 1 << 14 # Match regex kết thúc trong đoạn cuối này của khối thì đọc thêm rồi tìm lại
 
-    def on_context_mode_change(self):
-        use_context = self.context_mode.get() == MODE_WITH_CONTEXT
-        state = "normal" if use_context else "disabled"
-        self.prev_summary_text.configure(state=state)
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._fingerprint = None
+        self._chars = None
 
-    def on_language_change(self, event):
-        """Update label when language changes."""
-        language = self.language.get()
-        if language == "ENG":
-            self.split_length_label.config(text="Số từ mỗi phần:")
-        elif language in ["中文", "Việt Nam"]:
-            self.split_length_label.config(text="Số ký tự mỗi phần:")
-        else:
-            self.split_length_label.config(text="Số ký tự/số từ mỗi phần:")
+    def open(self):
+        # newline='' để vị trí ký tự khớp từng byte trong file (không đổi \r\n thành \n)
+        return open(self.path, 'r', encoding='utf-8', newline='')
 
-    def on_provider_change(self, event):
-        """Refresh model list when provider changes."""
-        self.update_model_options()
+    def __bool__(self):
+        return len(self) > 0
 
-    def update_model_options(self, provider=None):
-        """Update model combobox based on selected provider."""
-        provider = provider or self.provider_var.get()
-        config = PROVIDER_CONFIG.get(provider, {})
-        models = config.get("models", [])
-        self.model["values"] = models
-        default_model = PROVIDER_DEFAULT_MODELS.get(provider)
-        if default_model in models:
-            self.model.set(default_model)
-        elif models:
-            self.model.set(models[0])
-        else:
-            self.model.set("")
+    def __len__(self):
+        """Số ký tự của nội dung (đã strip)."""
+        if self._chars is None:
+            self.fingerprint()
+        return self._chars
 
-    def setup_periodic_queue_check(self):
-        def check_queue():
-            try:
+    def fingerprint(self):
+        """Bằng JobManifest.fingerprint(nội dung đã strip()), tính khi đọc file theo từng khối."""
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            chars = 0
+            pending = "" # Khoảng trắng cuối khối, chỉ tính nếu phía sau còn chữ
+            started = False
+            with self.open() as f:
                 while True:
-                    message = self.queue.get_nowait()
-                    widget, text, clear = message
-                    if clear:
-                        widget.delete("1.0", tk.END)
-                    widget.insert(tk.END, text)
-                    widget.see(tk.END) # Auto scroll to bottom
-            except queue.Empty:
-                pass
-            except Exception as e:
-                print(f"Lỗi UI update: {e}") # Log lỗi UI
-            finally:
-                self.root.after(100, check_queue)
-        self.root.after(100, check_queue)
+                    block = f.read(self.BLOCK_CHARS)
+                    if not block:
+                        break
+                    if not started:
+                        block = block.lstrip()
+                        started = bool(block)
+                    content = block.rstrip()
+                    if content:
+                        data = pending + content
+                        digest.update(data.encode('utf-8'))
+                        chars += len(data)
+                        pending = block[len(content):]
+                    else:
+                        pending += block
+            self._fingerprint = digest.hexdigest()
+            self._chars = chars
+        return self._fingerprint
 
-    def update_ui(self, widget, message, clear=True):
-        # Hàm này có thể không cần thiết nữa vì logic đã chuyển vào check_queue
-        # Nhưng vẫn giữ lại nếu có chỗ khác dùng
-        self.queue.put((widget, message, clear))
+    def preview(self, chars=INPUT_PREVIEW_CHARS):
+        """chars ký tự đầu của nội dung, đúng bằng read_text()[:chars] (bỏ khoảng trắng đầu và cuối file)."""
+        text = ""
+        with self.open() as f:
+            # Đọc tới khi có chữ ở vị trí >= chars - 1 thì khoảng trắng cuối file không lọt vào kết quả
+            while not text[chars - 1:].strip():
+                block = f.read(self.BLOCK_CHARS)
+                if not block:
+                    break
+                text = (text + block).lstrip()
+        return text.rstrip()[:chars]
 
-    def show_error(self, message):
-        # Hiển thị lỗi trên result_text và messagebox
-        self.queue.put((self.result_text, f"Lỗi: {message}\n", True))
-        messagebox.showerror("Lỗi", message)
+    def read_text(self):
+        with self.open() as f:
+            return f.read().strip()
 
-    def browse_api_key_file(self):
-        """Open file dialog to select API key file."""
-        file_path = filedialog.askopenfilename(
-            title="Chọn File API Key",
-            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
-        )
-        if file_path:
-            try:
-                keys = []
-                with open(file_path, 'r') as f:
-                    for line in f:
-                        stripped_line = line.strip()
-                        if stripped_line and not stripped_line.startswith('#'):
-                            keys.append(stripped_line)
-                if not keys:
-                    self.api_key_label.config(text="File API Key không chứa key hợp lệ")
-                    self.api_key = None
-                    self.api_keys = []
-                else:
-                    self.api_key = keys[0]
-                    self.api_keys = keys
-                    self.api_key_index = 0
-                    self.api_key_label.config(text=f"Đã tải {len(keys)} API Key từ: {os.path.basename(file_path)}")
-            except Exception as e:
-                self.api_key_label.config(text=f"Lỗi đọc file API Key: {str(e)}")
-                self.api_key = None
-                self.api_keys = []
+    def read_chunk(self, ranges):
+        """Nội dung một phần: các khoảng byte đã strip() nối bằng xuống dòng (tiêu đề chương + nội dung)."""
+        pieces = []
+        with open(self.path, 'rb') as f:
+            for start, end in ranges:
+                f.seek(start)
+                pieces.append(f.read(end - start).decode('utf-8').strip())
+        return "\n".join(pieces).strip()
 
-    def validate_inputs(self):
-        errors = []
+    def scan(self, pattern):
+        """Tìm mọi match của pattern (regex, không phân biệt hoa thường) trong file.
 
-        if not self.api_key:
-            errors.append("API Key chưa được tải. Vui lòng chọn file API Key.")
+        Trả về (danh sách khoảng byte của các match, danh sách có/không có chữ của từng đoạn
+        giữa các match: đoạn trước match đầu, giữa các match, sau match cuối).
+        """
+        regex = re.compile(pattern, re.IGNORECASE)
+        matches = []
+        has_text = []
+        gap_text = False # Đoạn đang xét (sau match gần nhất) đã có chữ chưa
+        with self.open() as f:
+            window = _TextWindow(f)
+            scan_pos = 0
+            while True:
+                window.read_more()
+                buffer = window.buffer
+                limit = len(buffer) if window.eof else len(buffer) - self.PATTERN_OVERLAP
+                resume_at = max(scan_pos, limit)
+                for match in regex.finditer(buffer, scan_pos):
+                    if not window.eof and match.end() > limit:
+                        # Match có thể dài hơn khi đọc thêm; không lùi quá limit vì match sớm hơn bị
+                        # bỏ qua (chưa đủ chữ để khớp) có thể bắt đầu trước match này
+                        resume_at = min(match.start(), max(scan_pos, limit))
+                        break
+                    gap_text = gap_text or NON_SPACE_PATTERN.search(buffer, scan_pos, match.start()) is not None
+                    has_text.append(gap_text)
+                    gap_text = False
+                    matches.append((window.byte(match.start()), window.byte(match.end())))
+                    scan_pos = match.end()
+                    resume_at = max(scan_pos, limit)
+                if window.eof:
+                    has_text.append(gap_text or NON_SPACE_PATTERN.search(buffer, scan_pos) is not None)
+                    return matches, has_text
+                if resume_at > scan_pos:
+                    gap_text = gap_text or NON_SPACE_PATTERN.search(buffer, scan_pos, resume_at) is not None
+                window.drop(resume_at)
+                scan_pos = 0
 
-        if not self.prompt_text.get("1.0", tk.END).strip():
-            errors.append("Prompt không được để trống")
+    def iter_ranges(self, max_chars=None, max_tokens=None, calibration=1.0, chars_per_token=1.0):
+        """Sinh khoảng byte (bắt đầu, kết thúc) của từng phần khi chia theo ký tự (max_chars)
+        hoặc theo token (max_tokens), cắt giống hệt TranslationEngine.split_by_chars / split_by_tokens
+        trên nội dung đã strip(), nhưng chỉ giữ vài khối trong bộ nhớ."""
+        with self.open() as f:
+            window = _TextWindow(f)
+            while not window.eof and not window.buffer.strip():
+                window.read_more()
+            start = len(window.buffer) - len(window.buffer.lstrip())
+            while True:
+                size = max_chars if max_tokens is None else max(1, int(max_tokens * chars_per_token))
+                # Cần biết nội dung còn dài hơn size ký tự không: đọc tới khi sau đó còn chữ hoặc hết file
+                while not window.eof and (len(window.buffer) <= start + size or window.buffer[start + size:].isspace()):
+                    window.read_more()
+                buffer = window.buffer
+                text_len = len(buffer.rstrip()) if window.eof else len(buffer)
+                if start >= text_len:
+                    return
+                while True:
+                    end = min(start + size, text_len)
+                    if end < text_len:
+                        end = find_cut_position(buffer, start, end)
+                    if max_tokens is None:
+                        break
+                    tokens = estimate_tokens(buffer, start, end) * calibration
+                    if tokens <= max_tokens or size <= 100:
+                        break
+                    size = max(100, int(size * max_tokens / tokens * 0.95))
+                chunk_start, chunk_end = strip_range(buffer, start, end)
+                if chunk_start < chunk_end:
+                    yield window.byte(chunk_start), window.byte(chunk_end)
+                start = end
+                if start > self.BLOCK_CHARS:
+                    window.drop(start)
+                    start = 0
 
-        if not self.additional_text.get("1.0", tk.END).strip():
-            errors.append("Văn bản cần xử lý không được để trống") # Sửa thông báo lỗi
 
-        if self.split_method.get() == "Theo số ký tự":
-            try:
-                split_length = int(self.split_length_entry.get())
-                if split_length <= 0:
-                    errors.append("Số ký tự/số từ mỗi phần phải lớn hơn 0")
-            except ValueError:
-                errors.append("Số ký tự/số từ không hợp lệ")
+class FileChunks:
+    """Các phần của một InputFile, mỗi phần là một hoặc nhiều khoảng byte; nội dung đọc từ đĩa khi lấy phần đó."""
 
-        return errors
+    def __init__(self, source, chunks):
+        self.source = source
+        self.chunks = chunks
 
-    def start_processing(self):
-        if self.processing:
-            messagebox.showwarning("Đang xử lý", "Một yêu cầu đang được xử lý. Vui lòng đợi.")
-            return
+    def __len__(self):
+        return len(self.chunks)
 
-        errors = self.validate_inputs()
-        if errors:
-            self.show_error("\n".join(errors))
-            return
+    def __getitem__(self, index):
+        return self.source.read_chunk(self.chunks[index])
 
-        self.processing = True
-        self.should_stop = False
-        self.submit_button.configure(state='disabled')
-        self.stop_button.configure(state='normal')
-        # Xóa các ô text trước khi bắt đầu
-        self.progress_text.delete("1.0", tk.END)
-        self.result_text.delete("1.0", tk.END)
-        self.completion_text.delete("1.0", tk.END)
-        self.progress_bar["value"] = 0
+    def __iter__(self):
+        for ranges in self.chunks:
+            yield self.source.read_chunk(ranges)
 
-        thread = threading.Thread(target=self._process_request_thread, daemon=True)
-        # thread.daemon = True # Đã set ở trên
-        thread.start()
+    def offsets(self, index):
+        """Các khoảng byte của phần trong file đầu vào, ghi vào kho kết quả của job."""
+        return {"source_bytes": [list(byte_range) for byte_range in self.chunks[index]]}
 
-    def stop_processing(self):
-        if not self.processing:
-            return
-        self.should_stop = True
-        self.queue.put((self.progress_text, "\nĐang yêu cầu dừng...", False)) # Ghi thêm, không xóa
-        self.stop_button.configure(state='disabled') # Vô hiệu hóa ngay khi bấm dừng
 
-    # --- Hàm gọi API mới ---
-    def _call_model_api(self, provider, model_name, prompt_content, openai_client=None):
-        """Hàm thực hiện gọi API theo provider được chọn."""
-        try:
-            if provider == "Google":
-                model_instance = genai.GenerativeModel(model_name)
-                response = model_instance.generate_content(prompt_content)
-                if not response or not response.text:
-                    return None, f"Không nhận được nội dung hợp lệ từ model {model_name}"
-                return response.text, None
-            elif provider in ["MegaLLM", "Open Router", "POE", "Mistral", "Literouter"]:
-                if openai_client is None:
-                    return None, f"{provider} client chưa được khởi tạo."
-                response = openai_client.chat.completions.create(
-                    model=model_name,
-                    messages=[{"role": "user", "content": prompt_content}]
-                )
-                content = self._extract_megallm_content(response)
-                if not content:
-                    return None, f"Không nhận được nội dung hợp lệ từ model {model_name} ({provider})"
-                return content, None
-            else:
-                return None, f"Provider {provider} chưa hỗ trợ."
-        except Exception as e:
-            error_msg = f"Lỗi API khi gọi provider {provider}, model {model_name}: {type(e).__name__} - {str(e)}"
-            print(error_msg)
-            return None, error_msg
+def model_token_limits(model_name):
+    """(context tối đa, output tối đa) của model theo MODEL_TOKEN_LIMITS."""
+    name = (model_name or "").lower().rsplit("/", 1)[-1]
+    for prefix, context_limit, output_limit in MODEL_TOKEN_LIMITS:
+        if name.startswith(prefix):
+            return context_limit, output_limit
+    return DEFAULT_MODEL_TOKEN_LIMITS
 
-    def _extract_megallm_content(self, response):
-        """Trích nội dung text từ response theo định dạng OpenAI-compatible."""
-        choices = getattr(response, "choices", None)
-        if not choices:
-            return None
-        first_choice = choices[0]
-        message = getattr(first_choice, "message", None)
-        content = None
-        if message is not None:
-            content = getattr(message, "content", None)
-            if isinstance(content, dict):
-                content = content.get("content")
-        if isinstance(content, list):
-            parts = []
-            for part in content:
-                if isinstance(part, dict):
-                    parts.append(part.get("text") or part.get("content") or "")
-                else:
-                    parts.append(str(part))
-            content = " ".join(part for part in parts if part).strip()
-        elif isinstance(content, str):
-            content = content.strip()
-        if not content and isinstance(message, dict):
-            content = (message.get("content") or "").strip()
-        if not content:
-            text_attr = getattr(first_choice, "text", None)
-            if isinstance(text_attr, str):
-                content = text_attr.strip()
-        return content
 
-    # --- Hàm gọi API với Retry và Timeout ---
-    def call_model_with_retry_and_timeout(self, provider, primary_model_name, prompt_content, openai_client=None):
-        """Gọi API với timeout, retry bằng model fallback nếu cần."""
-        start_time = time.time()
-        error_message_final = "Không có lỗi"
-        provider_config = PROVIDER_CONFIG.get(provider, {})
-        fallback_model = provider_config.get("fallback_model")
+def parse_rate_limit_error(error):
+    """Trả về số giây cần nghỉ nếu lỗi là 429 / RESOURCE_EXHAUSTED, None nếu là lỗi khác."""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    message = str(error)
+    if status != 429 and "RESOURCE_EXHAUSTED" not in message and not re.search(r'\b429\b', message):
+        return None
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after"):
+            return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass # Retry-After dạng ngày giờ -> dùng mặc định
+    # Gemini trả RetryInfo trong nội dung lỗi, ví dụ 'retryDelay': '17s'
+    match = re.search(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", message)
+    if match:
+        return float(match.group(1))
+    return RATE_LIMIT_DEFAULT_COOLDOWN
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(self._call_model_api, provider, primary_model_name, prompt_content, openai_client)
-            try:
-                print(f"Attempting primary model ({provider}): {primary_model_name}")
-                result_text, error_message = future.result(timeout=API_TIMEOUT_SECONDS)
-                if error_message:
-                    print(f"Primary model failed: {error_message}")
-                    error_message_final = error_message
-                else:
-                    print("Primary model success.")
-                    return result_text, None
-            except concurrent.futures.TimeoutError:
-                elapsed = time.time() - start_time
-                print(f"Primary model timeout after {elapsed:.2f}s")
-                error_message_final = f"Model chính ({primary_model_name}) timeout sau {elapsed:.2f} giây."
-            except Exception as e:
-                elapsed = time.time() - start_time
-                print(f"Primary model unexpected error after {elapsed:.2f}s: {e}")
-                error_message_final = f"Lỗi không xác định với model chính ({primary_model_name}): {str(e)}"
 
-        if not fallback_model:
-            error_message_final += "\nProvider không có fallback model."
-            return None, error_message_final
+_call_context = threading.local() # CallProgress của lần gọi API và phần (part) đang xử lý trên luồng hiện tại
 
-        print(f"Trying fallback model: {fallback_model}")
-        self.queue.put((self.progress_text, f"\n-> Thử lại với model {fallback_model}...", False))
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            fallback_start_time = time.time()
-            future = executor.submit(self._call_model_api, provider, fallback_model, prompt_content, openai_client)
-            try:
-                result_text, error_message = future.result(timeout=API_TIMEOUT_SECONDS)
-                if error_message:
-                    print(f"Fallback model failed: {error_message}")
-                    error_message_final += f"\nRetry với {fallback_model} cũng thất bại: {error_message}"
-                    return None, error_message_final
-                else:
-                    elapsed_fallback = time.time() - fallback_start_time
-                    print(f"Fallback model success after {elapsed_fallback:.2f}s.")
-                    self.queue.put((self.progress_text, f"\n-> Retry với {fallback_model} thành công.", False))
-                    return result_text, None
-            except concurrent.futures.TimeoutError:
-                elapsed = time.time() - fallback_start_time
-                print(f"Fallback model timeout after {elapsed:.2f}s")
-                error_message_final += f"\nRetry với {fallback_model} cũng timeout sau {elapsed:.2f} giây."
-                return None, error_message_final
-            except Exception as e:
-                elapsed = time.time() - fallback_start_time
-                print(f"Fallback model unexpected error after {elapsed:.2f}s: {e}")
-                error_message_final += f"\nLỗi không xác định khi retry với {fallback_model}: {str(e)}"
-                return None, error_message_final
-    def _process_request_thread(self):
-        import traceback
-        try:
-            provider = self.provider_var.get()
-            provider_config = PROVIDER_CONFIG.get(provider)
-            if not provider_config:
-                self.show_error(f"Provider {provider} chưa được cấu hình.")
-                self.processing = False
-                self.root.after(0, lambda: self.submit_button.configure(state='normal'))
-                self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
-                return
-            openai_client = None
-            # Round robin API key setup
-            api_keys = self.api_keys if self.api_keys else ([self.api_key] if self.api_key else [])
-            api_key_count = len(api_keys)
-            api_key_index = self.api_key_index if api_key_count > 0 else 0
-            if provider == "Google":
-                genai.configure(api_key=api_keys[api_key_index] if api_key_count > 0 else None)
-            elif provider in ["MegaLLM", "Open Router", "POE", "Mistral", "Literouter"]:
-                try:
-                    base_url = provider_config.get("base_url")
-                    if not base_url and provider == "MegaLLM":
-                        base_url = MEGALLM_BASE_URL
-                    default_headers = provider_config.get("headers")
-                    openai_client = OpenAI(
-                        base_url=base_url,
-                        api_key=api_keys[api_key_index] if api_key_count > 0 else None,
-                        default_headers=default_headers
-                    )
-                except Exception as client_error:
-                    self.show_error(f"Không thể khởi tạo {provider} client: {client_error}")
-                    self.processing = False
-                    self.root.after(0, lambda: self.submit_button.configure(state='normal'))
-                    self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
-                    return
-            else:
-                self.show_error(f"Provider {provider} chưa hỗ trợ.")
-                self.processing = False
-                self.root.after(0, lambda: self.submit_button.configure(state='normal'))
-                self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
-                return
-            primary_model_name = self.model.get()
-
-            text = self.additional_text.get("1.0", tk.END).strip()
-            split_method = self.split_method.get()
-            split_length = self.split_length_entry.get()
-            if split_method == "Theo chương (第X章/Chương X)":
-                chapters = self.split_text(text)
-            else:  # "Theo số ký tự"
-                chapters = self.split_text(text)
-            if not chapters:
-                self.show_error("Không thể chia văn bản thành các phần.")
-                self.processing = False
-                self.root.after(0, lambda: self.submit_button.configure(state='normal'))
-                self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
-                return
+def attach_response_to_call(response):
+    """Event hook của httpx: gắn response vừa nhận header vào CallProgress của luồng đang gọi API."""
+    progress = getattr(_call_context, "progress", None)
+    if progress is not None:
+        progress.attach(response)
 
-            results_dir = os.path.join(os.path.expanduser("~"), "Downloads", "gemini_results")
-            os.makedirs(results_dir, exist_ok=True)
-            timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-            result_file = os.path.join(results_dir, f"gemini_result_{timestamp}_{primary_model_name.replace('/', '-').replace(':', '_')}.txt")
 
-            self.progress_bar["maximum"] = len(chapters)
-            self.progress_bar["value"] = 0
+def abort_response(response):
+    """Ngắt một HTTP response đang được đọc ở luồng khác.
 
-            status_messages = []
-            total_parts = len(chapters)
-            use_context = self.context_mode.get() == MODE_WITH_CONTEXT
-            prev_summary = self.prev_summary_text.get("1.0", tk.END).strip() if use_context else ""
+    close() của httpx không đánh thức lệnh đọc socket đang chặn, nên shutdown socket:
+    luồng đang đọc nhận lỗi kết nối ngay thay vì chờ hết timeout đọc.
+    """
+    network_stream = getattr(response, "extensions", {}).get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass # Kết nối đã đóng
 
-            translations_only = []
-            for i, chapter in enumerate(chapters, 1):
-                if self.should_stop:
-                    status_messages.append(f"Phần {i}/{total_parts}: Đã dừng bởi người dùng.")
-                    self.queue.put((self.completion_text,
-                                    f"Xử lý đã bị dừng ở phần {i}.\n" + "\n".join(status_messages) + f"\nKết quả chưa hoàn chỉnh lưu tại: {result_file}", True))
-                    break
 
-                # Round robin API key selection
-                if api_key_count > 0:
-                    current_key = api_keys[api_key_index]
-                    self.api_key_index = (api_key_index + 1) % api_key_count
-                else:
-                    current_key = None
+def usage_tokens(usage):
+    """(token vào, token ra) từ usage của response: Google usage_metadata, OpenAI-compatible usage
+    (object hoặc dict trong kết quả batch); None nếu provider không trả về."""
+    if usage is None:
+        return None, None
+    get = usage.get if isinstance(usage, dict) else (lambda name: getattr(usage, name, None))
+    return (get("prompt_token_count") or get("promptTokenCount") or get("prompt_tokens"),
+            get("candidates_token_count") or get("candidatesTokenCount") or get("completion_tokens"))
 
-                # Update client/key for each call
-                if provider == "Google":
-                    genai.configure(api_key=current_key)
-                elif provider in ["MegaLLM", "Open Router", "POE", "Mistral", "Literouter"]:
-                    try:
-                        base_url = provider_config.get("base_url")
-                        if not base_url and provider == "MegaLLM":
-                            base_url = MEGALLM_BASE_URL
-                        default_headers = provider_config.get("headers")
-                        openai_client = OpenAI(
-                            base_url=base_url,
-                            api_key=current_key,
-                            default_headers=default_headers
-                        )
-                    except Exception as client_error:
-                        self.show_error(f"Không thể khởi tạo {provider} client: {client_error}")
-                        self.processing = False
-                        self.root.after(0, lambda: self.submit_button.configure(state='normal'))
-                        self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
-                        return
 
-                # Xây dựng prompt cho từng chương
-                prompt_content = self.build_translation_prompt(chapter, prev_summary)
-
-                # Hiển thị full prompt gửi API để debug, kèm thông tin key
-                self.queue.put((self.progress_text,
-                    f"Đang xử lý phần {i}/{total_parts}\n"
-                    f"Model chính: {primary_model_name}\n"
-                    f"Đang dùng API KEY thứ {api_key_index+1}/{api_key_count}\n"
-                    f"Prompt gửi API:\n{'='*20}\n{prompt_content}\n{'='*20}", True))
-                self.queue.put((self.result_text, f"--- Đang chờ kết quả phần {i} ---", True))
-
-                response_text, error_msg = self.call_model_with_retry_and_timeout(
-                    provider, primary_model_name, prompt_content, openai_client
-                )
+def cached_input_tokens(usage):
+    """Số token vào provider lấy từ cache prefix (đã tính trong token vào): Google cached_content_token_count,
+    OpenAI-compatible prompt_tokens_details.cached_tokens (DeepSeek: prompt_cache_hit_tokens); None nếu không có."""
+    if usage is None:
+        return None
+    get = usage.get if isinstance(usage, dict) else (lambda name: getattr(usage, name, None))
+    details = get("prompt_tokens_details")
+    if details is not None:
+        cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+        if cached:
+            return cached
+    return get("cached_content_token_count") or get("cachedContentTokenCount") or get("prompt_cache_hit_tokens")
 
-                if self.should_stop:
-                    status_messages.append(f"Phần {i}/{total_parts}: Đã dừng bởi người dùng sau khi gọi API.")
-                    self.queue.put((self.completion_text,
-                                    f"Xử lý đã bị dừng ở phần {i}.\n" + "\n".join(status_messages) + f"\nKết quả chưa hoàn chỉnh lưu tại: {result_file}", True))
-                    break
 
-                if error_msg:
-                    error_log = f"LỖI PHẦN {i}: {error_msg}"
-                    print(error_log)
-                    self.queue.put((self.result_text, error_log, True))
-                    status_messages.append(f"Phần {i}/{total_parts}: Thất bại - {error_msg.splitlines()[0]}")
-                    try:
-                        with open(result_file, 'a', encoding='utf-8') as f:
-                            f.write(f"## LỖI PHẦN {i} ##\n")
-                            f.write(f"{error_msg}\n\n")
-                    except Exception as write_err:
-                        print(f"Không thể ghi lỗi vào file: {write_err}")
-                        status_messages[-1] += " (Không ghi được file)"
-                    self.progress_bar["value"] = i
-                    self.queue.put((self.completion_text, "\n".join(status_messages) + f"\nKết quả đang lưu tại: {result_file}", True))
-                    continue
+class CallCancelled(Exception):
+    """Lần gọi API đã bị bỏ (timeout hoặc người dùng bấm dừng)."""
 
-                # Tách bản dịch và tóm tắt theo mode đã chọn
-                if use_context:
-                    translation, summary = self.extract_translation_and_summary(response_text)
-                else:
-                    translation, summary = response_text.strip(), ""
-                translations_only.append(translation)
-                if use_context:
-                    self.queue.put((self.result_text, f"Kết quả xử lý phần {i}:\n{translation}\n\n---TÓM TẮT---\n{summary}", True))
-                else:
-                    self.queue.put((self.result_text, f"Kết quả xử lý phần {i}:\n{translation}", True))
-                status_messages.append(f"Phần {i}/{total_parts}: Hoàn thành.")
-                # Ghi kết quả vào file
-                try:
-                    with open(result_file, 'a', encoding='utf-8') as f:
-                        f.write(f"## ")
-                        f.write(translation + "\n\n")
-                        if use_context:
-                            f.write(f"## TÓM TẮT PHẦN {i} ##\n")
-                            f.write(summary + "\n\n")
-                except Exception as write_err:
-                    print(f"Không thể ghi kết quả phần {i} vào file: {write_err}")
-                    status_messages[-1] = f"Phần {i}/{total_parts}: Hoàn thành (Lỗi ghi file)"
-                self.progress_bar["value"] = i
-                self.queue.put((self.completion_text, "\n".join(status_messages) + f"\nKết quả đang lưu tại: {result_file}", True))
-                # Cập nhật tóm tắt cho chương sau chỉ khi dùng context
-                if use_context:
-                    prev_summary = summary
-                    self.prev_summary_text.delete("1.0", tk.END)
-                    self.prev_summary_text.insert("1.0", summary)
-
-                # Advance round robin index for next call
-                api_key_index = self.api_key_index
-
-            # Sau khi hoàn thành, lưu file tổng hợp chỉ bản dịch
-            result_file_no_summary = result_file.replace('.txt', '_no_summary.txt')
-            try:
-                with open(result_file_no_summary, 'w', encoding='utf-8') as f:
-                    for idx, translation in enumerate(translations_only, 1):
-                        f.write(f"## ")
-                        f.write(translation + "\n\n")
-            except Exception as write_err:
-                print(f"Không thể ghi file tổng hợp không tóm tắt: {write_err}")
 
-            final_status = "\n".join(status_messages)
-            if not self.should_stop:
-                final_status = "Hoàn thành xử lý tất cả các phần.\n" + final_status
-                self.queue.put((self.progress_text, "Đã xử lý xong!", True))
-            else:
-                final_status = "Xử lý bị dừng.\n" + final_status
-            self.queue.put((self.completion_text, final_status + f"\nKết quả đầy đủ (hoặc chưa hoàn chỉnh) lưu tại: {result_file}", True))
+class CallProgress:
+    """Theo dõi một lần gọi API: thời điểm gửi, token đầu tiên (TTFT) và lần cuối nhận token.
 
-        except FileNotFoundError as e:
-            self.show_error(f"Lỗi đường dẫn hoặc file: {str(e)}")
-        except Exception as e:
-            error_traceback = traceback.format_exc()
-            print(f"Lỗi nghiêm trọng trong _process_request_thread: {error_traceback}")
-            self.show_error(f"Lỗi không xác định trong quá trình xử lý: {str(e)}")
-            self.queue.put((self.completion_text, f"Đã xảy ra lỗi nghiêm trọng: {str(e)}", True))
-        finally:
-            self.processing = False
-            self.root.after(0, lambda: self.submit_button.configure(state='normal'))
-            self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
-            print("Processing thread finished.")
+    cancel() đóng stream đang mở để luồng gọi API thoát ngay thay vì treo tới hết timeout.
+    """
 
-    def split_text(self, text):
-        try:
-            split_method = self.split_method.get()
-            language = self.language.get()
-            split_length = 0 # Khởi tạo
-            if split_method == "Theo số ký tự":
-                try:
-                    split_length = int(self.split_length_entry.get())
-                    if split_length <= 0:
-                        raise ValueError("Số ký tự/số từ mỗi phần phải lớn hơn 0")
-                except ValueError:
-                     # Show error và trả về None để dừng xử lý sớm
-                     self.show_error("Số ký tự/số từ không hợp lệ.")
-                     return None
+    def __init__(self, on_delta=None):
+        self.on_delta = on_delta
+        self.sent_at = None # None = còn đang chờ API key
+        self.first_token_at = None
+        self.last_activity = None
+        self.chars = 0
+        self.max_gap = 0.0 # Khoảng lặng dài nhất giữa hai đoạn text sau token đầu tiên
+        # Timeout của lần gọi này, engine đặt lại theo lịch sử của model (LatencyTracker.timeouts)
+        self.first_token_timeout = STREAM_FIRST_TOKEN_TIMEOUT_SECONDS
+        self.idle_timeout = STREAM_IDLE_TIMEOUT_SECONDS
+        self.total_timeout = API_TIMEOUT_SECONDS
+        self.cancelled = False
+        self.stream = None
+        self.key_slot = None # Key đang dùng, để request hedging chọn key khác
+        self.input_tokens = None # Theo usage của response, None = provider không trả về
+        self.output_tokens = None
+        self.cached_tokens = None # Phần token vào provider lấy từ cache prefix
+        self.part = None # Phần đang gọi và vai trò của lần gọi (primary/fallback/hedge), ghi vào JobTrace
+        self.role = None
 
-            if split_method == "Theo chương (第X章/Chương X)":
-                # Regex tìm "第...章" hoặc "Chương <số>" hoặc "Chapter <số>" case-insensitive
-                # Hỗ trợ cả số La Mã (I, V, X, L, C, D, M) trong Chapter
-                pattern = r'(?:第.*?章|Chương\s*\d+|Chapter\s*(?:\d+|[IVXLCDM]+))\b'
-                # Sử dụng re.split để tách dựa trên pattern, giữ lại delimiter
-                parts = re.split(f'({pattern})', text, flags=re.IGNORECASE)
+    def begin(self):
+        if self.cancelled:
+            raise CallCancelled()
+        self.sent_at = self.last_activity = time.monotonic()
 
-                if len(parts) <= 1: # Không tìm thấy chương nào
-                    # Thử tìm các dấu hiệu xuống dòng kép làm phân tách nếu không có chương
-                    parts = re.split(r'\n\s*\n', text)
-                    if len(parts) <= 1:
-                         self.show_error("Không tìm thấy định dạng chương (第X章/Chương X/Chapter X) hoặc ngắt đoạn bằng dòng trống. Văn bản sẽ được xử lý như một phần duy nhất.")
-                         return [text.strip()] # Trả về toàn bộ văn bản nếu không chia được
-                    else:
-                         # Tìm thấy ngắt đoạn, dùng chúng
-                         result = [p.strip() for p in parts if p.strip()]
-                         if not result:
-                              self.show_error("Văn bản trống sau khi chia theo dòng trống.")
-                              return None
-                         self.queue.put((self.progress_text, "Cảnh báo: Không tìm thấy chương, chia theo dòng trống.", False))
-                         return result
+    def wait_for_key(self):
+        """Dừng đồng hồ timeout trong lúc chờ API key (ví dụ key bị 429 đang nghỉ), begin() tính lại từ đầu."""
+        self.sent_at = self.last_activity = self.first_token_at = None
 
-                # Ghép lại phần tiêu đề chương với nội dung của nó
-                chapters = []
-                current_chapter_content = ""
-                if parts[0].strip(): # Phần text trước chương đầu tiên (nếu có)
-                    current_chapter_content += parts[0].strip() + "\n\n" # Thêm vào phần đầu
+    def attach(self, response):
+        """Ghi nhận HTTP response đang đọc để cancel() ngắt được nó từ luồng khác."""
+        self.stream = response
+        if self.cancelled:
+            self.cancel()
 
-                for i in range(1, len(parts), 2): # Bước nhảy 2 để lấy delimiter và nội dung sau nó
-                    delimiter = parts[i].strip()
-                    content = parts[i+1].strip()
-                    # Bắt đầu chương mới
-                    if current_chapter_content and delimiter: # Chỉ thêm nếu có nội dung chương trước đó
-                         chapters.append(current_chapter_content.strip())
+    def cancel(self):
+        self.cancelled = True
+        response, self.stream = self.stream, None
+        if response is not None:
+            abort_response(response)
 
-                    current_chapter_content = delimiter + "\n" + content # Bắt đầu chương mới với tiêu đề
+    def feed(self, text):
+        if self.cancelled:
+            raise CallCancelled()
+        if not text:
+            return
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            self.max_gap = max(self.max_gap, now - self.last_activity)
+        self.last_activity = now
+        self.chars += len(text)
+        if self.on_delta:
+            self.on_delta(text)
 
-                # Thêm chương cuối cùng
-                if current_chapter_content.strip():
-                    chapters.append(current_chapter_content.strip())
+    def record_usage(self, usage):
+        """Số token từ usage của response (Google: usage_metadata, OpenAI-compatible: usage)."""
+        input_tokens, output_tokens = usage_tokens(usage)
+        if input_tokens:
+            self.input_tokens = input_tokens
+        if output_tokens:
+            self.output_tokens = output_tokens
+        cached_tokens = cached_input_tokens(usage)
+        if cached_tokens:
+            self.cached_tokens = cached_tokens
 
-                if not chapters:
-                     self.show_error("Không trích xuất được nội dung chương nào.")
-                     return None
+    @property
+    def ttft(self):
+        if self.first_token_at is None or self.sent_at is None:
+            return None
+        return self.first_token_at - self.sent_at
 
-                print(f"Đã chia thành {len(chapters)} chương.")
-                return chapters
+    def timeout_exceeded(self):
+        """True nếu đã gửi request mà quá lâu không nhận thêm token nào hoặc cả request quá total_timeout."""
+        if self.last_activity is None:
+            return False
+        now = time.monotonic()
+        limit = self.idle_timeout if self.first_token_at else self.first_token_timeout
+        return now - self.last_activity > limit or now - self.sent_at > self.total_timeout
 
-            elif split_method == "Theo số ký tự":
-                # Đã validate split_length ở đầu hàm
-                if language == "ENG":
-                    # Chia theo từ cho tiếng Anh
-                    return self.smart_split_by_words(text, split_length)
-                else: # Tiếng Trung, Việt hoặc khác - chia theo ký tự
-                    result = []
-                    start = 0
-                    text_len = len(text)
-                    while start < text_len:
-                        end = min(start + split_length, text_len)  # Không vượt quá độ dài văn bản
-                        
-                        # Cố gắng tìm dấu ngắt câu gần nhất lùi về trước để không cắt giữa câu
-                        if end < text_len:
-                            split_pos = end  # Mặc định cắt tại vị trí end
-                            
-                            # Tìm dấu chấm, hỏi, than, xuống dòng gần nhất trong khoảng
-                            search_start = max(start, end - 100)
-                            possible_splits = [m.end() for m in re.finditer(r'[。!?！？\n\r]', text[search_start:end])]
-                            if possible_splits:
-                                # Lấy vị trí ngay sau dấu ngắt gần nhất
-                                split_pos = search_start + max(possible_splits)
-                            else:
-                                # Nếu không có dấu ngắt câu, tìm khoảng trắng gần nhất
-                                space_pos = text.rfind(' ', start, end)
-                                if space_pos > start:  # Đảm bảo tìm được và vị trí hợp lệ
-                                    split_pos = space_pos + 1
-                                # Nếu không tìm được gì, giữ nguyên end (cắt cứng)
-                            
-                            if split_pos > start:  # Đảm bảo có tiến triển
-                                end = split_pos
-
-                        chunk = text[start:end].strip()
-                        if chunk:  # Chỉ thêm nếu chunk không rỗng
-                            result.append(chunk)
-                        
-                        # Đảm bảo tiến triển: nếu end == start, tăng thêm 1 để tránh vòng lặp vô hạn
-                        if end <= start:
-                            start += 1
-                        else:
-                            start = end
 
-                    if not result:
-                        self.show_error("Không thể chia văn bản theo số ký tự (kết quả rỗng).")
-                        return None
-                    print(f"Đã chia thành {len(result)} phần theo ký tự.")
-                    return result
+class PartialOutput:
+    """Ghi phần bản dịch đang stream ra file tạm, xóa file khi phần đó hoàn tất."""
 
-            else:
-                raise ValueError("Phương thức chia văn bản không hợp lệ")
-        except Exception as e:
-            import traceback
-            self.show_error(f"Lỗi nghiêm trọng khi chia văn bản: {str(e)}\n{traceback.format_exc()}")
-            return None # Trả về None khi có lỗi nghiêm trọng
+    def __init__(self, path, echo=None):
+        self.path = path
+        self.echo = echo # Hàm hiển thị đoạn text mới lên UI (None = không hiển thị)
+        self.handle = None
+        self.ttft = None # TTFT của lần gọi thành công
+        self.call = {} # Model, key, thời gian và token của lần gọi thành công, ghi vào kho kết quả
 
-    def smart_split_by_words(self, text, max_words):
-        """
-        Splits text into chunks based on word count, respecting sentence boundaries.
-        """
-        # Cải thiện việc tách câu, hỗ trợ nhiều dấu câu hơn
-        sentences = re.split(r'(?<=[.!?…])\s+', text.replace('\n', ' ')) # Thay newline bằng space để split câu tốt hơn
-        chunks = []
-        current_chunk_sentences = []
-        current_word_count = 0
+    def start_attempt(self, model_name):
+        if self.handle is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.handle = open(self.path, 'w', encoding='utf-8')
+        else:
+            self.handle.seek(0)
+            self.handle.truncate()
+        if self.echo:
+            self.echo(f"\n--- {model_name} đang trả về ---\n")
 
-        for sentence in sentences:
-            if not sentence.strip(): continue # Bỏ qua câu rỗng
+    def succeeded(self, model_name, progress=None):
+        """Ghi nhận lần gọi trả về kết quả; progress None = kết quả lấy từ cache."""
+        if progress is None:
+            self.call = {"model": model_name, "cached": True}
+            return
+        self.ttft = progress.ttft
+        self.call = {
+            "model": model_name,
+            "key": None if progress.key_slot is None else progress.key_slot + 1,
+            "latency": None if progress.sent_at is None else round(time.monotonic() - progress.sent_at, 3),
+            "ttft": None if progress.ttft is None else round(progress.ttft, 3),
+            "input_tokens": progress.input_tokens,
+            "output_tokens": progress.output_tokens,
+            "cached_tokens": progress.cached_tokens,
+        }
 
-            words_in_sentence = len(sentence.split())
+    def write(self, text):
+        if self.handle is not None:
+            self.handle.write(text)
+            self.handle.flush()
+        if self.echo:
+            self.echo(text)
 
-            # Nếu một câu đã quá dài, chia nhỏ câu đó (trường hợp hiếm)
-            if words_in_sentence > max_words:
-                 print(f"Cảnh báo: Câu quá dài ({words_in_sentence} từ), sẽ bị chia nhỏ.")
-                 words = sentence.split()
-                 for i in range(0, len(words), max_words):
-                     sub_sentence = ' '.join(words[i:i+max_words])
-                     if sub_sentence:
-                         chunks.append(sub_sentence)
-                 # Đặt lại chunk hiện tại sau khi xử lý câu dài
-                 current_chunk_sentences = []
-                 current_word_count = 0
-                 continue # Chuyển sang câu tiếp theo
+    def finish(self, keep=False):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        if not keep and os.path.exists(self.path):
+            os.remove(self.path)
 
-            # Kiểm tra xem thêm câu này có vượt quá giới hạn không
-            if current_word_count + words_in_sentence <= max_words:
-                current_chunk_sentences.append(sentence)
-                current_word_count += words_in_sentence
+
+class ResponseCache:
+    """Cache kết quả API trên đĩa, khóa là sha256 của (provider, model, prompt).
+
+    Mỗi kết quả là một file JSON trong cache_dir/<2 ký tự đầu của hash>/. Khi
+    evict(), entry quá CACHE_MAX_AGE_DAYS bị xóa, sau đó xóa entry cũ nhất cho
+    tới khi tổng dung lượng dưới CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_MAX_BYTES, max_age_days=CACHE_MAX_AGE_DAYS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, provider, model_name, prompt_content):
+        payload = json.dumps([provider, model_name, prompt_content], ensure_ascii=False)
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".json")
+
+    def get(self, provider, model_name, prompt_content):
+        path = self._path(provider, model_name, prompt_content)
+        try:
+            if time.time() - os.path.getmtime(path) <= self.max_age_seconds:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = json.load(f)["text"]
+                os.utime(path) # Entry vừa dùng được giữ lâu hơn khi evict
+                with self.lock:
+                    self.hits += 1
+                return text
+        except (OSError, ValueError, KeyError):
+            pass
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, provider, model_name, prompt_content, text):
+        path = self._path(provider, model_name, prompt_content)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"provider": provider, "model": model_name, "created": time.time(), "text": text}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.writes += 1
+        except OSError as e:
+            print(f"Không thể ghi cache: {e}")
+
+    def evict(self):
+        """Xóa entry quá hạn, sau đó xóa entry cũ nhất cho tới khi dưới giới hạn dung lượng."""
+        now = time.time()
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.max_age_seconds or name.endswith(".tmp"):
+                    self._remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def summary(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            rate = 100 * self.hits / lookups if lookups else 0
+            return f"Cache: {self.hits}/{lookups} lượt tra trúng cache ({rate:.0f}%), lưu mới {self.writes} kết quả."
+
+
+class JobManifest:
+    """Kho kết quả và checkpoint của một job: file JSONL nằm cạnh file kết quả (<kết quả>.manifest.jsonl).
+
+    Dòng đầu là thông tin job (fingerprint văn bản đầu vào, cách chia, provider,
+    model, prompt...). Mỗi phần xong (hoặc lỗi) được ghi thêm một dòng gồm trạng
+    thái, vị trí của phần trong văn bản gốc (source_chars hoặc source_bytes), bản
+    dịch, tóm tắt, model, key, thời gian gọi và số token. File chỉ ghi nối thêm;
+    records giữ vị trí byte dòng mới nhất của từng phần nên read(i) chỉ seek một lần.
+    Khi "Tiếp tục job" sinh lại file kết quả, vị trí mới của các phần đã xong được ghi
+    bằng dòng "output" ngắn (record_output) thay vì chép lại cả bản dịch.
+    Các file .txt (có và không có tóm tắt) được sinh từ các dòng này (format_record, write_text).
+    """
+
+    SUFFIX = ".manifest.jsonl"
+    # record() ghi các trường này đầu tiên nên load() không phải parse JSON của cả bản dịch
+    CHUNK_PREFIX = re.compile(rb'\{"type": "chunk", "index": (\d+), "status": "(\w+)"')
+    # Mở đầu mọi dòng; trong chuỗi JSON dấu " luôn được escape nên một dòng hợp lệ chỉ chứa nó ở đầu dòng
+    ENTRY_START = b'{"type": '
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.records = {} # index -> (byte offset của dòng mới nhất, trạng thái)
+        self.batches = {} # id batch (Batch API) -> thông tin đã ghi (parts, key, state...)
+        self.outputs = {} # index -> [bắt đầu, kết thúc] trong file kết quả, ghi sau dòng chunk mới nhất
+        self.valid_end = None # load(): vị trí sau dòng đầy đủ cuối cùng, phần ghi dở sau đó bị cắt trước lần ghi đầu
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(text):
+        if isinstance(text, InputFile):
+            return text.fingerprint()
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def path_for(cls, result_file):
+        return result_file[:-len(".txt")] + cls.SUFFIX
+
+    @classmethod
+    def create(cls, result_file, header):
+        header = dict(header, type="job", version=2, result_file=result_file,
+                      created=datetime.now().isoformat(timespec="seconds"))
+        manifest = cls(cls.path_for(result_file), header)
+        with open(manifest.path, 'wb') as f:
+            f.write(json.dumps(header, ensure_ascii=False).encode('utf-8') + b"\n")
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        """Đọc manifest. Dòng cuối ghi dở khi crash (không có xuống dòng) bị bỏ qua và được cắt khỏi file
+        trước lần ghi tiếp theo. Dòng hỏng ở giữa file (manifest cũ đã ghi nối vào dòng ghi dở) được đọc
+        từ bản ghi đầy đủ ở cuối dòng đó."""
+        manifest = None
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # Dòng cuối ghi dở khi crash
+                match = cls.CHUNK_PREFIX.match(line)
+                if manifest is not None and match and line.find(cls.ENTRY_START, 1) == -1:
+                    index = int(match.group(1))
+                    manifest.records[index] = (offset, match.group(2).decode('ascii'))
+                    manifest.outputs.pop(index, None)
+                    offset += len(line)
+                    continue
+                entry_offset = offset
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    start = line.rfind(cls.ENTRY_START)
+                    try:
+                        entry = json.loads(line[start:].decode('utf-8')) if start > 0 else None
+                    except ValueError:
+                        entry = None
+                    if entry is None or manifest is None:
+                        offset += len(line)
+                        continue
+                    entry_offset = offset + start
+                if manifest is None:
+                    if entry.get("type") != "job":
+                        raise ValueError("File không phải manifest của job.")
+                    manifest = cls(path, entry)
+                elif entry.get("type") == "chunk":
+                    manifest.records[entry["index"]] = (entry_offset, entry["status"])
+                    manifest.outputs.pop(entry["index"], None)
+                elif entry.get("type") == "output":
+                    manifest.outputs[entry["index"]] = entry["output"]
+                elif entry.get("type") == "batch":
+                    manifest.batches[entry["id"]] = dict(manifest.batches.get(entry["id"], {}), **entry)
+                offset += len(line)
+        if manifest is None:
+            raise ValueError("Manifest rỗng.")
+        manifest.valid_end = offset
+        return manifest
+
+    def _append(self, entry):
+        """Ghi thêm một dòng (gọi khi đang giữ self.lock), trả về vị trí byte của dòng."""
+        data = json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n"
+        with open(self.path, 'ab') as f:
+            if self.valid_end is not None:
+                # Cắt dòng ghi dở của lần chạy trước, nếu không dòng mới sẽ bị nối vào nó
+                if f.seek(0, os.SEEK_END) > self.valid_end:
+                    f.truncate(self.valid_end)
+                self.valid_end = None
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+        return offset
+
+    def record(self, index, status, **fields):
+        entry = dict({"type": "chunk", "index": index, "status": status}, **fields)
+        with self.lock:
+            self.records[index] = (self._append(entry), status)
+            self.outputs.pop(index, None)
+
+    def record_output(self, index, output):
+        """Ghi vị trí mới [bắt đầu, kết thúc] của phần trong file kết quả (sau khi sinh lại file lúc tiếp tục job)."""
+        entry = {"type": "output", "index": index, "output": output}
+        with self.lock:
+            self._append(entry)
+            self.outputs[index] = output
+
+    def output_range(self, index):
+        """Vị trí [bắt đầu, kết thúc] hiện tại của phần trong file kết quả, None nếu chưa ghi được."""
+        with self.lock:
+            if index in self.outputs:
+                return self.outputs[index]
+        return self.read(index).get("output")
+
+    def record_batch(self, batch_id, **fields):
+        """Ghi batch đã gửi (hoặc trạng thái mới của nó) để tiếp tục job chờ tiếp batch cũ thay vì gửi lại."""
+        entry = dict({"type": "batch", "id": batch_id}, **fields)
+        with self.lock:
+            self._append(entry)
+            self.batches[batch_id] = dict(self.batches.get(batch_id, {}), **entry)
+
+    def is_done(self, index):
+        record = self.records.get(index)
+        return record is not None and record[1] == "done"
+
+    def read(self, index):
+        """Đọc lại dòng mới nhất của một phần (bản dịch, tóm tắt...) từ đĩa."""
+        offset, _ = self.records[index]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline().decode('utf-8'))
+
+    def done_count(self):
+        return sum(1 for _, status in self.records.values() if status == "done")
+
+    def iter_records(self, indexes=None):
+        """Dòng mới nhất của từng phần theo thứ tự phần; indexes: chỉ đọc các phần này (bỏ qua phần chưa có)."""
+        with self.lock:
+            if indexes is None:
+                records = sorted(self.records.items())
             else:
-                # Đóng chunk hiện tại và bắt đầu chunk mới
-                if current_chunk_sentences:
-                    chunks.append(' '.join(current_chunk_sentences).strip())
-                current_chunk_sentences = [sentence]
-                current_word_count = words_in_sentence
+                records = [(index, self.records[index]) for index in sorted(indexes) if index in self.records]
+        with open(self.path, 'rb') as f:
+            for _, (offset, _) in records:
+                f.seek(offset)
+                yield json.loads(f.readline().decode('utf-8'))
 
-        # Thêm chunk cuối cùng nếu còn
-        if current_chunk_sentences:
-            chunks.append(' '.join(current_chunk_sentences).strip())
+    @staticmethod
+    def format_record(record, use_context, include_summary=True):
+        """Đoạn text của một phần trong file kết quả: "## " + bản dịch, tóm tắt hoặc lỗi của phần đó."""
+        index = record["index"]
+        if record["status"] != "done":
+            return f"## LỖI PHẦN {index} ##\n{record.get('error', '')}\n\n" if include_summary else ""
+        text = f"## {record['translation']}\n\n"
+        if use_context and include_summary:
+            text += f"## TÓM TẮT PHẦN {index} ##\n{record.get('summary', '')}\n\n"
+        return text
 
-        if not chunks:
-             self.show_error("Không thể chia văn bản theo số từ (kết quả rỗng).")
-             return None
-        print(f"Đã chia thành {len(chunks)} phần theo từ.")
-        return chunks
+    def write_text(self, path, include_summary=True):
+        """Sinh lại file .txt từ kho kết quả; include_summary=False chỉ gồm bản dịch các phần đã xong."""
+        use_context = self.header.get("context_mode") == MODE_WITH_CONTEXT
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in self.iter_records():
+                f.write(self.format_record(record, use_context, include_summary))
+        return path
 
-    def load_results(self):
+class ResultsIndex:
+    """Danh sách các job đã chạy: file JSONL (mặc định RESULTS_INDEX_FILE), ghi nối thêm khi job bắt đầu và kết thúc.
+
+    Mỗi dòng là thông tin của một job (file kết quả, manifest, provider, model, số phần xong/lỗi);
+    dòng sau của cùng file kết quả được gộp đè lên dòng trước. Khi chưa có file index (các job chạy
+    trước khi có index), jobs() quét thư mục chứa index một lần, chỉ đọc dòng đầu của từng manifest,
+    rồi ghi kết quả quét thành index.
+    """
+
+    lock = threading.Lock() # Dùng chung cho mọi job của batch ghi vào cùng một index
+
+    def __init__(self, path=None):
+        self.path = path or RESULTS_INDEX_FILE
+
+    def add(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if not os.path.exists(self.path):
+                self._rebuild() # Job đầu tiên sau khi có index: giữ lại các job cũ trong thư mục
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def jobs(self):
+        """Các job, mới nhất trước, mỗi file kết quả một entry."""
+        with self.lock:
+            if not os.path.exists(self.path):
+                self._rebuild()
+        entries = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        result_file = entry["result_file"]
+                    except (ValueError, KeyError):
+                        continue
+                    entries[result_file] = dict(entries.get(result_file, {}), **entry)
+        except OSError:
+            return []
+        return sorted(entries.values(), key=lambda entry: entry.get("created", ""), reverse=True)
+
+    def _rebuild(self):
+        """Tạo index từ các file kết quả/manifest trong thư mục; gọi khi đang giữ self.lock."""
+        root = os.path.dirname(self.path)
+        if not os.path.isdir(root):
+            return
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")] # Bỏ qua .cache
+            for name in filenames:
+                if not name.startswith("gemini_result_") or not name.endswith(".txt") or name.endswith("_no_summary.txt"):
+                    continue
+                result_file = os.path.join(dirpath, name)
+                try: # Thời điểm tạo job nằm trong tên file: gemini_result_<Y-m-d-H-M-S>_<model>.txt
+                    created = datetime.strptime(name[len("gemini_result_"):][:19], "%Y-%m-%d-%H-%M-%S")
+                except ValueError:
+                    created = datetime.fromtimestamp(os.path.getmtime(result_file))
+                entry = {"result_file": result_file, "created": created.isoformat(timespec="seconds")}
+                manifest_path = JobManifest.path_for(result_file)
+                try:
+                    with open(manifest_path, 'r', encoding='utf-8') as f:
+                        header = json.loads(f.readline())
+                    entry.update(manifest=manifest_path, created=header.get("created", entry["created"]),
+                                 provider=header.get("provider"), model=header.get("model"),
+                                 total_parts=header.get("total_parts"))
+                except (OSError, ValueError):
+                    pass # File kết quả cũ không có manifest
+                entries.append(entry)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class ClientPool:
+    """Cache client theo (provider, base_url, key), dùng chung cho mọi luồng trong job.
+
+    Mỗi client giữ pool kết nối keep-alive riêng nên các request sau cùng key
+    không phải tạo kết nối và bắt tay TLS lại. Google dùng genai.Client riêng cho
+    từng key thay vì genai.configure toàn cục, nên nhiều key Gemini chạy song song được.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get_client(self, provider, api_key):
+        if provider == "Google":
+            return self.get_google_client(api_key)
+        return self.get_openai_client(provider, api_key)
+
+    def get_google_client(self, api_key):
+        base_url = PROVIDER_CONFIG["Google"].get("base_url") # None = endpoint mặc định của Gemini API
+        cache_key = ("Google", base_url, api_key)
+        with self.lock:
+            client = self.clients.get(cache_key)
+            if client is None:
+                # Timeout đọc của httpx: không nhận thêm byte nào trong khoảng này thì request bị hủy
+                read_timeout = STREAM_FIRST_TOKEN_TIMEOUT_SECONDS if PROVIDER_CONFIG["Google"].get("stream", True) else API_TIMEOUT_SECONDS
+                client = genai.Client(api_key=api_key, http_options=genai_types.HttpOptions(
+                    base_url=base_url,
+                    timeout=int(read_timeout * 1000),
+                    client_args={"event_hooks": {"response": [attach_response_to_call]}}
+                ))
+                self.clients[cache_key] = client
+            return client
+
+    def get_openai_client(self, provider, api_key):
+        provider_config = PROVIDER_CONFIG.get(provider, {})
+        base_url = provider_config.get("base_url")
+        if not base_url and provider == "MegaLLM":
+            base_url = MEGALLM_BASE_URL
+        cache_key = (provider, base_url, api_key)
+        with self.lock:
+            client = self.clients.get(cache_key)
+            if client is None:
+                http_client = DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=MAX_CONCURRENCY * 2,
+                        max_keepalive_connections=MAX_CONCURRENCY,
+                        keepalive_expiry=CLIENT_KEEPALIVE_SECONDS
+                    ),
+                    event_hooks={"response": [attach_response_to_call]}
+                )
+                client = OpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    default_headers=provider_config.get("headers"),
+                    http_client=http_client,
+                    timeout=Timeout(API_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+                    max_retries=0 # Retry, đổi key và fallback do engine quyết định
+                )
+                self.clients[cache_key] = client
+            return client
+
+    def close(self):
+        """Đóng toàn bộ kết nối khi job kết thúc."""
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                print(f"Không thể đóng client: {e}")
+
+
+class KeyScheduler:
+    """Chọn API key theo token bucket riêng của từng key.
+
+    Mỗi key có 2 bucket: số request/phút (rpm) và số token/phút (tpm), lấy từ
+    "rate_limit" trong PROVIDER_CONFIG (None = không giới hạn). Key bị 429 được
+    cho nghỉ theo Retry-After; acquire() luôn trả về key còn nhiều dư địa nhất.
+    """
+
+    def __init__(self, api_keys, rate_limit=None):
+        rate_limit = rate_limit or {}
+        self.rpm = rate_limit.get("rpm") or 0
+        self.tpm = rate_limit.get("tpm") or 0
+        now = time.monotonic()
+        self.slots = [{
+            "key": key,
+            "requests": float(self.rpm),
+            "tokens": float(self.tpm),
+            "updated": now,
+            "cooldown_until": 0.0,
+            "last_used": 0.0,
+            "calls": 0,
+            "throttled": 0
+        } for key in api_keys]
+        self.lock = threading.Lock()
+
+    def _refill(self, slot, now):
+        elapsed = now - slot["updated"]
+        slot["updated"] = now
+        if self.rpm:
+            slot["requests"] = min(self.rpm, slot["requests"] + elapsed * self.rpm / 60)
+        if self.tpm:
+            slot["tokens"] = min(self.tpm, slot["tokens"] + elapsed * self.tpm / 60)
+
+    def _wait_time(self, slot, tokens, now):
+        """Số giây đến khi key đủ chỗ cho request này (0 = dùng được ngay)."""
+        waits = [slot["cooldown_until"] - now]
+        if self.rpm:
+            waits.append((1 - slot["requests"]) * 60 / self.rpm)
+        if self.tpm:
+            # Request lớn hơn cả bucket thì chỉ cần bucket đầy
+            needed = min(tokens, self.tpm)
+            waits.append((needed - slot["tokens"]) * 60 / self.tpm)
+        return max(0.0, max(waits))
+
+    def _headroom(self, slot, tokens):
+        ratios = [1.0]
+        if self.rpm:
+            ratios.append((slot["requests"] - 1) / self.rpm)
+        if self.tpm:
+            ratios.append((slot["tokens"] - tokens) / self.tpm)
+        return min(ratios)
+
+    def acquire(self, tokens=0, should_stop=None, avoid=None):
+        """Chờ tới khi có key dùng được, trả về (vị trí key, key) hoặc (None, None) nếu bị dừng.
+
+        avoid: vị trí key không nên dùng nếu còn key khác dùng được ngay (request hedging).
+        """
+        if not self.slots:
+            return 0, None
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                ready = []
+                next_wait = None
+                for index, slot in enumerate(self.slots):
+                    self._refill(slot, now)
+                    wait = self._wait_time(slot, tokens, now)
+                    if wait <= 0:
+                        ready.append(index)
+                    elif next_wait is None or wait < next_wait:
+                        next_wait = wait
+                if avoid is not None and len(ready) > 1 and avoid in ready:
+                    ready.remove(avoid)
+                if ready:
+                    # Nhiều dư địa nhất trước, hòa thì key lâu chưa dùng nhất (round robin)
+                    index = max(ready, key=lambda idx: (self._headroom(self.slots[idx], tokens),
+                                                        -self.slots[idx]["last_used"]))
+                    slot = self.slots[index]
+                    if self.rpm:
+                        slot["requests"] -= 1
+                    if self.tpm:
+                        slot["tokens"] -= tokens
+                    slot["last_used"] = now
+                    slot["calls"] += 1
+                    return index, slot["key"]
+            if should_stop and should_stop():
+                return None, None
+            time.sleep(min(next_wait, 0.5))
+
+    def report_rate_limited(self, index, retry_after=None):
+        """Cho key nghỉ sau khi nhận 429."""
+        with self.lock:
+            slot = self.slots[index]
+            cooldown = retry_after if retry_after is not None else RATE_LIMIT_DEFAULT_COOLDOWN
+            slot["cooldown_until"] = max(slot["cooldown_until"], time.monotonic() + cooldown)
+            slot["requests"] = min(slot["requests"], 0.0)
+            slot["throttled"] += 1
+
+    def is_cooling_down(self, index):
+        with self.lock:
+            return self.slots[index]["cooldown_until"] > time.monotonic()
+
+    def summary(self):
+        with self.lock:
+            calls = sum(slot["calls"] for slot in self.slots)
+            throttled = sum(slot["throttled"] for slot in self.slots)
+            busiest = max((slot["calls"] for slot in self.slots), default=0)
+        return (f"API KEY: {len(self.slots)} key, {calls} lượt gọi "
+                f"(nhiều nhất {busiest}/key), {throttled} lần bị giới hạn 429.")
+
+
+class LatencyTracker:
+    """Lịch sử thời gian gọi API theo (provider, model), lưu giữa các lần chạy trong file JSON.
+
+    Mỗi mẫu là [giây cả request, số token prompt, TTFT, khoảng lặng dài nhất khi stream].
+    Thời gian cả request được quy về giây/token prompt để dùng cho phần dài ngắn khác nhau.
+    Từ lịch sử tính ngưỡng gửi request hedging và timeout riêng cho từng model.
+    """
+
+    def __init__(self, path=None, history_size=LATENCY_HISTORY_SIZE):
+        self.path = path # None = chỉ giữ trong bộ nhớ
+        self.history_size = history_size
+        self.samples = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Đọc lịch sử từ path; file chưa có hoặc hỏng thì bắt đầu lịch sử mới."""
+        tracker = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for provider, models in data.items():
+                for model_name, samples in models.items():
+                    tracker.samples[(provider, model_name)] = [list(sample) for sample in samples][-tracker.history_size:]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            print(f"Bỏ qua lịch sử thời gian gọi API lỗi {path}: {e}")
+        return tracker
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        with self.lock:
+            data = {}
+            for (provider, model_name), samples in self.samples.items():
+                data.setdefault(provider, {})[model_name] = samples
+            self.changed = False
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = self.path + ".tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"Không thể lưu lịch sử thời gian gọi API: {e}")
+
+    def record(self, provider, model_name, seconds, prompt_tokens, ttft=None, max_gap=None):
+        with self.lock:
+            samples = self.samples.setdefault((provider, model_name), [])
+            samples.append([round(seconds, 3), prompt_tokens,
+                            None if ttft is None else round(ttft, 3),
+                            None if max_gap is None else round(max_gap, 3)])
+            del samples[:-self.history_size]
+            self.changed = True
+
+    def _values(self, provider, model_name, column, prompt_tokens=None):
+        """Các giá trị của một cột đã sắp xếp, None khi chưa đủ LATENCY_MIN_SAMPLES mẫu.
+
+        prompt_tokens: quy cột thời gian cả request về độ dài prompt này.
+        """
+        with self.lock:
+            samples = list(self.samples.get((provider, model_name), []))
+        if prompt_tokens is None:
+            values = [sample[column] for sample in samples if sample[column] is not None]
+        else:
+            values = [sample[column] / max(1, sample[1]) * prompt_tokens for sample in samples]
+        if len(values) < LATENCY_MIN_SAMPLES:
+            return None
+        return sorted(values)
+
+    @staticmethod
+    def _at(values, percent):
+        return values[int(percent / 100 * (len(values) - 1))]
+
+    def percentile(self, provider, model_name, percent, prompt_tokens):
+        """Thời gian dự kiến ở percentile percent (0-100) cho prompt dài prompt_tokens token,
+        None khi chưa đủ mẫu."""
+        values = self._values(provider, model_name, 0, prompt_tokens)
+        return None if values is None else self._at(values, percent)
+
+    def timeouts(self, provider, model_name, prompt_tokens):
+        """(chờ token đầu, khoảng lặng khi stream, cả request) cho lần gọi tiếp theo.
+
+        Mỗi giá trị là TIMEOUT_SAFETY_FACTOR x p99 của lịch sử, tối thiểu ADAPTIVE_TIMEOUT_MIN_SECONDS
+        và không vượt hằng số timeout cố định; chưa đủ mẫu thì dùng hằng số cố định.
+        """
+        limits = []
+        for column, scale, upper in ((2, None, STREAM_FIRST_TOKEN_TIMEOUT_SECONDS),
+                                     (3, None, STREAM_IDLE_TIMEOUT_SECONDS),
+                                     (0, prompt_tokens, API_TIMEOUT_SECONDS)):
+            values = self._values(provider, model_name, column, scale)
+            if values is None:
+                limits.append(upper)
+            else:
+                limits.append(min(upper, max(ADAPTIVE_TIMEOUT_MIN_SECONDS, TIMEOUT_SAFETY_FACTOR * self._at(values, 99))))
+        return tuple(limits)
+
+
+class JobMetrics:
+    """Thống kê trực tiếp của job để chỉnh số luồng và số key: theo từng (provider, model, key)
+    số request đang chạy, thành công, lỗi, p50/p95 thời gian gọi, token vào/ra mỗi giây
+    (theo usage của response, không có thì ước lượng), lượt trúng cache, và thời gian còn lại
+    theo tốc độ của METRICS_ETA_WINDOW phần xong gần nhất.
+
+    Các luồng gọi API ghi vào, giao diện đọc snapshot(); batch dùng chung một JobMetrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.rows = {}
+        self.total_parts = 0
+        self.finished_parts = 0
+        self.part_times = collections.deque(maxlen=METRICS_ETA_WINDOW)
+
+    def _row(self, provider, model_name, key_slot):
+        row = self.rows.get((provider, model_name, key_slot))
+        if row is None:
+            row = self.rows[(provider, model_name, key_slot)] = {
+                "in_flight": 0, "success": 0, "failure": 0, "cache_hits": 0,
+                "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+                "latencies": collections.deque(maxlen=METRICS_LATENCY_SAMPLES)
+            }
+        return row
+
+    def call_started(self, provider, model_name, key_slot):
+        with self.lock:
+            self._row(provider, model_name, key_slot)["in_flight"] += 1
+
+    def call_finished(self, provider, model_name, key_slot, seconds, ok, input_tokens, output_tokens, cached_tokens=0):
+        with self.lock:
+            row = self._row(provider, model_name, key_slot)
+            row["in_flight"] -= 1
+            row["success" if ok else "failure"] += 1
+            row["input_tokens"] += input_tokens
+            row["output_tokens"] += output_tokens
+            row["cached_tokens"] += cached_tokens
+            if ok:
+                row["latencies"].append(seconds)
+
+    def cache_hit(self, provider, model_name):
+        with self.lock:
+            self._row(provider, model_name, None)["cache_hits"] += 1
+
+    def add_parts(self, count):
+        """Thêm số phần cần gọi API (không tính phần đã xong từ lần chạy trước)."""
+        with self.lock:
+            self.total_parts += count
+
+    def part_finished(self):
+        with self.lock:
+            self.finished_parts += 1
+            self.part_times.append(time.monotonic())
+
+    def eta(self):
+        """Số giây ước tính còn lại, None khi chưa đủ 2 phần xong để tính tốc độ."""
+        with self.lock:
+            remaining = self.total_parts - self.finished_parts
+            times = list(self.part_times)
+        if remaining <= 0:
+            return 0.0
+        if len(times) < 2 or times[-1] <= times[0]:
+            return None
+        return remaining * (times[-1] - times[0]) / (len(times) - 1)
+
+    def snapshot(self):
+        """Các dòng thống kê đã tính sẵn (dict), sắp theo provider, model, key."""
+        with self.lock:
+            elapsed = max(1e-9, time.monotonic() - self.started)
+            rows = []
+            for (provider, model_name, key_slot), row in self.rows.items():
+                latencies = sorted(row["latencies"])
+                rows.append({
+                    "provider": provider, "model": model_name,
+                    "key": "cache" if key_slot is None else f"Key {key_slot + 1}",
+                    "in_flight": row["in_flight"], "success": row["success"], "failure": row["failure"],
+                    "cache_hits": row["cache_hits"],
+                    "p50": latencies[int(0.5 * (len(latencies) - 1))] if latencies else None,
+                    "p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+                    "input_tps": row["input_tokens"] / elapsed,
+                    "output_tps": row["output_tokens"] / elapsed,
+                    "cached_share": row["cached_tokens"] / row["input_tokens"] if row["input_tokens"] else 0.0
+                })
+        rows.sort(key=lambda row: (row["provider"], row["model"], row["key"] == "cache", row["key"]))
+        return rows
+
+    def format_progress(self):
+        """Một dòng tóm tắt: số phần xong, tốc độ token ra, thời gian còn lại."""
+        rows = self.snapshot()
+        eta = self.eta()
+        with self.lock:
+            finished, total = self.finished_parts, self.total_parts
+        output_tps = sum(row["output_tps"] for row in rows)
+        eta_text = "đang tính" if eta is None else time.strftime("%H:%M:%S", time.gmtime(eta))
+        return f"{finished}/{total} phần, {output_tps:.0f} token ra/giây, còn lại khoảng {eta_text}"
+
+    def format_table(self):
+        """Bảng thống kê dạng text cho ô trạng thái cuối job và CLI."""
+        lines = ["Thống kê gọi API (p50/p95 giây, token vào/ra mỗi giây, tỉ lệ token vào lấy từ cache prefix):"]
+        for row in self.snapshot():
+            if row["key"] == "cache":
+                lines.append(f"  {row['model']} [cache]: {row['cache_hits']} lượt trúng cache")
+                continue
+            latency = "-" if row["p50"] is None else f"{row['p50']:.1f}/{row['p95']:.1f}"
+            lines.append(f"  {row['model']} [{row['key']}]: {row['success']} thành công, {row['failure']} lỗi, "
+                         f"{latency}s, {row['input_tps']:.0f}/{row['output_tps']:.0f} token/s"
+                         + (f", cache prefix {row['cached_share']:.0%}" if row["cached_share"] else ""))
+        return "\n".join(lines)
+
+
+class JobTrace:
+    """Trace của một job dạng JSONL, mỗi dòng là một span đã kết thúc:
+    {"name", "part", "start" (epoch giây), "dur" (giây), "thread", ...thuộc tính}.
+
+    Các span: split, build_prompt, cache_lookup, key_wait, api_call (role primary/fallback/hedge),
+    parse (extract_translation_and_summary) và write, để biết thời gian của job nằm ở đâu.
+    export_chrome_trace() chuyển file sang định dạng mở được bằng chrome://tracing hoặc Perfetto.
+    """
+
+    def __init__(self, path=None):
+        self.path = path # None = không ghi trace
+        self.handle = None
+        self.lock = threading.Lock()
+
+    def record(self, name, start, duration, part=None, **attrs):
+        if self.path is None:
+            return
+        span = {"name": name, "part": part, "start": round(start, 6), "dur": round(duration, 6),
+                "thread": threading.current_thread().name}
+        span.update(attrs)
+        line = json.dumps(span, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.path is None:
+                return
+            try:
+                if self.handle is None:
+                    self.handle = open(self.path, 'a', encoding='utf-8')
+                self.handle.write(line)
+            except OSError as e:
+                print(f"Không thể ghi trace {self.path}: {e}")
+                self.path = None
+
+    @contextlib.contextmanager
+    def span(self, name, part=None, **attrs):
+        """Đo khối lệnh bên trong; thuộc tính thêm vào dict nhận được sẽ được ghi cùng span."""
+        start = time.time()
+        began = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            self.record(name, start, time.perf_counter() - began, part, **attrs)
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+
+def export_chrome_trace(trace_path, output_path=None):
+    """Chuyển trace JSONL của JobTrace sang Trace Event Format (JSON) cho chrome://tracing / Perfetto.
+
+    Mỗi luồng là một hàng, tham số của span nằm trong args. Trả về đường dẫn file đã ghi
+    (mặc định cùng tên, đuôi .json).
+    """
+    if output_path is None:
+        output_path = trace_path[:-len(".jsonl")] + ".json" if trace_path.endswith(".jsonl") else trace_path + ".json"
+    events = []
+    thread_ids = {}
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+                name, start, duration = span.pop("name"), span.pop("start"), span.pop("dur")
+            except (ValueError, KeyError):
+                continue # Dòng cuối dở dang khi job bị tắt ngang
+            thread = span.pop("thread", "")
+            if thread not in thread_ids:
+                thread_ids[thread] = len(thread_ids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": thread_ids[thread],
+                               "args": {"name": thread}})
+            events.append({"name": name, "cat": "job", "ph": "X", "pid": 1, "tid": thread_ids[thread],
+                           "ts": round(start * 1e6), "dur": round(duration * 1e6), "args": span})
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    return output_path
+
+class ResultExporter:
+    """Xuất file kết quả (.txt) sang PDF hoặc Word, không dùng Tk nên chạy được ở luồng nền.
+
+    File nguồn được đọc từng dòng; PDF được dàn trang trực tiếp lên canvas, mỗi trang đầy thì
+    showPage() ngay nên chỉ giữ các Paragraph của trang đang dàn. python-docx vẫn giữ cả tài liệu
+    trong bộ nhớ tới lúc save(), nhưng không còn bản sao toàn bộ văn bản gốc.
+    on_progress(số byte đã đọc, tổng số byte) được gọi mỗi EXPORT_PROGRESS_LINES dòng.
+    """
+
+    def __init__(self, source_path, output_path, on_progress=None):
+        self.source_path = source_path
+        self.output_path = output_path
+        self.on_progress = on_progress or (lambda done, total: None)
+        self.total_bytes = os.path.getsize(source_path)
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def iter_lines(self):
+        done = 0
+        with open(self.source_path, 'rb') as f:
+            for count, raw in enumerate(f, 1):
+                if self.cancelled.is_set():
+                    return
+                done += len(raw)
+                if count % EXPORT_PROGRESS_LINES == 0:
+                    self.on_progress(done, self.total_bytes)
+                yield raw.decode('utf-8', errors='replace').rstrip('\r\n')
+        self.on_progress(done, self.total_bytes)
+
+    def export(self):
+        """Ghi output_path theo đuôi file (.docx là Word, còn lại là PDF).
+
+        Trả về False nếu bị hủy giữa chừng; file dở (kể cả khi lỗi) bị xóa.
+        """
+        try:
+            if self.output_path.lower().endswith(".docx"):
+                self._export_docx()
+            else:
+                self._export_pdf()
+            if not self.cancelled.is_set():
+                return True
+        except BaseException:
+            self._remove_output()
+            raise
+        self._remove_output()
+        return False
+
+    def _remove_output(self):
+        try:
+            os.remove(self.output_path)
+        except OSError:
+            pass
+
+    def _export_docx(self):
+        from docx import Document
+        doc = Document()
+        for line in self.iter_lines():
+            doc.add_paragraph(line)
+        if not self.cancelled.is_set():
+            doc.save(self.output_path)
+
+    def _export_pdf(self):
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.pdfgen.canvas import Canvas
+        from reportlab.platypus import Frame, Paragraph, Spacer
+        from xml.sax.saxutils import escape
+
+        styles = getSampleStyleSheet()
+        title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=16,
+                                     textColor='black', spaceAfter=12, alignment=1)
+        body_style = ParagraphStyle('CustomBody', parent=styles['BodyText'], fontSize=11,
+                                    leading=14, spaceAfter=6)
+        width, height = letter
+        canvas = Canvas(self.output_path, pagesize=letter)
+
+        def new_frame():
+            # Cùng lề 1 inch như SimpleDocTemplate
+            return Frame(inch, inch, width - 2 * inch, height - 2 * inch)
+
+        frame = new_frame()
+        page_empty = True
+        pending = collections.deque([Paragraph("Gemini Processing Results", title_style), Spacer(1, 0.3 * inch)])
+        lines = self.iter_lines()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < EXPORT_PDF_BATCH:
+                line = next(lines, None)
+                if line is None:
+                    exhausted = True
+                elif line.strip():
+                    # Dòng kết quả là văn bản thường, không phải markup của Paragraph
+                    pending.append(Paragraph(escape(line), body_style))
+                else:
+                    pending.append(Spacer(1, 0.1 * inch))
+            if not pending or self.cancelled.is_set():
+                break
+            flowable = pending[0]
+            if frame.add(flowable, canvas, trySplit=1):
+                pending.popleft()
+                page_empty = False
+                continue
+            parts = frame.split(flowable, canvas)
+            if parts:
+                pending.popleft()
+                pending.extendleft(reversed(parts))
+                continue
+            if page_empty:
+                pending.popleft() # Không vừa cả một trang trống và không chia được: bỏ qua để không lặp mãi
+                continue
+            canvas.showPage()
+            frame = new_frame()
+            page_empty = True
+        if not self.cancelled.is_set():
+            canvas.save()
+
+
+def run_in_daemon_thread(fn, *args):
+    """Chạy fn(*args) ở một luồng daemon, trả về Future.
+
+    Khác ThreadPoolExecutor: bỏ rơi future khi timeout hoặc bấm dừng không phải chờ luồng kết thúc,
+    và luồng còn treo không giữ tiến trình lại khi thoát.
+    """
+    future = concurrent.futures.Future()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
         try:
-            results_dir = os.path.join(os.path.expanduser("~"), "Downloads",
-                                     "gemini_results")
-            if not os.path.exists(results_dir):
-                messagebox.showinfo("Thông tin", "Thư mục 'gemini_results' trong Downloads không tồn tại. Chưa có kết quả nào được lưu.")
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def iter_ordered_results(items, worker, max_workers, should_stop=None):
+    """Chạy worker(index, item) song song, trả về (index, kết quả) theo đúng thứ tự.
+
+    Chỉ giữ tối đa 2 * max_workers phần đang chạy hoặc đã xong nhưng chưa tới lượt,
+    nên bộ nhớ không tăng theo số phần. Khi should_stop() trả về True, các phần đã
+    xong liền mạch theo thứ tự vẫn được trả về trước khi dừng để không mất kết quả.
+    """
+    should_stop = should_stop or (lambda: False)
+    window = max(1, max_workers) * 2
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers))
+    pending = {}
+    iterator = enumerate(items, 1)
+    exhausted = False
+    next_index = 1
+    try:
+        while True:
+            while not exhausted and len(pending) < window and not should_stop():
+                try:
+                    index, item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[index] = executor.submit(worker, index, item)
+            if not pending:
                 return
+            if should_stop():
+                while next_index in pending and pending[next_index].done():
+                    yield next_index, pending.pop(next_index).result()
+                    next_index += 1
+                return
+            try:
+                result = pending[next_index].result(timeout=0.2)
+            except concurrent.futures.TimeoutError:
+                continue
+            del pending[next_index]
+            yield next_index, result
+            next_index += 1
+    finally:
+        for future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def load_api_keys(path):
+    """Đọc file API key: mỗi dòng một key, bỏ qua dòng trống và dòng bắt đầu bằng #."""
+    keys = []
+    with open(path, 'r') as f:
+        for line in f:
+            stripped_line = line.strip()
+            if stripped_line and not stripped_line.startswith('#'):
+                keys.append(stripped_line)
+    return keys
+
+
+class JobConfig:
+    """Thiết lập của một job, không phụ thuộc giao diện (GUI đọc từ widget, CLI đọc từ tham số)."""
+
+    def __init__(self, text, prompt, api_keys, provider=DEFAULT_PROVIDER, model=None,
+                 language="中文", split_method=SPLIT_BY_CHAPTER, split_length=10000,
+                 context_mode=MODE_WITH_CONTEXT, initial_summary="", two_phase=False,
+                 concurrency=DEFAULT_CONCURRENCY, use_cache=True, results_dir=RESULTS_DIR,
+                 resume_manifest=None, hedge_percentile=0, token_calibration=None, batch_mode=False):
+        self.text = text # Chuỗi văn bản, hoặc InputFile khi đọc thẳng từ file
+        self.prompt = prompt
+        self.api_keys = list(api_keys)
+        self.provider = provider
+        self.model = model or PROVIDER_DEFAULT_MODELS.get(provider)
+        self.language = language
+        self.split_method = split_method
+        self.split_length = split_length
+        self.context_mode = context_mode
+        self.initial_summary = initial_summary
+        self.two_phase = two_phase
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.results_dir = results_dir
+        self.resume_manifest = resume_manifest # JobManifest khi tiếp tục job cũ
+        # Gửi thêm request dự phòng khi request chính chậm hơn percentile này của các lần trước (0 = tắt)
+        self.hedge_percentile = hedge_percentile
+        # Hệ số nhân cho estimate_tokens khi chia "Theo token" (None = đo lại bằng API đếm token)
+        self.token_calibration = token_calibration
+        # Gửi cả job qua Batch API bất đồng bộ của provider (rẻ hơn, kết quả về chậm), chỉ chế độ không context
+        self.batch_mode = batch_mode
+
+    @property
+    def use_context(self):
+        return self.context_mode == MODE_WITH_CONTEXT
+
+    @classmethod
+    def from_manifest(cls, manifest, text, api_keys, **overrides):
+        """Dựng lại thiết lập từ header của manifest để chia văn bản ra đúng các phần cũ."""
+        header = manifest.header
+        settings = dict(
+            provider=header["provider"],
+            model=header["model"],
+            language=header["language"],
+            split_method=header["split_method"],
+            split_length=int(header["split_length"]),
+            context_mode=header["context_mode"],
+            initial_summary=header.get("initial_summary", ""),
+            two_phase=header.get("two_phase", False),
+            token_calibration=header.get("token_calibration"),
+            batch_mode=header.get("batch_mode", False),
+            results_dir=os.path.dirname(header["result_file"]),
+            resume_manifest=manifest
+        )
+        settings.update(overrides)
+        return cls(text, header["prompt"], api_keys, **settings)
+
+    def validate(self, require_text=True):
+        errors = []
+        if not self.api_keys:
+            errors.append("API Key chưa được tải. Vui lòng chọn file API Key.")
+        if not self.prompt:
+            errors.append("Prompt không được để trống")
+        if require_text and not self.text:
+            errors.append("Văn bản cần xử lý không được để trống")
+        if self.provider not in PROVIDER_CONFIG:
+            errors.append(f"Provider {self.provider} chưa được cấu hình.")
+        if self.split_method not in SPLIT_METHODS:
+            errors.append("Phương thức chia văn bản không hợp lệ")
+        elif self.split_method == SPLIT_BY_CHARS and self.split_length <= 0:
+            errors.append("Số ký tự/số từ mỗi phần phải lớn hơn 0")
+        elif self.split_method == SPLIT_BY_TOKENS and self.split_length < 0:
+            errors.append("Số token mỗi phần không được âm (0 = tự tính theo model)")
+        if not 1 <= self.concurrency <= MAX_CONCURRENCY:
+            errors.append(f"Số luồng song song phải từ 1 đến {MAX_CONCURRENCY}")
+        if self.hedge_percentile and not 50 <= self.hedge_percentile < 100:
+            errors.append("Percentile hedging phải từ 50 đến dưới 100 (0 = tắt)")
+        if self.batch_mode:
+            if self.use_context:
+                errors.append("Batch API chỉ dùng cho chế độ không context (Without previous context).")
+            elif not PROVIDER_CONFIG.get(self.provider, {}).get("batch_api"):
+                errors.append(f"Provider {self.provider} không hỗ trợ Batch API.")
+        return errors
+
+
+class EngineReporter:
+    """Nơi TranslationEngine báo tiến trình. Mặc định in ra console (dùng cho CLI);
+    giao diện Tk dùng TkReporter để đưa thông báo vào các ô text."""
+
+    def __init__(self):
+        self.last_completion = ""
+
+    def progress(self, text, clear=False):
+        text = text.strip()
+        if text:
+            print(text)
+
+    def result(self, text, clear=False):
+        pass # Bản dịch đã được ghi vào file kết quả, không in lại ra console
 
-            files = [f for f in os.listdir(results_dir) if f.startswith("gemini_result_") and f.endswith(".txt")]
-            if not files:
-                 messagebox.showinfo("Thông tin", "Không tìm thấy file kết quả nào trong thư mục 'gemini_results'.")
-                 return
+    def completion(self, text):
+        self.last_completion = text
 
-            # Tìm file mới nhất dựa trên tên (timestamp) thay vì ctime
-            # Điều này đáng tin cậy hơn nếu file bị copy/move
-            files.sort(reverse=True) # Sắp xếp giảm dần theo tên (timestamp)
-            latest_file = files[0]
-            latest_file_path = os.path.join(results_dir, latest_file)
+    def set_progress(self, value, maximum=None):
+        pass
 
-            with open(latest_file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+    def summary_updated(self, summary):
+        pass
 
-            # Hiển thị nội dung file lên ô result_text thay vì completion_text
-            self.result_text.delete("1.0", tk.END)
-            self.result_text.insert(tk.END, content)
-            self.result_text.see("1.0") # Cuộn lên đầu
-            self.completion_text.delete("1.0", tk.END)
-            self.completion_text.insert(tk.END, f"Đã tải nội dung từ file:\n{latest_file_path}")
+    def error(self, message):
+        print(f"Lỗi: {message}", file=sys.stderr)
 
+
+class UiUpdateQueue:
+    """Hàng đợi cập nhật giao diện từ các luồng xử lý, gộp lại theo từng ô cho mỗi chu kỳ check_queue.
+
+    put((widget, text, clear)): các text cùng ô được nối lại, clear=True bỏ hết text đang chờ
+    của ô đó, nên mỗi chu kỳ chỉ có một lần insert/see() cho mỗi ô.
+    Text chờ của mỗi ô không quá UI_PENDING_MAX_CHARS (giữ phần cuối), nên bộ nhớ không tăng
+    dù nhiều luồng gửi liên tục. set_state(key, func) cho trạng thái chỉ cần giá trị mới nhất
+    (progress bar, tóm tắt): trong một chu kỳ chỉ func cuối cùng của mỗi key được chạy.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {} # widget -> [clear, [text...], số ký tự]
+        self.states = {}
+
+    def put(self, message):
+        widget, text, clear = message
+        with self.lock:
+            entry = self.pending.get(widget)
+            if entry is None or clear:
+                entry = self.pending[widget] = [clear, [], 0]
+            entry[1].append(text)
+            entry[2] += len(text)
+            if entry[2] > 2 * UI_PENDING_MAX_CHARS: # Cắt theo đợt để không nối chuỗi ở mỗi lần put
+                entry[:] = self._tail(entry)
+
+    def set_state(self, key, func):
+        with self.lock:
+            self.states[key] = func
+
+    @staticmethod
+    def _tail(entry):
+        """Chỉ giữ UI_PENDING_MAX_CHARS ký tự cuối; phần đầu đằng nào cũng bị đẩy khỏi ô log nên xóa cả ô cũ."""
+        if entry[2] <= UI_PENDING_MAX_CHARS:
+            return entry
+        tail = "".join(entry[1])[-UI_PENDING_MAX_CHARS:]
+        return [True, [tail], len(tail)]
+
+    def drain(self):
+        """Lấy ra mọi cập nhật đang chờ: ([(widget, clear, text)], [func])."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            states, self.states = self.states, {}
+        updates = []
+        for widget, entry in pending.items():
+            clear, texts, _ = self._tail(entry)
+            updates.append((widget, clear, "".join(texts)))
+        return updates, list(states.values())
+
+
+class TkReporter(EngineReporter):
+    """Chuyển thông báo của engine vào queue, check_queue cập nhật widget trên luồng chính."""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def progress(self, text, clear=False):
+        self.app.queue.put((self.app.progress_text, text, clear))
+
+    def result(self, text, clear=False):
+        self.app.queue.put((self.app.result_text, text, clear))
+
+    def completion(self, text):
+        super().completion(text)
+        self.app.queue.put((self.app.completion_text, text, True))
+
+    def set_progress(self, value, maximum=None):
+        progress_bar = self.app.progress_bar
+        if maximum is not None:
+            self.app.queue.set_state("progress_maximum", lambda: progress_bar.configure(maximum=maximum))
+        self.app.queue.set_state("progress_value", lambda: progress_bar.configure(value=value))
+
+    def summary_updated(self, summary):
+        def show_summary():
+            self.app.prev_summary_text.delete("1.0", tk.END)
+            self.app.prev_summary_text.insert("1.0", summary)
+        self.app.queue.set_state("summary", show_summary)
+
+    def error(self, message):
+        self.app.show_error(message)
+
+
+class TranslationEngine:
+    """Chia văn bản, gọi API và ghi file kết quả cho một job.
+
+    Không dùng tkinter: giao diện và CLI cùng chạy job qua run(), khác nhau ở reporter.
+    Khi chạy hàng loạt, các engine dùng chung một SharedResources (scheduler, client, cache).
+    """
+
+    def __init__(self, reporter=None, shared=None):
+        self.reporter = reporter or EngineReporter()
+        self.shared = shared
+        self.should_stop = False
+        self.config = None
+        self.active_calls = set() # CallProgress của các lần gọi API đang chờ, hủy ngay khi stop()
+        self.active_calls_lock = threading.Lock()
+        self.key_scheduler = KeyScheduler([]) # Tạo lại cho mỗi job theo rate_limit của provider
+        self.client_pool = ClientPool() # Client dùng lại suốt job, đóng khi job kết thúc
+        self.response_cache = None # ResponseCache khi bật cache kết quả
+        self.latency = LatencyTracker() # Thay bằng lịch sử đọc từ LATENCY_FILE khi chạy job
+        self.metrics = shared.metrics if shared is not None else JobMetrics()
+        self.trace = JobTrace() # Ghi vào <file kết quả>.trace.jsonl khi chạy job
+        self.hedge_stats = {"sent": 0, "won": 0, "wasted_tokens": 0}
+        self.hedge_stats_lock = threading.Lock()
+        self.context_caches = {} # (model, key) -> cached content Gemini chứa phần prompt chung, xóa khi job kết thúc
+        self.split_chars_per_token = None # Số ký tự/token ước tính khi chia "Theo token" của job đang chạy
+        self.context_caches_lock = threading.Lock()
+
+    def stop(self):
+        self.should_stop = True
+        with self.active_calls_lock:
+            calls = list(self.active_calls)
+        for progress in calls:
+            progress.cancel()
+
+    def build_prompt_prefix(self):
+        """Phần đầu giống hệt nhau ở mọi prompt dịch của job: prompt người dùng và (khi có context)
+        yêu cầu định dạng. Đặt trước phần thay đổi theo từng phần để provider cache được."""
+        prompt_parts = [self.config.prompt]
+        if self.config.use_context:
+            prompt_parts.append("\nYêu cầu:\n1. Trả về bản dịch tiếng Việt của chương trong phần \"Nội dung cần dịch\", không dùng Markdown.\n2. Trả về tóm tắt nội dung chương vừa dịch, tối đa 350 từ, giữ nguyên đại từ nhân xưng được sử dụng trong văn bản dịch. Tuyệt đối không ghép đại từ trước tên riêng (ví dụ: chỉ viết 'Yến Dịch', không được viết 'anh Yến Dịch') Giữ đúng đại từ khi dẫn truyện. \nTrả kết quả theo đúng thứ tự:\n---DỊCH---\n[Bản dịch]\n---TÓM TẮT---\n[Tóm tắt chương]")
+        return "\n".join(prompt_parts)
+
+    def build_translation_prompt(self, chapter_text, prev_summary):
+        context = prev_summary.strip()
+        prompt_parts = [self.build_prompt_prefix()]
+        if self.config.use_context and context:
+            prompt_parts.append(f"\nBối cảnh chương trước: {context}")
+        prompt_parts.append("\nNội dung cần dịch:\n" + chapter_text)
+        return "\n".join(prompt_parts)
+
+    def split_prompt(self, prompt_content):
+        """(phần prompt chung, phần riêng của từng phần). Phần chung rỗng khi prompt không bắt đầu
+        bằng nó, ví dụ prompt tóm tắt của chế độ 2 pha."""
+        prefix = self.build_prompt_prefix()
+        if prefix.strip() and prompt_content.startswith(prefix):
+            return prefix, prompt_content[len(prefix):].lstrip("\n")
+        return "", prompt_content
+
+    def chat_messages(self, provider, prompt_content):
+        """Messages OpenAI-compatible: phần prompt chung là system message riêng để provider cache prefix
+        (tắt bằng "system_prompt": False trong PROVIDER_CONFIG nếu provider bỏ qua system message)."""
+        system, user = self.split_prompt(prompt_content)
+        if not system or not PROVIDER_CONFIG.get(provider, {}).get("system_prompt", True):
+            return [{"role": "user", "content": prompt_content}]
+        return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+
+    def google_request(self, model_name, prompt_content, client=None, key_slot=None):
+        """(contents, config) cho Gemini: phần prompt chung là system instruction, hoặc cached content
+        tạo một lần cho (model, key) khi đủ dài; client None = không dùng cached content (Batch API)."""
+        system, user = self.split_prompt(prompt_content)
+        if not system:
+            return prompt_content, None
+        cache_name = self._google_context_cache(client, model_name, key_slot, system) if client is not None else None
+        if cache_name:
+            return user, genai_types.GenerateContentConfig(cached_content=cache_name)
+        return user, genai_types.GenerateContentConfig(system_instruction=system)
+
+    def _google_context_cache(self, client, model_name, key_slot, system):
+        """Tên cached content chứa phần prompt chung, tạo ở lần gọi đầu tiên với (model, key) này và gia hạn
+        khi đã qua nửa thời gian sống; None nếu tắt, prompt chung quá ngắn hoặc provider từ chối.
+
+        Khóa chỉ giữ khi đọc và nhận việc tạo/gia hạn entry; lời gọi mạng chạy ngoài khóa nên
+        (model, key) khác không phải chờ. Lời gọi cùng (model, key) chờ entry đang tạo xong."""
+        if not PROVIDER_CONFIG["Google"].get("context_cache") or estimate_tokens(system) < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        ttl = f"{GEMINI_CONTEXT_CACHE_TTL_SECONDS}s"
+        key = (model_name, key_slot)
+        with self.context_caches_lock:
+            entry = self.context_caches.get(key)
+            now = time.monotonic()
+            if entry is None:
+                entry = self.context_caches[key] = {"name": None, "client": client, "renewed": now, "ready": threading.Event()}
+                action = "create"
+            elif not entry["ready"].is_set():
+                action = "wait"
+            elif entry["name"] and now - entry["renewed"] > GEMINI_CONTEXT_CACHE_TTL_SECONDS / 2:
+                entry["renewed"] = now # Nhận việc gia hạn; lời gọi khác vẫn dùng cache còn nửa thời gian sống
+                action = "update"
+            else:
+                return entry["name"]
+        if action == "wait":
+            entry["ready"].wait()
+            with self.context_caches_lock:
+                return entry["name"]
+        name = entry["name"]
+        try:
+            if action == "create":
+                name = client.caches.create(model=model_name, config=genai_types.CreateCachedContentConfig(
+                    system_instruction=system, ttl=ttl, display_name="gem5-prompt-prefix")).name
+                print(f"Đã tạo cached content {name} cho phần prompt chung ({model_name}).")
+            else:
+                client.caches.update(name=name, config=genai_types.UpdateCachedContentConfig(ttl=ttl))
         except Exception as e:
-            import traceback
-            self.show_error(f"Lỗi khi tải kết quả: {str(e)}\n{traceback.format_exc()}")
+            print(f"Không dùng được cached content cho {model_name}: {type(e).__name__} - {e}. "
+                  "Phần prompt chung được gửi như system instruction.")
+            name = None
+        with self.context_caches_lock:
+            entry["name"] = name
+            # _delete_context_caches() đã chạy khi đang tạo: cache mới không còn ai xóa
+            orphaned = action == "create" and name and self.context_caches.get(key) is not entry
+        entry["ready"].set()
+        if orphaned:
+            self._delete_context_caches([entry])
+        return name
+
+    def _delete_context_caches(self, entries=None):
+        """Xóa các cached content của job (hoặc của entries) để không tính phí lưu trữ tới hết thời gian sống."""
+        if entries is None:
+            with self.context_caches_lock:
+                entries, self.context_caches = list(self.context_caches.values()), {}
+        for entry in entries:
+            if entry["name"]:
+                try:
+                    entry["client"].caches.delete(name=entry["name"])
+                except Exception as e:
+                    print(f"Không xóa được cached content {entry['name']}: {type(e).__name__} - {e}")
+
+    def format_prompt_cache_summary(self, input_tokens, cached_tokens):
+        """Số token vào (theo usage) của các phần xong trong lần chạy này được provider lấy từ cache prefix."""
+        prefix_tokens = estimate_tokens(self.build_prompt_prefix())
+        if not input_tokens:
+            return f"Cache prefix của provider: provider không trả về số token (phần prompt chung ~{prefix_tokens} token)."
+        return (f"Cache prefix của provider: {cached_tokens}/{input_tokens} token vào lấy từ cache "
+                f"({cached_tokens / input_tokens:.0%}), phần prompt chung ~{prefix_tokens} token mỗi request.")
+
+    def build_summary_prompt(self, chapter_text):
+        """Prompt tóm tắt dùng cho pha 1 của chế độ 2 pha."""
+        return ("Tóm tắt nội dung chương sau bằng tiếng Việt, tối đa 350 từ, không dùng Markdown. "
+                "Giữ nguyên tên riêng, tuyệt đối không ghép đại từ trước tên riêng. "
+                "Chỉ trả về phần tóm tắt.\n\nNội dung chương:\n" + chapter_text)
+
+    def extract_translation_and_summary(self, response_text):
+        import re
+        parts = re.split(r'---DỊCH---|---TÓM TẮT---', response_text)
+        if len(parts) >= 3:
+            translation = parts[1].strip()
+            summary = parts[2].strip()
+        else:
+            translation = response_text.strip()
+            summary = ""
+        return translation, summary
+
+    # --- Hàm gọi API mới ---
+    def _call_model_api(self, provider, model_name, prompt_content, client=None, key_slot=None, progress=None):
+        """Hàm thực hiện gọi API theo provider được chọn.
+
+        Mặc định dùng streaming (tắt bằng "stream": False trong PROVIDER_CONFIG),
+        từng đoạn text nhận được đưa vào progress.feed().
+        """
+        progress = progress or CallProgress()
+        stream = PROVIDER_CONFIG.get(provider, {}).get("stream", True)
+        _call_context.progress = progress # Để cancel() ngắt được response của lần gọi này
+        try:
+            if client is None:
+                return None, f"{provider} client chưa được khởi tạo."
+            progress.begin()
+            if provider == "Google":
+                contents, request_config = self.google_request(model_name, prompt_content, client, key_slot)
+                if stream:
+                    parts = []
+                    for chunk in client.models.generate_content_stream(model=model_name, contents=contents, config=request_config):
+                        text = chunk.text or ""
+                        parts.append(text)
+                        progress.feed(text)
+                        progress.record_usage(getattr(chunk, "usage_metadata", None))
+                    content = "".join(parts)
+                else:
+                    response = client.models.generate_content(model=model_name, contents=contents, config=request_config)
+                    content = response.text if response else None
+                    progress.feed(content)
+                    progress.record_usage(getattr(response, "usage_metadata", None))
+                if not content:
+                    return None, f"Không nhận được nội dung hợp lệ từ model {model_name}"
+                return content, None
+            elif provider in ["MegaLLM", "Open Router", "POE", "Mistral", "Literouter"]:
+                if stream:
+                    parts = []
+                    extra_args = {}
+                    if PROVIDER_CONFIG.get(provider, {}).get("stream_usage", True):
+                        extra_args["stream_options"] = {"include_usage": True} # Số token ở event cuối
+                    response = client.chat.completions.create(
+                        model=model_name,
+                        messages=self.chat_messages(provider, prompt_content),
+                        stream=True,
+                        # Đang stream thì timeout đọc là khoảng chờ token đầu tiên, không phải cả request
+                        timeout=Timeout(API_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS,
+                                        read=STREAM_FIRST_TOKEN_TIMEOUT_SECONDS),
+                        **extra_args
+                    )
+                    for event in response:
+                        progress.record_usage(getattr(event, "usage", None))
+                        choices = getattr(event, "choices", None)
+                        if not choices:
+                            continue
+                        text = getattr(choices[0].delta, "content", None) or ""
+                        parts.append(text)
+                        progress.feed(text)
+                    content = "".join(parts).strip()
+                else:
+                    response = client.chat.completions.create(
+                        model=model_name,
+                        messages=self.chat_messages(provider, prompt_content)
+                    )
+                    content = self._extract_megallm_content(response)
+                    progress.feed(content)
+                    progress.record_usage(getattr(response, "usage", None))
+                if not content:
+                    return None, f"Không nhận được nội dung hợp lệ từ model {model_name} ({provider})"
+                return content, None
+            else:
+                return None, f"Provider {provider} chưa hỗ trợ."
+        except Exception as e:
+            error_msg = f"Lỗi API khi gọi provider {provider}, model {model_name}: {type(e).__name__} - {str(e)}"
+            print(error_msg)
+            retry_after = parse_rate_limit_error(e)
+            if retry_after is not None and key_slot is not None:
+                self.key_scheduler.report_rate_limited(key_slot, retry_after)
+            return None, error_msg
+        finally:
+            _call_context.progress = None
+
+    def _call_with_scheduled_key(self, provider, model_name, prompt_content, progress=None, avoid_key=None):
+        """Gọi model với key do scheduler chọn, đổi sang key khác khi key hiện tại bị 429."""
+        prompt_tokens = estimate_tokens(prompt_content)
+        tokens = prompt_tokens * 2 # Prompt + bản dịch dài tương đương
+        progress = progress or CallProgress()
+        error_message = None
+        for _ in range(RATE_LIMIT_MAX_KEY_SWITCHES):
+            progress.wait_for_key()
+            with self.trace.span("key_wait", progress.part, model=model_name) as span:
+                key_slot, api_key = self.key_scheduler.acquire(
+                    tokens, lambda: self.should_stop or progress.cancelled, avoid_key)
+                span["key"] = None if key_slot is None else key_slot + 1
+            if key_slot is None:
+                if progress.cancelled and not self.should_stop:
+                    return None, "Lần gọi đã bị hủy (timeout) trước khi có API key."
+                return None, "Đã dừng bởi người dùng trước khi có API key."
+            progress.key_slot = key_slot
+            client = self.client_pool.get_client(provider, api_key)
+            self.reporter.progress(f"\n-> Dùng API KEY thứ {key_slot+1}/{len(self.key_scheduler.slots)}", False)
+            progress.input_tokens = progress.output_tokens = progress.cached_tokens = None
+            self.metrics.call_started(provider, model_name, key_slot)
+            result_text, error_message = None, "Lỗi không xác định"
+            span = {"model": model_name, "role": progress.role, "key": key_slot + 1}
+            started_at = time.time()
+            try:
+                result_text, error_message = self._call_model_api(provider, model_name, prompt_content, client, key_slot, progress)
+            finally:
+                span.update(ok=not error_message, error=error_message, ttft=progress.ttft,
+                            input_tokens=progress.input_tokens, output_tokens=progress.output_tokens,
+                            cached_tokens=progress.cached_tokens)
+                self.trace.record("api_call", started_at, time.time() - started_at, progress.part, **span)
+                self.metrics.call_finished(
+                    provider, model_name, key_slot,
+                    time.monotonic() - progress.sent_at if progress.sent_at is not None else 0.0,
+                    not error_message,
+                    progress.input_tokens or prompt_tokens,
+                    progress.output_tokens or progress.chars // 4,
+                    progress.cached_tokens or 0)
+            if not error_message:
+                return result_text, None
+            if not self.key_scheduler.slots or not self.key_scheduler.is_cooling_down(key_slot):
+                return None, error_message # Lỗi không phải 429, để tầng trên retry bằng fallback
+            self.reporter.progress(f"\n-> API KEY thứ {key_slot+1} bị giới hạn (429), chuyển key khác...", False)
+        return None, error_message
+
+    def _extract_megallm_content(self, response):
+        """Trích nội dung text từ response theo định dạng OpenAI-compatible."""
+        choices = getattr(response, "choices", None)
+        if not choices:
+            return None
+        first_choice = choices[0]
+        message = getattr(first_choice, "message", None)
+        content = None
+        if message is not None:
+            content = getattr(message, "content", None)
+            if isinstance(content, dict):
+                content = content.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if isinstance(part, dict):
+                    parts.append(part.get("text") or part.get("content") or "")
+                else:
+                    parts.append(str(part))
+            content = " ".join(part for part in parts if part).strip()
+        elif isinstance(content, str):
+            content = content.strip()
+        if not content and isinstance(message, dict):
+            content = (message.get("content") or "").strip()
+        if not content:
+            text_attr = getattr(first_choice, "text", None)
+            if isinstance(text_attr, str):
+                content = text_attr.strip()
+        return content
+
+    def _wait_for_call(self, future, progress):
+        """Chờ kết quả gọi API; timeout khi quá lâu không có token mới, cả request vượt
+        progress.total_timeout hoặc tính cả thời gian chờ key vượt API_TIMEOUT_SECONDS.
+
+        Khi timeout hoặc bấm dừng, lần gọi bị hủy (đóng stream) và hàm trả về ngay,
+        không chờ luồng gọi API kết thúc.
+        """
+        deadline = time.monotonic() + API_TIMEOUT_SECONDS
+        try:
+            while True:
+                try:
+                    return future.result(timeout=0.5)
+                except concurrent.futures.TimeoutError:
+                    if self.should_stop:
+                        progress.cancel()
+                        raise CallCancelled()
+                    if progress.timeout_exceeded() or time.monotonic() > deadline:
+                        progress.cancel()
+                        raise
+        finally:
+            with self.active_calls_lock:
+                self.active_calls.discard(progress)
+
+    def _start_attempt(self, provider, model_name, prompt_content, sink, avoid_key=None, role="primary"):
+        if sink is not None:
+            sink.start_attempt(model_name)
+        progress = CallProgress(sink.write if sink is not None else None)
+        progress.part = getattr(_call_context, "part", None)
+        progress.role = role
+        progress.first_token_timeout, progress.idle_timeout, progress.total_timeout = \
+            self.latency.timeouts(provider, model_name, estimate_tokens(prompt_content))
+        with self.active_calls_lock:
+            self.active_calls.add(progress)
+        if self.should_stop:
+            progress.cancel()
+        future = run_in_daemon_thread(self._call_with_scheduled_key, provider, model_name, prompt_content,
+                                      progress, avoid_key)
+        return future, progress
+
+    def _record_latency(self, provider, model_name, prompt_content, progress, finished=True):
+        """Ghi thời gian từ lúc gửi request (không tính thời gian chờ key) vào lịch sử của model.
+
+        finished=False: request bị hủy giữa chừng, chỉ ghi thời gian đã chờ (chặn dưới).
+        """
+        if progress.sent_at is None:
+            return
+        self.latency.record(provider, model_name, time.monotonic() - progress.sent_at,
+                            estimate_tokens(prompt_content),
+                            progress.ttft if finished else None,
+                            progress.max_gap if finished else None)
+
+    def _hedge_delay(self, provider, model_name, prompt_content):
+        """Số giây chờ request chính trước khi gửi request dự phòng, None nếu không hedging."""
+        percentile = self.config.hedge_percentile if self.config is not None else 0
+        if not percentile:
+            return None
+        return self.latency.percentile(provider, model_name, percentile, estimate_tokens(prompt_content))
+
+    def format_timeout_summary(self, provider, model_name, prompt_tokens):
+        first_token, idle, total = self.latency.timeouts(provider, model_name, prompt_tokens)
+        return (f"Timeout {model_name} theo lịch sử (prompt {prompt_tokens} token): "
+                f"chờ token đầu {first_token:.0f}s, ngắt quãng {idle:.0f}s, cả request {total:.0f}s.")
+
+    def format_hedge_summary(self):
+        with self.hedge_stats_lock:
+            stats = dict(self.hedge_stats)
+        return (f"Hedging (p{self.config.hedge_percentile:g}): {stats['sent']} request dự phòng, "
+                f"{stats['won']} lần request dự phòng về trước, "
+                f"lãng phí khoảng {stats['wasted_tokens']} token cho request bị hủy.")
+
+    # --- Hàm gọi API với Retry và Timeout ---
+    def call_model_with_retry_and_timeout(self, provider, primary_model_name, prompt_content, sink=None):
+        """Gọi API với timeout, retry bằng model fallback nếu cần.
+
+        sink (PartialOutput, tùy chọn) nhận từng đoạn text đang stream và TTFT của lần gọi thành công.
+        Trả về (None, None) khi bị dừng giữa chừng.
+        """
+        fallback_model = PROVIDER_CONFIG.get(provider, {}).get("fallback_model")
+
+        if self.response_cache is not None:
+            # Kết quả của model fallback lần trước cũng dùng được
+            with self.trace.span("cache_lookup", getattr(_call_context, "part", None)) as span:
+                for model_name in [primary_model_name] + ([fallback_model] if fallback_model else []):
+                    cached_text = self.response_cache.get(provider, model_name, prompt_content)
+                    if cached_text is not None:
+                        span["hit"] = model_name
+                        break
+            if cached_text is not None:
+                print(f"Cache hit ({provider}): {model_name}")
+                self.metrics.cache_hit(provider, model_name)
+                if sink is not None:
+                    sink.succeeded(model_name)
+                return cached_text, None
+
+        call_slots = self.shared.call_slots if self.shared is not None else None
+        if call_slots is None:
+            return self._call_with_fallback(provider, primary_model_name, prompt_content, sink)
+        # Giới hạn số request đang chờ chung cho mọi file của batch. Slot được trả ngay khi
+        # lần gọi timeout hoặc bị dừng, kể cả khi luồng gọi API bị bỏ rơi chưa kết thúc.
+        while not call_slots.acquire(timeout=0.5):
+            if self.should_stop:
+                return None, None
+        try:
+            return self._call_with_fallback(provider, primary_model_name, prompt_content, sink)
+        finally:
+            call_slots.release()
+
+    def _call_with_fallback(self, provider, primary_model_name, prompt_content, sink):
+        start_time = time.time()
+        error_message_final = "Không có lỗi"
+        fallback_model = PROVIDER_CONFIG.get(provider, {}).get("fallback_model")
+
+        hedge_delay = self._hedge_delay(provider, primary_model_name, prompt_content)
+        if hedge_delay is not None:
+            return self._call_hedged(provider, primary_model_name, fallback_model, prompt_content, sink, hedge_delay)
+
+        future, progress = self._start_attempt(provider, primary_model_name, prompt_content, sink)
+        try:
+            print(f"Attempting primary model ({provider}): {primary_model_name}")
+            result_text, error_message = self._wait_for_call(future, progress)
+            if error_message:
+                print(f"Primary model failed: {error_message}")
+                error_message_final = error_message
+            else:
+                print(f"Primary model success (TTFT {progress.ttft or 0:.2f}s).")
+                self._record_latency(provider, primary_model_name, prompt_content, progress)
+                if sink is not None:
+                    sink.succeeded(primary_model_name, progress)
+                if self.response_cache is not None:
+                    self.response_cache.put(provider, primary_model_name, prompt_content, result_text)
+                return result_text, None
+        except CallCancelled:
+            return None, None
+        except concurrent.futures.TimeoutError:
+            elapsed = time.time() - start_time
+            print(f"Primary model timeout after {elapsed:.2f}s")
+            error_message_final = f"Model chính ({primary_model_name}) timeout sau {elapsed:.2f} giây (không nhận thêm token)."
+        except Exception as e:
+            elapsed = time.time() - start_time
+            print(f"Primary model unexpected error after {elapsed:.2f}s: {e}")
+            error_message_final = f"Lỗi không xác định với model chính ({primary_model_name}): {str(e)}"
+
+        if self.should_stop:
+            return None, None # Lỗi do bị dừng giữa chừng, không thử fallback
+        if not fallback_model:
+            error_message_final += "\nProvider không có fallback model."
+            return None, error_message_final
+
+        print(f"Trying fallback model: {fallback_model}")
+        self.reporter.progress(f"\n-> Thử lại với model {fallback_model}...", False)
+
+        fallback_start_time = time.time()
+        future, progress = self._start_attempt(provider, fallback_model, prompt_content, sink, role="fallback")
+        try:
+            result_text, error_message = self._wait_for_call(future, progress)
+            if error_message:
+                if self.should_stop:
+                    return None, None
+                print(f"Fallback model failed: {error_message}")
+                error_message_final += f"\nRetry với {fallback_model} cũng thất bại: {error_message}"
+                return None, error_message_final
+            else:
+                elapsed_fallback = time.time() - fallback_start_time
+                print(f"Fallback model success after {elapsed_fallback:.2f}s.")
+                self._record_latency(provider, fallback_model, prompt_content, progress)
+                if sink is not None:
+                    sink.succeeded(fallback_model, progress)
+                if self.response_cache is not None:
+                    self.response_cache.put(provider, fallback_model, prompt_content, result_text)
+                self.reporter.progress(f"\n-> Retry với {fallback_model} thành công.", False)
+                return result_text, None
+        except CallCancelled:
+            return None, None
+        except concurrent.futures.TimeoutError:
+            elapsed = time.time() - fallback_start_time
+            print(f"Fallback model timeout after {elapsed:.2f}s")
+            error_message_final += f"\nRetry với {fallback_model} cũng timeout sau {elapsed:.2f} giây."
+            return None, error_message_final
+        except Exception as e:
+            elapsed = time.time() - fallback_start_time
+            print(f"Fallback model unexpected error after {elapsed:.2f}s: {e}")
+            error_message_final += f"\nLỗi không xác định khi retry với {fallback_model}: {str(e)}"
+            return None, error_message_final
+
+    def _call_hedged(self, provider, primary_model_name, fallback_model, prompt_content, sink, hedge_delay):
+        """Gọi model chính, quá hedge_delay giây chưa xong thì gửi thêm một request dự phòng.
+
+        Request dự phòng dùng model fallback, hoặc cùng model với key khác nếu provider không có
+        fallback. Lấy kết quả về trước, hủy request còn lại và tính token đã tốn cho nó vào
+        hedge_stats. Request dự phòng không stream vào sink để không trộn với request chính.
+        Model chính lỗi trước ngưỡng thì model fallback được gọi ngay như khi không hedging.
+        """
+        hedge_model = fallback_model or primary_model_name
+        future, primary = self._start_attempt(provider, primary_model_name, prompt_content, sink)
+        attempts = [(primary_model_name, future, primary)]
+        started = [primary]
+        hedged = False
+        errors = []
+        deadline = time.monotonic() + API_TIMEOUT_SECONDS
+        print(f"Attempting primary model ({provider}): {primary_model_name}, hedging sau {hedge_delay:.1f}s")
+        try:
+            while attempts:
+                done, _ = concurrent.futures.wait([attempt[1] for attempt in attempts], timeout=0.5,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for attempt in [attempt for attempt in attempts if attempt[1] in done]:
+                    attempts.remove(attempt)
+                    model_name, future, progress = attempt
+                    try:
+                        result_text, error_message = future.result()
+                    except Exception as e:
+                        result_text, error_message = None, f"{type(e).__name__} - {str(e)}"
+                    if self.should_stop:
+                        return None, None
+                    if error_message:
+                        print(f"{model_name} failed: {error_message}")
+                        errors.append(f"{model_name}: {error_message}")
+                        continue
+                    self._record_latency(provider, model_name, prompt_content, progress)
+                    for loser_model, _, loser in attempts:
+                        # Request bị hủy chậm hơn request thắng: ghi lại như một mẫu để
+                        # percentile không bị kéo xuống bởi việc chỉ thấy request nhanh
+                        self._record_latency(provider, loser_model, prompt_content, loser, finished=False)
+                        loser.cancel()
+                        wasted = loser.chars // 4 + (estimate_tokens(prompt_content) if loser.sent_at else 0)
+                        with self.hedge_stats_lock:
+                            self.hedge_stats["wasted_tokens"] += wasted
+                    if hedged and progress is not primary:
+                        with self.hedge_stats_lock:
+                            self.hedge_stats["won"] += 1
+                        self.reporter.progress(f"\n-> Request dự phòng ({model_name}) trả về trước.", False)
+                    if sink is not None:
+                        sink.succeeded(model_name, progress)
+                    if self.response_cache is not None:
+                        self.response_cache.put(provider, model_name, prompt_content, result_text)
+                    return result_text, None
+                if self.should_stop:
+                    return None, None
+                now = time.monotonic()
+                for attempt in list(attempts):
+                    model_name, _, progress = attempt
+                    if progress.timeout_exceeded() or now > deadline:
+                        progress.cancel()
+                        attempts.remove(attempt)
+                        errors.append(f"{model_name}: timeout (không nhận thêm token).")
+                if len(started) > 1:
+                    continue
+                primary_slow = primary.sent_at is not None and now - primary.sent_at >= hedge_delay
+                primary_failed = not attempts and fallback_model is not None
+                if primary_slow or primary_failed:
+                    if primary_slow and attempts:
+                        hedged = True
+                        with self.hedge_stats_lock:
+                            self.hedge_stats["sent"] += 1
+                        self.reporter.progress(f"\n-> Sau {now - primary.sent_at:.1f}s chưa xong, "
+                                               f"gửi thêm request dự phòng tới {hedge_model}...", False)
+                    else:
+                        self.reporter.progress(f"\n-> Thử lại với model {hedge_model}...", False)
+                    future, progress = self._start_attempt(provider, hedge_model, prompt_content, None,
+                                                           avoid_key=primary.key_slot,
+                                                           role="hedge" if hedged else "fallback")
+                    attempts.append((hedge_model, future, progress))
+                    started.append(progress)
+        finally:
+            for _, _, progress in attempts:
+                progress.cancel()
+            with self.active_calls_lock:
+                self.active_calls.difference_update(started)
+        if len(started) == 1:
+            errors.append("Provider không có fallback model.")
+        return None, "\n".join(errors)
+    def format_speedup(self, wall_seconds, serial_seconds):
+        """So sánh thời gian thực tế với thời gian ước tính nếu chạy tuần tự từng phần."""
+        speedup = serial_seconds / wall_seconds if wall_seconds > 0 else 0
+        return (f"Thời gian thực tế: {wall_seconds:.1f} giây; "
+                f"ước tính chạy tuần tự: {serial_seconds:.1f} giây (nhanh hơn x{speedup:.1f}).")
+
+    def _update_results_index(self, result_file, **fields):
+        try:
+            ResultsIndex().add(dict(fields, result_file=result_file))
+        except OSError as e:
+            print(f"Không ghi được index các job: {e}")
+
+    def run_batch_api(self, provider, model_name, chapters, manifest, call_info):
+        """Chế độ Batch API: gửi các phần chưa xong thành batch bất đồng bộ của provider, chờ xong rồi
+        trả về {số phần: (bản dịch, lỗi)}; call_info[i] nhận model, batch, key, token của từng phần.
+
+        Mỗi batch tối đa BATCH_MAX_REQUESTS phần / BATCH_MAX_BYTES prompt, các batch luân phiên key.
+        Batch đã gửi được ghi vào manifest nên "Tiếp tục job" chờ tiếp batch cũ thay vì gửi lại;
+        bấm dừng chỉ ngừng chờ, batch vẫn chạy trên server. Phần không có trong kết quả trả về
+        (bị dừng) được coi như chưa xử lý.
+        """
+        api_keys = self.config.api_keys
+        outputs = {}
+        waiting = {} # id batch -> thông tin batch đang chờ
+        for batch_id, batch in manifest.batches.items():
+            if batch.get("state") != "collected" and not all(manifest.is_done(i) for i in batch["parts"]):
+                waiting[batch_id] = batch
+        submitted_parts = {i for batch in waiting.values() for i in batch["parts"]}
+        if waiting:
+            self.reporter.progress(f"Batch API: chờ tiếp {len(waiting)} batch đã gửi ở lần chạy trước.\n", False)
+
+        group, group_bytes = [], 0
+
+        def submit_group():
+            key_slot = len(manifest.batches) % len(api_keys)
+            parts = [i for i, _ in group]
+            with self.trace.span("batch_submit", None, parts=len(parts), bytes=group_bytes, key=key_slot + 1) as span:
+                try:
+                    client = self.client_pool.get_client(provider, api_keys[key_slot])
+                    batch_id = self._submit_batch(provider, model_name, group, client)
+                except Exception as e:
+                    error_msg = f"Không gửi được batch ({provider}, {model_name}): {type(e).__name__} - {str(e)}"
+                    print(error_msg)
+                    span["error"] = error_msg
+                    for i in parts:
+                        outputs[i] = (None, error_msg)
+                    return
+                span["batch"] = batch_id
+            manifest.record_batch(batch_id, provider=provider, model=model_name, key=key_slot + 1,
+                                  parts=parts, submitted=time.time())
+            waiting[batch_id] = manifest.batches[batch_id]
+            for _ in parts:
+                self.metrics.call_started(provider, model_name, key_slot)
+            self.reporter.progress(f"Batch API: đã gửi batch {batch_id} ({len(parts)} phần, key {key_slot + 1}).\n", False)
+
+        for i in range(1, len(chapters) + 1):
+            if self.should_stop:
+                break
+            if manifest.is_done(i) or i in submitted_parts:
+                continue
+            prompt_content = self.build_translation_prompt(chapters[i - 1], "")
+            if self.response_cache is not None:
+                cached_text = self.response_cache.get(provider, model_name, prompt_content)
+                if cached_text is not None:
+                    self.metrics.cache_hit(provider, model_name)
+                    outputs[i] = (cached_text, None)
+                    call_info[i] = {"model": model_name, "cached": True}
+                    continue
+            size = len(prompt_content.encode('utf-8'))
+            if group and (len(group) >= BATCH_MAX_REQUESTS or group_bytes + size > BATCH_MAX_BYTES):
+                submit_group()
+                group, group_bytes = [], 0
+            group.append((i, prompt_content))
+            group_bytes += size
+        if group and not self.should_stop:
+            submit_group()
+
+        poll_errors = collections.Counter()
+        while waiting and not self.should_stop:
+            for batch_id, batch in list(waiting.items()):
+                key_slot = (batch.get("key", 1) - 1) % len(api_keys)
+                poll_failed = False
+                try:
+                    client = self.client_pool.get_client(provider, api_keys[key_slot])
+                    finished, results, state = self._poll_batch(provider, batch_id, batch["parts"], client)
+                except Exception as e:
+                    poll_errors[batch_id] += 1
+                    print(f"Lỗi khi hỏi trạng thái batch {batch_id}: {type(e).__name__} - {e}")
+                    if poll_errors[batch_id] < BATCH_POLL_MAX_ERRORS:
+                        continue
+                    # Không đánh dấu đã lấy kết quả: lần "Tiếp tục job" sau sẽ hỏi lại batch này
+                    finished, results, state, poll_failed = True, {}, f"lỗi khi hỏi trạng thái: {type(e).__name__} - {e}", True
+                else:
+                    poll_errors[batch_id] = 0
+                if not finished:
+                    continue
+                seconds = time.time() - batch.get("submitted", time.time())
+                self.trace.record("batch_wait", batch.get("submitted", time.time()), seconds, None,
+                                  batch=batch_id, parts=len(batch["parts"]), state=state)
+                for i in batch["parts"]:
+                    if manifest.is_done(i):
+                        continue
+                    text, error_msg, usage = results.get(i, (None, f"Batch {batch_id} kết thúc ({state}) mà không có kết quả cho phần này.", None))
+                    input_tokens, output_tokens = usage_tokens(usage)
+                    cached_tokens = cached_input_tokens(usage)
+                    self.metrics.call_finished(provider, model_name, key_slot, seconds, not error_msg,
+                                               input_tokens or 0, output_tokens or 0, cached_tokens or 0)
+                    if error_msg:
+                        outputs[i] = (None, error_msg)
+                        continue
+                    outputs[i] = (text, None)
+                    call_info[i] = {"model": model_name, "key": key_slot + 1, "batch": batch_id,
+                                    "latency": round(seconds, 3), "input_tokens": input_tokens, "output_tokens": output_tokens,
+                                    "cached_tokens": cached_tokens}
+                    if self.response_cache is not None:
+                        self.response_cache.put(provider, model_name, self.build_translation_prompt(chapters[i - 1], ""), text)
+                if not poll_failed:
+                    manifest.record_batch(batch_id, state="collected")
+                del waiting[batch_id]
+                self.reporter.progress(f"Batch API: batch {batch_id} xong ({state}).\n", False)
+            if waiting:
+                self.reporter.progress(f"Batch API: đang chờ {len(waiting)} batch...\n", False)
+                deadline = time.monotonic() + BATCH_POLL_SECONDS
+                while time.monotonic() < deadline and not self.should_stop:
+                    time.sleep(0.5)
+        if waiting:
+            self.reporter.progress(f"Đã ngừng chờ {len(waiting)} batch; batch vẫn chạy trên server, "
+                                   "dùng \"Tiếp tục job\" để lấy kết quả mà không phải gửi lại.\n", False)
+        return outputs
+
+    def _submit_batch(self, provider, model_name, requests, client):
+        """Gửi [(số phần, prompt)] thành một batch, trả về id batch của provider."""
+        if PROVIDER_CONFIG[provider]["batch_api"] == "google":
+            src = []
+            for i, prompt_content in requests:
+                contents, request_config = self.google_request(model_name, prompt_content)
+                item = {"contents": [{"parts": [{"text": contents}], "role": "user"}], "metadata": {"key": str(i)}}
+                if request_config is not None:
+                    item["config"] = request_config
+                src.append(item)
+            job = client.batches.create(
+                model=model_name,
+                src=src,
+                config={"display_name": f"gem5-{requests[0][0]}-{requests[-1][0]}"})
+            return job.name
+        # OpenAI-style: file JSONL mỗi dòng một request /v1/chat/completions, custom_id là số phần
+        with tempfile.TemporaryFile() as f:
+            for i, prompt_content in requests:
+                f.write(json.dumps({
+                    "custom_id": f"part-{i}", "method": "POST", "url": "/v1/chat/completions",
+                    "body": {"model": model_name, "messages": self.chat_messages(provider, prompt_content)}
+                }, ensure_ascii=False).encode('utf-8') + b"\n")
+            f.seek(0)
+            uploaded = client.files.create(file=("batch.jsonl", f), purpose="batch")
+        batch = client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions",
+                                      completion_window="24h")
+        return batch.id
+
+    def _poll_batch(self, provider, batch_id, parts, client):
+        """(đã kết thúc chưa, {số phần: (text, lỗi, usage)}, trạng thái) của một batch."""
+        results = {}
+        if PROVIDER_CONFIG[provider]["batch_api"] == "google":
+            job = client.batches.get(name=batch_id)
+            state = job.state.name if job.state is not None else "UNKNOWN"
+            if state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+                return False, results, state
+            responses = (job.dest.inlined_responses if job.dest is not None else None) or []
+            for position, item in enumerate(responses):
+                key = (item.metadata or {}).get("key")
+                i = int(key) if key else parts[position] # Kết quả inline theo đúng thứ tự request
+                if item.error is not None:
+                    results[i] = (None, f"Lỗi API trong batch: {item.error.message}", None)
+                    continue
+                text = item.response.text if item.response is not None else None
+                results[i] = (text, None if text else f"Không nhận được nội dung hợp lệ từ model (batch {batch_id})",
+                              getattr(item.response, "usage_metadata", None))
+            return True, results, state
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in ("completed", "failed", "expired", "cancelled"):
+            return False, results, batch.status
+        state = batch.status
+        if batch.status == "failed" and getattr(batch, "errors", None) and batch.errors.data:
+            state += f": {batch.errors.data[0].message}"
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                i = int(item["custom_id"].split("-", 1)[1])
+                response = item.get("response") or {}
+                body = response.get("body") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    error = item.get("error") or body.get("error") or {}
+                    results[i] = (None, f"Lỗi API trong batch: {error.get('message') or response.get('status_code')}", None)
+                    continue
+                choices = body.get("choices") or [{}]
+                text = ((choices[0].get("message") or {}).get("content") or "").strip()
+                results[i] = (text, None if text else f"Không nhận được nội dung hợp lệ từ model (batch {batch_id})",
+                              body.get("usage"))
+        return True, results, state
+
+    def _append_record_text(self, result_file, record, use_context):
+        """Ghi đoạn text của một phần (sinh từ bản ghi của kho kết quả) vào cuối file kết quả,
+        trả về vị trí byte [bắt đầu, kết thúc] của đoạn đó."""
+        with open(result_file, 'a', encoding='utf-8') as f:
+            f.flush()
+            start = os.fstat(f.fileno()).st_size
+            f.write(JobManifest.format_record(record, use_context))
+            f.flush()
+            return [start, os.fstat(f.fileno()).st_size]
+
+    def run(self, config):
+        """Chạy job đến hết hoặc đến khi stop().
+
+        Trả về dict thống kê (result_file, total_parts, done, failed, stopped),
+        None nếu job không bắt đầu được (lỗi đã báo qua reporter.error).
+        """
+        self.config = config
+        self.client_pool = ClientPool() if self.shared is None else self.shared.client_pool
+        try:
+            errors = config.validate()
+            if errors:
+                self.reporter.error("\n".join(errors))
+                return None
+            provider = config.provider
+            provider_config = PROVIDER_CONFIG[provider]
+            # Mỗi key có token bucket riêng, key bị 429 sẽ được cho nghỉ
+            api_keys = config.api_keys
+            with self.hedge_stats_lock:
+                self.hedge_stats = {"sent": 0, "won": 0, "wasted_tokens": 0}
+            self.trace = JobTrace()
+            if self.shared is not None:
+                self.key_scheduler = self.shared.key_scheduler
+                self.response_cache = self.shared.response_cache
+                self.latency = self.shared.latency
+            else:
+                self.metrics = JobMetrics()
+                self.key_scheduler = KeyScheduler(api_keys, provider_config.get("rate_limit"))
+                self.latency = LatencyTracker.load(LATENCY_FILE)
+                self.response_cache = None
+                if config.use_cache:
+                    self.response_cache = ResponseCache(os.path.join(config.results_dir, ".cache"))
+                    self.response_cache.evict()
+            if provider in ["Google", "MegaLLM", "Open Router", "POE", "Mistral", "Literouter"]:
+                try:
+                    # Tạo sẵn client đầu tiên, cũng là bước kiểm tra cấu hình trước khi chia văn bản
+                    self.client_pool.get_client(provider, api_keys[0])
+                except Exception as client_error:
+                    self.reporter.error(f"Không thể khởi tạo {provider} client: {client_error}")
+                    return None
+            else:
+                self.reporter.error(f"Provider {provider} chưa hỗ trợ.")
+                return None
+            primary_model_name = config.model
+
+            text = config.text
+            manifest = config.resume_manifest
+            if manifest is not None and JobManifest.fingerprint(text) != manifest.header["input_fingerprint"]:
+                self.reporter.error("Văn bản đầu vào không khớp với job đã lưu, không thể tiếp tục job.")
+                return None
+            split_started_at = time.time()
+            self.split_chars_per_token = None
+            chapters = self.split_text(text)
+            split_seconds = time.time() - split_started_at
+            if not chapters:
+                self.reporter.error("Không thể chia văn bản thành các phần.")
+                return None
+
+            results_dir = config.results_dir
+            os.makedirs(results_dir, exist_ok=True)
+            timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+            result_file = os.path.join(results_dir, f"gemini_result_{timestamp}_{primary_model_name.replace('/', '-').replace(':', '_')}.txt")
+
+            self.reporter.set_progress(0, len(chapters))
+
+            status_messages = []
+            total_parts = len(chapters)
+            use_context = config.use_context
+            prev_summary = config.initial_summary.strip() if use_context else ""
+            two_phase = use_context and config.two_phase
+
+            if manifest is not None:
+                if manifest.header["total_parts"] != total_parts:
+                    self.reporter.error(f"Văn bản được chia thành {total_parts} phần, khác với {manifest.header['total_parts']} phần của job đã lưu.")
+                    return None
+                # Cùng số phần vẫn có thể cắt ở chỗ khác (chia "Theo token" với ước lượng ký tự/token khác)
+                saved_chars_per_token = manifest.header.get("chars_per_token")
+                if saved_chars_per_token is not None and saved_chars_per_token != self.split_chars_per_token:
+                    self.reporter.error("Văn bản được chia khác với job đã lưu (số ký tự/token ước tính khác), không thể tiếp tục job.")
+                    return None
+                result_file = manifest.header["result_file"]
+                # Dựng lại file kết quả theo đúng thứ tự từ manifest, phần đã xong không gọi lại API
+                open(result_file, 'w', encoding='utf-8').close()
+                self.reporter.progress(f"Tiếp tục job: {manifest.done_count()}/{total_parts} phần đã xong sẽ được bỏ qua.\n", True)
+            else:
+                manifest = JobManifest.create(result_file, {
+                    "input_fingerprint": JobManifest.fingerprint(text),
+                    "input_chars": len(text),
+                    "split_method": config.split_method,
+                    "split_length": config.split_length,
+                    "language": config.language,
+                    "provider": provider,
+                    "model": primary_model_name,
+                    "context_mode": config.context_mode,
+                    "two_phase": two_phase,
+                    "token_calibration": config.token_calibration,
+                    "chars_per_token": self.split_chars_per_token,
+                    "batch_mode": config.batch_mode,
+                    "prompt": config.prompt,
+                    "initial_summary": prev_summary,
+                    "total_parts": total_parts
+                })
+            failed_parts = []
+            self._update_results_index(result_file, manifest=manifest.path, created=manifest.header.get("created"),
+                                       provider=provider, model=primary_model_name, total_parts=total_parts,
+                                       done=manifest.done_count(), status="running")
+            self.metrics.add_parts(total_parts - manifest.done_count())
+            self.trace = JobTrace(result_file[:-len(".txt")] + ".trace.jsonl")
+            self.trace.record("split", split_started_at, split_seconds, split_method=config.split_method, parts=total_parts)
+
+            def job_stats():
+                """Thống kê trả về cho nơi gọi (CLI hiển thị, mã thoát), đồng thời cập nhật index các job."""
+                stats = {"result_file": result_file, "manifest": manifest.path, "trace": self.trace.path, "total_parts": total_parts,
+                         "done": manifest.done_count(), "failed": len(failed_parts), "stopped": self.should_stop,
+                         "input_tokens": call_tokens["input"], "cached_input_tokens": call_tokens["cached"]}
+                self._update_results_index(result_file, done=stats["done"], failed=stats["failed"],
+                                           status="stopped" if self.should_stop else "finished")
+                return stats
+
+            # Chế độ có context phải chạy tuần tự vì mỗi phần cần tóm tắt của phần trước,
+            # trừ khi dùng chế độ 2 pha (tóm tắt đã được tính trước)
+            concurrency = 1 if use_context and not two_phase else config.concurrency
+            precomputed_summaries = None
+            job_start_time = time.time()
+            api_seconds = [0.0] # Tổng thời gian gọi API dịch = thời gian nếu chạy tuần tự
+            api_seconds_lock = threading.Lock()
+            ttfts = {} # Thời gian tới token đầu tiên của từng phần
+            chunk_calls = {} # Model, key, thời gian, token của lần gọi thành công từng phần (PartialOutput.call)
+            call_tokens = collections.Counter() # Tổng token vào / token vào lấy từ cache prefix của các phần đã ghi
+            chunk_offsets = getattr(chapters, "offsets", None) # Chia theo chương trong bộ nhớ không có vị trí
+
+            def source_fields(i):
+                return chunk_offsets(i - 1) if chunk_offsets is not None else {}
+            chunk_seconds = [] # Thời gian xử lý từng phần (kể cả retry/hedging), để báo p50/p99
+            # Bản dịch đang stream của từng phần được ghi dần vào đây, xóa khi phần đó xong
+            partial_dir = result_file[:-len(".txt")] + "_partial"
+            # Prompt đầy đủ của từng phần ghi vào file để debug, ô tiến trình chỉ hiện phần đầu
+            prompts_file = result_file[:-len(".txt")] + ".prompts.log"
+            prompts_lock = threading.Lock()
+
+            def call_chunk(i, chapter, chunk_prev_summary):
+                """Gọi API cho một phần, dùng được từ nhiều luồng."""
+                _call_context.part = i # Các span gọi API của phần này ghi kèm số phần
+                # Xây dựng prompt cho từng chương
+                with self.trace.span("build_prompt", i) as span:
+                    prompt_content = self.build_translation_prompt(chapter, chunk_prev_summary)
+                    span["chars"] = len(prompt_content)
+                with prompts_lock:
+                    with open(prompts_file, 'a', encoding='utf-8') as f:
+                        f.write(f"{'='*20} Phần {i}/{total_parts} {'='*20}\n{prompt_content}\n\n")
+
+                if concurrency == 1:
+                    # Hiển thị phần đầu prompt gửi API để debug (key được ghi khi scheduler chọn)
+                    prompt_preview = prompt_content[:PROMPT_PREVIEW_CHARS]
+                    if len(prompt_content) > PROMPT_PREVIEW_CHARS:
+                        prompt_preview += f"\n... (còn {len(prompt_content) - PROMPT_PREVIEW_CHARS} ký tự, prompt đầy đủ trong {os.path.basename(prompts_file)})"
+                    self.reporter.progress(
+                        f"Đang xử lý phần {i}/{total_parts}\n"
+                        f"Model chính: {primary_model_name}\n"
+                        f"Prompt gửi API:\n{'='*20}\n{prompt_preview}\n{'='*20}", True)
+                    self.reporter.result(f"--- Đang chờ kết quả phần {i} ---", True)
+                else:
+                    self.reporter.progress(f"\nBắt đầu phần {i}/{total_parts} ({len(prompt_content)} ký tự prompt)", False)
+
+                # Chỉ hiện text đang stream lên UI khi xử lý tuần tự, tránh trộn nhiều phần
+                echo = (lambda text: self.reporter.result(text, False)) if concurrency == 1 else None
+                sink = PartialOutput(os.path.join(partial_dir, f"phan_{i:05d}.txt"), echo)
+                call_start = time.time()
+                try:
+                    result = self.call_model_with_retry_and_timeout(
+                        provider, primary_model_name, prompt_content, sink
+                    )
+                finally:
+                    # Giữ lại file tạm nếu phần này lỗi để tiện kiểm tra
+                    sink.finish(keep=sink.ttft is None)
+                with api_seconds_lock:
+                    api_seconds[0] += time.time() - call_start
+                    chunk_seconds.append(time.time() - call_start)
+                    if sink.ttft is not None:
+                        ttfts[i] = sink.ttft
+                    chunk_calls[i] = sink.call
+                return result
+
+            def parallel_worker(i, chapter):
+                if self.should_stop or manifest.is_done(i):
+                    return None, None
+                chunk_prev_summary = ""
+                if precomputed_summaries is not None:
+                    chunk_prev_summary = prev_summary if i == 1 else precomputed_summaries[i - 2]
+                try:
+                    return call_chunk(i, chapter, chunk_prev_summary)
+                except Exception as e:
+                    return None, f"Lỗi khi xử lý phần {i}: {type(e).__name__} - {str(e)}"
+
+            def summary_worker(i, chapter):
+                if self.should_stop:
+                    return None, None
+                if manifest.is_done(i):
+                    return manifest.read(i).get("summary", ""), None
+                _call_context.part = i
+                try:
+                    with self.trace.span("build_prompt", i, stage="summary"):
+                        summary_prompt = self.build_summary_prompt(chapter)
+                    return self.call_model_with_retry_and_timeout(provider, summary_model_name, summary_prompt)
+                except Exception as e:
+                    return None, f"{type(e).__name__} - {str(e)}"
+
+            def stop_message(i):
+                status_messages.append(f"Phần {i}/{total_parts}: Đã dừng bởi người dùng.")
+                self.reporter.completion(f"Xử lý đã bị dừng ở phần {i}.\n" + "\n".join(status_messages) + f"\nKết quả chưa hoàn chỉnh lưu tại: {result_file}")
+
+            if two_phase:
+                # Pha 1: tóm tắt tất cả các chương song song bằng model rẻ
+                summary_model_name = provider_config.get("summary_model") or primary_model_name
+                self.reporter.progress(f"Pha 1/2: Tóm tắt {total_parts} phần bằng {summary_model_name} với {concurrency} luồng...", True)
+                precomputed_summaries = []
+                summaries = iter_ordered_results(chapters, summary_worker, concurrency, lambda: self.should_stop)
+                try:
+                    for i, (summary_text, summary_error) in summaries:
+                        if summary_error:
+                            print(f"Không tóm tắt được phần {i}: {summary_error}")
+                            self.reporter.progress(f"\nPhần {i}: không tóm tắt được, phần sau sẽ dịch không có bối cảnh.", False)
+                        precomputed_summaries.append((summary_text or "").strip())
+                        self.reporter.set_progress(i)
+                finally:
+                    summaries.close()
+                phase_one_seconds = time.time() - job_start_time
+                if self.should_stop:
+                    self.reporter.completion(f"Xử lý đã bị dừng trong pha tóm tắt ({len(precomputed_summaries)}/{total_parts} phần).")
+                    return job_stats()
+                self.reporter.set_progress(0)
+                self.reporter.progress(f"\nPha 1 xong sau {phase_one_seconds:.1f} giây.\nPha 2/2: Dịch {total_parts} phần với {concurrency} luồng...", False)
+
+            if config.batch_mode:
+                self.reporter.progress(f"Batch API: {total_parts - manifest.done_count()} phần chưa xong, "
+                                       f"hỏi trạng thái mỗi {BATCH_POLL_SECONDS} giây.\n", True)
+                batch_outputs = self.run_batch_api(provider, primary_model_name, chapters, manifest, chunk_calls)
+                results = ((i, batch_outputs.get(i, (None, None))) for i in range(1, total_parts + 1))
+            elif concurrency > 1:
+                results = iter_ordered_results(chapters, parallel_worker, concurrency, lambda: self.should_stop)
+                if not two_phase:
+                    self.reporter.progress(f"Đang xử lý {total_parts} phần với {concurrency} luồng song song...", True)
+            else:
+                results = ((i, None) for i in range(1, total_parts + 1))
+
+            next_part = 1
+            try:
+                for i, result in results:
+                    next_part = i + 1
+                    # Kết quả đã nhận trước khi bấm dừng vẫn được ghi lại
+                    if self.should_stop and (result is None or result == (None, None)):
+                        stop_message(i)
+                        break
+
+                    if manifest.is_done(i):
+                        # Phần đã xong ở lần chạy trước: sinh lại từ kho kết quả
+                        record = manifest.read(i)
+                        summary = record.get("summary", "")
+                        try:
+                            output = self._append_record_text(result_file, record, use_context)
+                        except Exception as write_err:
+                            print(f"Không thể ghi kết quả phần {i} vào file: {write_err}")
+                            output = None
+                        # File kết quả được sinh lại từ đầu nên vị trí ghi ở lần chạy trước không còn đúng
+                        if output != manifest.outputs.get(i, record.get("output")):
+                            manifest.record_output(i, output)
+                        status_messages.append(f"Phần {i}/{total_parts}: Đã xong từ lần chạy trước.")
+                        self.reporter.set_progress(i)
+                        if use_context:
+                            prev_summary = summary
+                        continue
+
+                    if result is None:
+                        try:
+                            response_text, error_msg = call_chunk(i, chapters[i - 1], prev_summary)
+                        except Exception as client_error:
+                            self.reporter.error(f"Không thể khởi tạo {provider} client: {client_error}")
+                            return job_stats()
+                    else:
+                        response_text, error_msg = result
+                    if response_text is None and error_msg is None:
+                        # Bị dừng khi đang gọi API, phần này chưa có kết quả
+                        stop_message(i)
+                        break
+
+                    if error_msg:
+                        error_log = f"LỖI PHẦN {i}: {error_msg}"
+                        print(error_log)
+                        self.reporter.result(error_log, True)
+                        status_messages.append(f"Phần {i}/{total_parts}: Thất bại - {error_msg.splitlines()[0]}")
+                        fields = dict(source_fields(i), error=error_msg)
+                        try:
+                            self._append_record_text(result_file, dict(fields, index=i, status="error"), use_context)
+                        except Exception as write_err:
+                            print(f"Không thể ghi lỗi vào file: {write_err}")
+                            status_messages[-1] += " (Không ghi được file)"
+                        manifest.record(i, "error", **fields)
+                        failed_parts.append(i)
+                        self.metrics.part_finished()
+                        self.reporter.set_progress(i)
+                        self.reporter.completion("\n".join(status_messages) + f"\nKết quả đang lưu tại: {result_file}")
+                        continue
+
+                    # Tách bản dịch và tóm tắt theo mode đã chọn
+                    if use_context:
+                        with self.trace.span("parse", i):
+                            translation, summary = self.extract_translation_and_summary(response_text)
+                        if not summary and precomputed_summaries is not None:
+                            summary = precomputed_summaries[i - 1]
+                    else:
+                        translation, summary = response_text.strip(), ""
+                    if use_context:
+                        self.reporter.result(f"Kết quả xử lý phần {i}:\n{translation}\n\n---TÓM TẮT---\n{summary}", True)
+                    else:
+                        self.reporter.result(f"Kết quả xử lý phần {i}:\n{translation}", True)
+                    if i in ttfts:
+                        status_messages.append(f"Phần {i}/{total_parts}: Hoàn thành (TTFT {ttfts[i]:.1f}s).")
+                    else:
+                        status_messages.append(f"Phần {i}/{total_parts}: Hoàn thành.")
+                    # Ghi kết quả vào file (luôn theo đúng thứ tự phần)
+                    output = None
+                    with api_seconds_lock:
+                        call_fields = chunk_calls.pop(i, {})
+                        call_tokens["input"] += call_fields.get("input_tokens") or 0
+                        call_tokens["cached"] += call_fields.get("cached_tokens") or 0
+                    fields = dict(source_fields(i), translation=translation, summary=summary, **call_fields)
+                    with self.trace.span("write", i):
+                        try:
+                            output = self._append_record_text(result_file, dict(fields, index=i, status="done"), use_context)
+                        except Exception as write_err:
+                            print(f"Không thể ghi kết quả phần {i} vào file: {write_err}")
+                            status_messages[-1] = f"Phần {i}/{total_parts}: Hoàn thành (Lỗi ghi file)"
+                        # Checkpoint: ghi sau file kết quả để manifest không bao giờ đi trước dữ liệu
+                        manifest.record(i, "done", output=output, **fields)
+                    self.metrics.part_finished()
+                    self.reporter.set_progress(i)
+                    self.reporter.completion("\n".join(status_messages) + f"\nKết quả đang lưu tại: {result_file}")
+                    # Cập nhật tóm tắt cho chương sau chỉ khi dùng context
+                    if use_context:
+                        prev_summary = summary
+                        self.reporter.summary_updated(summary)
+                else:
+                    # Bộ song song trả về sớm khi bấm dừng giữa chừng
+                    if self.should_stop and next_part <= total_parts:
+                        stop_message(next_part)
+            finally:
+                results.close()
+
+            # Sau khi hoàn thành, sinh file tổng hợp chỉ bản dịch từ kho kết quả
+            result_file_no_summary = result_file.replace('.txt', '_no_summary.txt')
+            try:
+                manifest.write_text(result_file_no_summary, include_summary=False)
+            except Exception as write_err:
+                print(f"Không thể ghi file tổng hợp không tóm tắt: {write_err}")
+
+            final_status = "\n".join(status_messages)
+            if concurrency > 1 and not config.batch_mode:
+                final_status += "\n" + self.format_speedup(time.time() - job_start_time, api_seconds[0])
+            final_status += "\n" + self.key_scheduler.summary()
+            if self.shared is None:
+                final_status += "\n" + self.metrics.format_table()
+            final_status += f"\nCheckpoint để tiếp tục job: {manifest.path}"
+            final_status += f"\nTrace thời gian từng bước: {self.trace.path}"
+            if self.response_cache is not None:
+                final_status += "\n" + self.response_cache.summary()
+            final_status += "\n" + self.format_prompt_cache_summary(call_tokens["input"], call_tokens["cached"])
+            if ttfts:
+                ttft_values = sorted(ttfts.values())
+                final_status += (f"\nTTFT (thời gian tới token đầu tiên): trung bình {sum(ttft_values) / len(ttft_values):.1f}s, "
+                                 f"p95 {ttft_values[int(0.95 * (len(ttft_values) - 1))]:.1f}s.")
+            if chunk_seconds:
+                chunk_values = sorted(chunk_seconds)
+                final_status += (f"\nThời gian mỗi phần: p50 {chunk_values[int(0.5 * (len(chunk_values) - 1))]:.1f}s, "
+                                 f"p99 {chunk_values[int(0.99 * (len(chunk_values) - 1))]:.1f}s.")
+            if config.hedge_percentile:
+                final_status += "\n" + self.format_hedge_summary()
+            final_status += "\n" + self.format_timeout_summary(
+                provider, primary_model_name, estimate_tokens(self.build_translation_prompt(chapters[0], prev_summary)))
+            try:
+                os.rmdir(partial_dir) # Chỉ xóa được khi không còn phần nào lỗi
+            except OSError:
+                pass
+            if not self.should_stop:
+                final_status = "Hoàn thành xử lý tất cả các phần.\n" + final_status
+                self.reporter.progress("Đã xử lý xong!", True)
+            else:
+                final_status = "Xử lý bị dừng.\n" + final_status
+            self.reporter.completion(final_status + f"\nKết quả đầy đủ (hoặc chưa hoàn chỉnh) lưu tại: {result_file}")
+            return job_stats()
+
+        except FileNotFoundError as e:
+            self.reporter.error(f"Lỗi đường dẫn hoặc file: {str(e)}")
+        except Exception as e:
+            error_traceback = traceback.format_exc()
+            print(f"Lỗi nghiêm trọng trong TranslationEngine.run: {error_traceback}")
+            self.reporter.error(f"Lỗi không xác định trong quá trình xử lý: {str(e)}")
+            self.reporter.completion(f"Đã xảy ra lỗi nghiêm trọng: {str(e)}")
+        finally:
+            self._delete_context_caches()
+            self.trace.close()
+            if self.shared is None:
+                self.client_pool.close()
+                self.latency.save()
+        return None
+
+    def split_text(self, text):
+        try:
+            if isinstance(text, InputFile):
+                return self.split_input_file(text)
+            split_method = self.config.split_method
+            language = self.config.language
+            split_length = self.config.split_length # Đã kiểm tra trong JobConfig.validate()
+
+            if split_method == SPLIT_BY_CHAPTER:
+                # Sử dụng re.split để tách dựa trên CHAPTER_PATTERN, giữ lại delimiter
+                parts = re.split(f'({CHAPTER_PATTERN})', text, flags=re.IGNORECASE)
+
+                if len(parts) <= 1: # Không tìm thấy chương nào
+                    # Thử tìm các dấu hiệu xuống dòng kép làm phân tách nếu không có chương
+                    parts = re.split(BLANK_LINE_PATTERN, text)
+                    if len(parts) <= 1:
+                         self.reporter.error("Không tìm thấy định dạng chương (第X章/Chương X/Chapter X) hoặc ngắt đoạn bằng dòng trống. Văn bản sẽ được xử lý như một phần duy nhất.")
+                         return [text.strip()] # Trả về toàn bộ văn bản nếu không chia được
+                    else:
+                         # Tìm thấy ngắt đoạn, dùng chúng
+                         result = [p.strip() for p in parts if p.strip()]
+                         if not result:
+                              self.reporter.error("Văn bản trống sau khi chia theo dòng trống.")
+                              return None
+                         self.reporter.progress("Cảnh báo: Không tìm thấy chương, chia theo dòng trống.", False)
+                         return result
+
+                # Ghép lại phần tiêu đề chương với nội dung của nó
+                chapters = []
+                current_chapter_content = ""
+                if parts[0].strip(): # Phần text trước chương đầu tiên (nếu có)
+                    current_chapter_content += parts[0].strip() + "\n\n" # Thêm vào phần đầu
+
+                for i in range(1, len(parts), 2): # Bước nhảy 2 để lấy delimiter và nội dung sau nó
+                    delimiter = parts[i].strip()
+                    content = parts[i+1].strip()
+                    # Bắt đầu chương mới
+                    if current_chapter_content and delimiter: # Chỉ thêm nếu có nội dung chương trước đó
+                         chapters.append(current_chapter_content.strip())
+
+                    current_chapter_content = delimiter + "\n" + content # Bắt đầu chương mới với tiêu đề
+
+                # Thêm chương cuối cùng
+                if current_chapter_content.strip():
+                    chapters.append(current_chapter_content.strip())
+
+                if not chapters:
+                     self.reporter.error("Không trích xuất được nội dung chương nào.")
+                     return None
+
+                print(f"Đã chia thành {len(chapters)} chương.")
+                return chapters
+
+            elif split_method == SPLIT_BY_CHARS:
+                # Đã validate split_length ở đầu hàm
+                if language == "ENG":
+                    # Chia theo từ cho tiếng Anh
+                    return self.smart_split_by_words(text, split_length)
+                else: # Tiếng Trung, Việt hoặc khác - chia theo ký tự
+                    result = self.split_by_chars(text, split_length)
+                    if not result:
+                        self.reporter.error("Không thể chia văn bản theo số ký tự (kết quả rỗng).")
+                        return None
+                    print(f"Đã chia thành {len(result)} phần theo ký tự.")
+                    return result
+
+            elif split_method == SPLIT_BY_TOKENS:
+                max_tokens, calibration, chars_per_token = self._token_split_settings(text[:TOKEN_CALIBRATION_SAMPLE_CHARS])
+                result = self.split_by_tokens(text, max_tokens, calibration, chars_per_token)
+                if not result:
+                    self.reporter.error("Không thể chia văn bản theo token (kết quả rỗng).")
+                    return None
+                print(f"Đã chia thành {len(result)} phần theo token.")
+                return result
+
+            else:
+                raise ValueError("Phương thức chia văn bản không hợp lệ")
+        except Exception as e:
+            self.reporter.error(f"Lỗi nghiêm trọng khi chia văn bản: {str(e)}\n{traceback.format_exc()}")
+            return None # Trả về None khi có lỗi nghiêm trọng
+
+    def split_by_chars(self, text, max_chars):
+        """Chia text thành các phần tối đa max_chars ký tự, cắt ở dấu ngắt câu hoặc khoảng trắng.
+
+        Mỗi điểm cắt chỉ xét 100 ký tự cuối của phần nên thời gian tuyến tính theo số phần;
+        kết quả là TextChunks (khoảng vị trí), không sao chép văn bản.
+        """
+        ranges = []
+        start = 0
+        text_len = len(text)
+        while start < text_len:
+            end = min(start + max_chars, text_len)  # Không vượt quá độ dài văn bản
+            if end < text_len:
+                end = find_cut_position(text, start, end)
+            chunk_start, chunk_end = strip_range(text, start, end)
+            if chunk_start < chunk_end:  # Chỉ thêm nếu chunk không rỗng
+                ranges.append((chunk_start, chunk_end))
+            start = end
+        return TextChunks(text, ranges)
+
+    def token_budget(self):
+        """Số token văn bản gốc tối đa mỗi phần để bản dịch (và tóm tắt) vừa output của model
+        và cả request vừa context, chừa TOKEN_BUDGET_SAFETY."""
+        context_limit, output_limit = model_token_limits(self.config.model)
+        output_budget = output_limit * TOKEN_BUDGET_SAFETY
+        if self.config.use_context:
+            output_budget -= SUMMARY_TOKEN_RESERVE
+        by_output = output_budget / TRANSLATION_OUTPUT_RATIO
+        # Context chứa prompt, tóm tắt chương trước, văn bản gốc và bản dịch
+        overhead = estimate_tokens(self.config.prompt) + SUMMARY_TOKEN_RESERVE
+        by_context = (context_limit * TOKEN_BUDGET_SAFETY - overhead) / (1 + TRANSLATION_OUTPUT_RATIO)
+        return max(1, int(min(by_output, by_context)))
+
+    def calibrate_tokens(self, sample):
+        """Hệ số nhân để estimate_tokens khớp tokenizer của model.
+
+        Google có API count_tokens: đếm đoạn mẫu (đầu văn bản) rồi so với ước lượng cục bộ.
+        Các provider OpenAI-compatible không có API đếm token nên dùng ước lượng cục bộ (hệ số 1).
+        """
+        if self.config.provider != "Google":
+            return 1.0
+        try:
+            client = self.client_pool.get_client("Google", self.config.api_keys[0])
+            counted = client.models.count_tokens(model=self.config.model, contents=sample).total_tokens
+        except Exception as e:
+            print(f"Không đếm được token bằng API, dùng ước lượng cục bộ: {type(e).__name__} - {e}")
+            return 1.0
+        if not counted:
+            return 1.0
+        return round(counted / estimate_tokens(sample), 3)
+
+    def _token_split_settings(self, sample):
+        """(số token tối đa mỗi phần, hệ số hiệu chỉnh, số ký tự/token ước tính) cho chia "Theo token",
+        tính từ đoạn mẫu đầu văn bản."""
+        if self.config.token_calibration is None:
+            self.config.token_calibration = self.calibrate_tokens(sample)
+        calibration = self.config.token_calibration
+        max_tokens = self.config.split_length or self.token_budget()
+        self.reporter.progress(f"Chia theo token: tối đa {max_tokens} token mỗi phần "
+                               f"(hệ số hiệu chỉnh ước lượng x{calibration:.2f}).\n", False)
+        chars_per_token = len(sample) / max(1, estimate_tokens(sample) * calibration)
+        self.split_chars_per_token = chars_per_token # Ghi vào manifest để "Tiếp tục job" kiểm tra chia giống lần trước
+        return max_tokens, calibration, chars_per_token
+
+    def split_by_tokens(self, text, max_tokens, calibration=1.0, chars_per_token=4.0):
+        """Chia text thành các phần không quá max_tokens token (estimate_tokens x calibration),
+        cắt ở dấu ngắt câu hoặc khoảng trắng như khi chia theo ký tự. Trả về TextChunks.
+
+        chars_per_token: ước tính ban đầu để chọn độ dài phần, phần nào dày token hơn thì thu nhỏ lại.
+        """
+        ranges = []
+        start = 0
+        text_len = len(text)
+        while start < text_len:
+            size = max(1, int(max_tokens * chars_per_token))
+            while True:
+                end = min(start + size, text_len)
+                if end < text_len:
+                    end = find_cut_position(text, start, end)
+                tokens = estimate_tokens(text, start, end) * calibration
+                if tokens <= max_tokens or size <= 100:
+                    break
+                # Đoạn này dày token hơn trung bình (ví dụ nhiều chữ Hán): thu nhỏ theo tỉ lệ
+                size = max(100, int(size * max_tokens / tokens * 0.95))
+            chunk_start, chunk_end = strip_range(text, start, end)
+            if chunk_start < chunk_end:
+                ranges.append((chunk_start, chunk_end))
+            start = end
+        return TextChunks(text, ranges)
+
+    def split_input_file(self, source):
+        """split_text cho InputFile: đọc file theo từng khối, trả về FileChunks thay vì danh sách chuỗi.
+
+        Kết quả giống hệt split_text trên nội dung file (đã strip()). Riêng chia theo từ (ENG)
+        vẫn cần đọc cả văn bản vào bộ nhớ.
+        """
+        split_method = self.config.split_method
+        if split_method == SPLIT_BY_CHAPTER:
+            headings, has_text = source.scan(CHAPTER_PATTERN)
+            if headings:
+                # Phần trước chương đầu tiên (nếu có chữ) là một phần riêng, mỗi chương gồm tiêu đề + nội dung
+                chunks = [((0, headings[0][0]),)] if has_text[0] else []
+                for k, (start, end) in enumerate(headings):
+                    next_start = headings[k + 1][0] if k + 1 < len(headings) else source.size
+                    chunks.append(((start, end), (end, next_start)))
+                print(f"Đã chia thành {len(chunks)} chương.")
+                return FileChunks(source, chunks)
+            separators, has_text = source.scan(BLANK_LINE_PATTERN)
+            if not separators:
+                self.reporter.error("Không tìm thấy định dạng chương (第X章/Chương X/Chapter X) hoặc ngắt đoạn bằng dòng trống. Văn bản sẽ được xử lý như một phần duy nhất.")
+                return FileChunks(source, [((0, source.size),)])
+            edges = [0] + [edge for separator in separators for edge in separator] + [source.size]
+            chunks = [((edges[2 * k], edges[2 * k + 1]),) for k in range(len(separators) + 1) if has_text[k]]
+            if not chunks:
+                self.reporter.error("Văn bản trống sau khi chia theo dòng trống.")
+                return None
+            self.reporter.progress("Cảnh báo: Không tìm thấy chương, chia theo dòng trống.", False)
+            return FileChunks(source, chunks)
+        if split_method == SPLIT_BY_CHARS and self.config.language == "ENG":
+            return self.smart_split_by_words(source.read_text(), self.config.split_length)
+        if split_method == SPLIT_BY_CHARS:
+            ranges = source.iter_ranges(max_chars=self.config.split_length)
+        else:
+            max_tokens, calibration, chars_per_token = self._token_split_settings(source.preview(TOKEN_CALIBRATION_SAMPLE_CHARS))
+            ranges = source.iter_ranges(max_tokens=max_tokens, calibration=calibration, chars_per_token=chars_per_token)
+        chunks = [(byte_range,) for byte_range in ranges]
+        if not chunks:
+            self.reporter.error("Không thể chia văn bản (kết quả rỗng).")
+            return None
+        print(f"Đã chia thành {len(chunks)} phần {'theo ký tự' if split_method == SPLIT_BY_CHARS else 'theo token'}.")
+        return FileChunks(source, chunks)
+
+    def smart_split_by_words(self, text, max_words):
+        """
+        Splits text into chunks based on word count, respecting sentence boundaries.
+        """
+        # Cải thiện việc tách câu, hỗ trợ nhiều dấu câu hơn
+        sentences = re.split(r'(?<=[.!?…])\s+', text.replace('\n', ' ')) # Thay newline bằng space để split câu tốt hơn
+        chunks = []
+        current_chunk_sentences = []
+        current_word_count = 0
+
+        for sentence in sentences:
+            if not sentence.strip(): continue # Bỏ qua câu rỗng
+
+            words_in_sentence = len(sentence.split())
+
+            # Nếu một câu đã quá dài, chia nhỏ câu đó (trường hợp hiếm)
+            if words_in_sentence > max_words:
+                 print(f"Cảnh báo: Câu quá dài ({words_in_sentence} từ), sẽ bị chia nhỏ.")
+                 words = sentence.split()
+                 for i in range(0, len(words), max_words):
+                     sub_sentence = ' '.join(words[i:i+max_words])
+                     if sub_sentence:
+                         chunks.append(sub_sentence)
+                 # Đặt lại chunk hiện tại sau khi xử lý câu dài
+                 current_chunk_sentences = []
+                 current_word_count = 0
+                 continue # Chuyển sang câu tiếp theo
+
+            # Kiểm tra xem thêm câu này có vượt quá giới hạn không
+            if current_word_count + words_in_sentence <= max_words:
+                current_chunk_sentences.append(sentence)
+                current_word_count += words_in_sentence
+            else:
+                # Đóng chunk hiện tại và bắt đầu chunk mới
+                if current_chunk_sentences:
+                    chunks.append(' '.join(current_chunk_sentences).strip())
+                current_chunk_sentences = [sentence]
+                current_word_count = words_in_sentence
+
+        # Thêm chunk cuối cùng nếu còn
+        if current_chunk_sentences:
+            chunks.append(' '.join(current_chunk_sentences).strip())
+
+        if not chunks:
+             self.reporter.error("Không thể chia văn bản theo số từ (kết quả rỗng).")
+             return None
+        print(f"Đã chia thành {len(chunks)} phần theo từ.")
+        return chunks
+
+def find_input_files(pattern):
+    """Danh sách file đầu vào từ một file, một thư mục (các file .txt trong đó) hoặc một glob."""
+    if os.path.isdir(pattern):
+        return sorted(os.path.join(pattern, name) for name in os.listdir(pattern)
+                      if name.lower().endswith(".txt") and os.path.isfile(os.path.join(pattern, name)))
+    if os.path.isfile(pattern):
+        return [pattern]
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+class SharedResources:
+    """Scheduler API key, client pool, cache và giới hạn request đồng thời dùng chung cho cả batch.
+
+    Mọi file trong batch lấy key từ cùng một KeyScheduler nên rate limit của từng key
+    tính trên tổng số request; call_slots giữ tổng số request đang chạy không quá max_calls.
+    """
+
+    def __init__(self, provider, api_keys, max_calls, cache_dir=None):
+        self.key_scheduler = KeyScheduler(api_keys, PROVIDER_CONFIG.get(provider, {}).get("rate_limit"))
+        self.client_pool = ClientPool()
+        self.response_cache = None
+        if cache_dir:
+            self.response_cache = ResponseCache(cache_dir)
+            self.response_cache.evict()
+        self.call_slots = threading.BoundedSemaphore(max_calls)
+        self.latency = LatencyTracker.load(LATENCY_FILE)
+        self.metrics = JobMetrics()
+
+    def close(self):
+        self.client_pool.close()
+        self.latency.save()
+
+
+class BatchJobReporter(EngineReporter):
+    """Reporter của một file trong batch: chỉ báo số phần đã xong và lỗi lên reporter chung, kèm tên file."""
+
+    def __init__(self, parent, name):
+        super().__init__()
+        self.parent = parent
+        self.name = name
+        self.total_parts = 0
+        self.last_error = None
+
+    def progress(self, text, clear=False):
+        pass # Log từng request của nhiều file chạy cùng lúc sẽ lẫn vào nhau
+
+    def set_progress(self, value, maximum=None):
+        if maximum is not None:
+            self.total_parts = maximum
+        if value:
+            self.parent.progress(f"\n[{self.name}] {value}/{self.total_parts} phần", False)
+
+    def error(self, message):
+        self.last_error = message
+        self.parent.progress(f"\n[{self.name}] Lỗi: {message}", False)
+
+
+class BatchRunner:
+    """Chạy nhiều file đầu vào với cùng thiết lập, các file dùng chung một SharedResources.
+
+    Mỗi file có thư mục kết quả riêng trong batch_dir. Nếu thư mục đó đã có manifest của
+    đúng văn bản này (chạy lại một batch cũ), job được tiếp tục thay vì chạy lại từ đầu.
+    """
+
+    REPORT_NAME = "batch_report.txt"
+
+    def __init__(self, reporter=None):
+        self.reporter = reporter or EngineReporter()
+        self.should_stop = False
+        self.engines = set()
+        self.lock = threading.Lock()
+        self.metrics = JobMetrics() # Thay bằng SharedResources.metrics khi chạy
+
+    def stop(self):
+        with self.lock:
+            self.should_stop = True
+            engines = list(self.engines)
+        for engine in engines:
+            engine.stop()
+
+    @staticmethod
+    def job_names(input_files):
+        """Tên thư mục kết quả của từng file, thêm hậu tố khi trùng tên."""
+        names, used = [], set()
+        for path in input_files:
+            base = os.path.splitext(os.path.basename(path))[0] or "input"
+            name, n = base, 2
+            while name in used:
+                name, n = f"{base}_{n}", n + 1
+            used.add(name)
+            names.append(name)
+        return names
+
+    def job_config(self, base_config, text, job_dir):
+        """Thiết lập cho một file: tiếp tục manifest cũ trong job_dir nếu có, ngược lại dùng base_config."""
+        for manifest_path in sorted(glob.glob(os.path.join(job_dir, "*" + JobManifest.SUFFIX)), reverse=True):
+            try:
+                manifest = JobManifest.load(manifest_path)
+            except Exception as e:
+                print(f"Bỏ qua manifest lỗi {manifest_path}: {e}")
+                continue
+            if manifest.header["input_fingerprint"] == JobManifest.fingerprint(text):
+                return JobConfig.from_manifest(manifest, text, base_config.api_keys,
+                                               concurrency=base_config.concurrency, use_cache=base_config.use_cache,
+                                               hedge_percentile=base_config.hedge_percentile)
+        config = copy.copy(base_config)
+        config.text = text
+        config.results_dir = job_dir
+        config.resume_manifest = None
+        return config
+
+    def run(self, input_files, base_config, batch_dir, max_files=None):
+        """Xử lý input_files với thiết lập của base_config (bỏ qua base_config.text).
+
+        max_files: số file chạy cùng lúc (mặc định bằng số luồng song song). Trả về danh sách
+        kết quả từng file theo thứ tự input_files, None nếu thiết lập không hợp lệ.
+        """
+        errors = base_config.validate(require_text=False)
+        if errors:
+            self.reporter.error("\n".join(errors))
+            return None
+        max_files = max_files or base_config.concurrency
+        os.makedirs(batch_dir, exist_ok=True)
+        shared = SharedResources(base_config.provider, base_config.api_keys, base_config.concurrency,
+                                 os.path.join(base_config.results_dir, ".cache") if base_config.use_cache else None)
+        self.metrics = shared.metrics
+        names = self.job_names(input_files)
+        rows = [None] * len(input_files)
+        finished = 0
+        batch_start_time = time.time()
+        self.reporter.set_progress(0, len(input_files))
+        self.reporter.progress(f"Batch: {len(input_files)} file, tối đa {max_files} file cùng lúc, "
+                               f"{base_config.concurrency} request đồng thời.\nThư mục kết quả: {batch_dir}", True)
+
+        def run_one(index):
+            path, name = input_files[index], names[index]
+            row = {"input": path, "name": name, "status": "Chưa chạy (đã dừng)", "stats": None, "seconds": 0.0}
+            rows[index] = row
+            try:
+                # Đọc file theo từng khối khi chia, không nạp cả file; fingerprint để báo sớm file lỗi encoding
+                text = InputFile(path)
+                text.fingerprint()
+            except (OSError, UnicodeDecodeError) as e:
+                row["status"] = f"Không đọc được file: {e}"
+                return
+            engine = TranslationEngine(BatchJobReporter(self.reporter, name), shared)
+            with self.lock:
+                if self.should_stop:
+                    return
+                self.engines.add(engine)
+            job_start_time = time.time()
+            try:
+                stats = engine.run(self.job_config(base_config, text, os.path.join(batch_dir, name)))
+            finally:
+                with self.lock:
+                    self.engines.discard(engine)
+            row["seconds"] = time.time() - job_start_time
+            row["stats"] = stats
+            if stats is None:
+                row["status"] = f"Không chạy được: {engine.reporter.last_error or 'lỗi không xác định'}"
+            elif stats["stopped"] and stats["done"] < stats["total_parts"]:
+                row["status"] = "Đã dừng"
+            elif stats["failed"] or stats["done"] < stats["total_parts"]:
+                row["status"] = "Có phần lỗi"
+            else:
+                row["status"] = "Hoàn thành"
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_files) as executor:
+                futures = [executor.submit(run_one, index) for index in range(len(input_files))]
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        print(f"Lỗi khi xử lý file trong batch: {traceback.format_exc()}")
+                    finished += 1
+                    self.reporter.set_progress(finished)
+        finally:
+            shared.close()
+
+        report = self.format_report(rows, base_config, time.time() - batch_start_time, shared)
+        report_path = os.path.join(batch_dir, self.REPORT_NAME)
+        try:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                f.write(report + "\n")
+        except OSError as e:
+            print(f"Không thể ghi báo cáo batch: {e}")
+        self.reporter.progress("\nĐã xử lý xong batch!" if not self.should_stop else "\nBatch đã dừng.", False)
+        self.reporter.completion(report + f"\nBáo cáo lưu tại: {report_path}")
+        return rows
+
+    def format_report(self, rows, base_config, wall_seconds, shared):
+        completed = sum(1 for row in rows if row["status"] == "Hoàn thành")
+        lines = [
+            f"BÁO CÁO BATCH ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')})",
+            f"Provider: {base_config.provider}, model: {base_config.model}, {len(rows)} file, "
+            f"{completed} hoàn thành, {len(rows) - completed} chưa hoàn thành.",
+            f"Thời gian: {wall_seconds:.1f} giây.",
+            ""
+        ]
+        for number, row in enumerate(rows, 1):
+            stats = row["stats"]
+            line = f"{number}. {row['name']}: {row['status']}"
+            if stats is not None:
+                line += f" - {stats['done']}/{stats['total_parts']} phần xong, {stats['failed']} lỗi, {row['seconds']:.1f} giây"
+            lines.append(line)
+            lines.append(f"   Đầu vào: {row['input']}")
+            if stats is not None:
+                lines.append(f"   Kết quả: {stats['result_file']}")
+        lines.append("")
+        lines.append(shared.key_scheduler.summary())
+        lines.append(shared.metrics.format_table())
+        if shared.response_cache is not None:
+            lines.append(shared.response_cache.summary())
+        return "\n".join(lines)
+
+
+class ResultsBrowser:
+    """Cửa sổ duyệt các job trong ResultsIndex và xem kết quả từng trang.
+
+    Mỗi trang chỉ đọc RESULTS_PAGE_PARTS phần từ kho kết quả (JobManifest.iter_records seek thẳng
+    tới từng dòng); file kết quả cũ không có manifest được đọc RESULTS_PAGE_BYTES byte mỗi trang.
+    Không bao giờ nạp cả file kết quả vào ô Text.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.jobs = []
+        self.job = None
+        self.manifest = None
+        self.page = 0
+        self.page_count = 0
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("Duyệt kết quả")
+        self.window.geometry("900x700")
+
+        columns = ("created", "model", "parts", "status", "file")
+        headings = ("Thời gian", "Model", "Phần xong", "Trạng thái", "File kết quả")
+        jobs_frame = ttk.Frame(self.window, padding="5")
+        jobs_frame.pack(fill="x")
+        self.jobs_tree = ttk.Treeview(jobs_frame, columns=columns, show="headings", height=8, selectmode="browse")
+        for column, heading in zip(columns, headings):
+            self.jobs_tree.heading(column, text=heading)
+            self.jobs_tree.column(column, width={"created": 150, "model": 180, "file": 330}.get(column, 90), anchor="w")
+        jobs_scrollbar = ttk.Scrollbar(jobs_frame, orient="vertical", command=self.jobs_tree.yview)
+        self.jobs_tree.configure(yscrollcommand=jobs_scrollbar.set)
+        self.jobs_tree.pack(side="left", fill="x", expand=True)
+        jobs_scrollbar.pack(side="right", fill="y")
+        self.jobs_tree.bind("<<TreeviewSelect>>", lambda event: self.open_selected())
+
+        button_row = ttk.Frame(self.window, padding="5")
+        button_row.pack(fill="x")
+        ttk.Button(button_row, text="Làm mới", command=self.refresh).pack(side="left", padx=5)
+        ttk.Button(button_row, text="< Trang trước", command=lambda: self.show_page(self.page - 1)).pack(side="left", padx=5)
+        ttk.Button(button_row, text="Trang sau >", command=lambda: self.show_page(self.page + 1)).pack(side="left", padx=5)
+        ttk.Button(button_row, text="Export PDF",
+                   command=lambda: self.job and app.export_to_pdf(self.job["result_file"])).pack(side="left", padx=5)
+        ttk.Button(button_row, text="Export Word",
+                   command=lambda: self.job and app.export_to_word(self.job["result_file"])).pack(side="left", padx=5)
+        self.page_label = ttk.Label(button_row, text="", anchor="w")
+        self.page_label.pack(side="left", fill="x", expand=True, padx=5)
+
+        text_frame = ttk.Frame(self.window, padding="5")
+        text_frame.pack(fill="both", expand=True)
+        self.text = app.create_text_widget(text_frame, height=20)
+        self.refresh()
+
+    def refresh(self):
+        """Đọc lại index và chọn job mới nhất."""
+        self.jobs = ResultsIndex().jobs()
+        self.jobs_tree.delete(*self.jobs_tree.get_children())
+        for position, job in enumerate(self.jobs):
+            total = job.get("total_parts")
+            parts = "-" if total is None else f"{job.get('done', '?')}/{total}"
+            if job.get("failed"):
+                parts += f" ({job['failed']} lỗi)"
+            self.jobs_tree.insert("", tk.END, iid=str(position), values=(
+                job.get("created", ""), job.get("model") or "", parts, job.get("status", ""),
+                os.path.basename(job["result_file"])))
+        if self.jobs:
+            self.jobs_tree.selection_set("0")
+        else:
+            self.set_text("Chưa có job nào trong thư mục kết quả.")
+
+    def open_selected(self):
+        selection = self.jobs_tree.selection()
+        if not selection:
+            return
+        self.job = self.jobs[int(selection[0])]
+        self.manifest = None
+        manifest_path = self.job.get("manifest")
+        try:
+            if manifest_path and os.path.exists(manifest_path):
+                self.manifest = JobManifest.load(manifest_path)
+                total = max([self.manifest.header.get("total_parts") or 0] + list(self.manifest.records))
+                self.page_count = max(1, -(-total // RESULTS_PAGE_PARTS))
+            else:
+                self.page_count = max(1, -(-os.path.getsize(self.job["result_file"]) // RESULTS_PAGE_BYTES))
+        except (OSError, ValueError) as e:
+            self.page_count = 0
+            self.page_label.config(text="")
+            self.set_text(f"Không mở được job: {e}")
+            return
+        self.show_page(0)
+
+    def show_page(self, page):
+        if self.job is None or not 0 <= page < self.page_count:
+            return
+        self.page = page
+        try:
+            if self.manifest is not None:
+                text, description = self.read_parts_page(page)
+            else:
+                text, description = self.read_bytes_page(page)
+        except (OSError, ValueError) as e:
+            text, description = f"Lỗi đọc kết quả: {e}", ""
+        self.page_label.config(text=f"Trang {page + 1}/{self.page_count} {description}")
+        self.set_text(text)
+
+    def read_parts_page(self, page):
+        first = page * RESULTS_PAGE_PARTS + 1
+        last = first + RESULTS_PAGE_PARTS - 1
+        total = self.manifest.header.get("total_parts") or last
+        last = min(last, max(total, first))
+        use_context = self.manifest.header.get("context_mode") == MODE_WITH_CONTEXT
+        records = {record["index"]: record for record in self.manifest.iter_records(range(first, last + 1))}
+        blocks = []
+        for index in range(first, last + 1):
+            record = records.get(index)
+            if record is None:
+                blocks.append(f"===== Phần {index}: chưa xử lý =====\n\n")
+                continue
+            details = [record["status"]]
+            if record.get("model"):
+                details.append(record["model"] + (" (cache)" if record.get("cached") else ""))
+            if record.get("key"):
+                details.append(f"key {record['key']}")
+            if record.get("latency") is not None:
+                details.append(f"{record['latency']:.1f}s")
+            if record.get("output_tokens"):
+                details.append(f"{record.get('input_tokens') or '?'}/{record['output_tokens']} token"
+                               + (f" ({record['cached_tokens']} từ cache prefix)" if record.get("cached_tokens") else ""))
+            blocks.append(f"===== Phần {index} ({', '.join(details)}) =====\n"
+                          + JobManifest.format_record(record, use_context))
+        return "".join(blocks), f"(phần {first}-{last}/{total})"
+
+    def read_bytes_page(self, page):
+        with open(self.job["result_file"], 'rb') as f:
+            f.seek(page * RESULTS_PAGE_BYTES)
+            data = f.read(RESULTS_PAGE_BYTES)
+        # Ký tự bị cắt ở biên trang bị bỏ qua; file cũ không có manifest nên không biết ranh giới các phần
+        return data.decode('utf-8', errors='ignore'), "(file kết quả không có manifest)"
+
+    def set_text(self, text):
+        self.text.delete("1.0", tk.END)
+        self.text.insert(tk.END, text)
+        self.text.see("1.0")
+
+
+class GeminiInterface:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("Gemini Pro v6 API Interface (with Retry)") # Cập nhật title
+        self.root.geometry("800x900")
+
+        self.root.option_add('*Font', ('Arial', 12))
+        if os.name == 'nt':
+            self.root.option_add('*Dialog.msg.font', ('Arial', 12))
+
+        self.processing = False
+        self.queue = UiUpdateQueue()
+        self.api_key = None  # Single API key (legacy)
+        self.input_file = None # InputFile khi chọn "Mở file văn bản...", ô nhập văn bản chỉ hiện phần đầu file
+        self.api_keys = []   # List of API keys for round robin
+        self.api_key_index = 0  # Current index for round robin
+        self.engine = TranslationEngine(TkReporter(self)) # Tạo mới cho mỗi job (BatchRunner khi chạy hàng loạt)
+        self.resume_manifest = None # JobManifest khi bấm "Tiếp tục job"
+        self.provider_var = tk.StringVar(value=DEFAULT_PROVIDER)
+
+        self.create_menu_export() # Thêm menu Export phía trên cùng
+        self.create_main_frame()
+        self.create_widgets()
+        self.setup_periodic_queue_check()
+        self.root.after(METRICS_REFRESH_MS, self.refresh_metrics)
+    def create_menu_export(self):
+        menubar = tk.Menu(self.root)
+        export_menu = tk.Menu(menubar, tearoff=0)
+        export_menu.add_command(label="Export to PDF", command=self.export_to_pdf)
+        export_menu.add_command(label="Export to Word", command=self.export_to_word)
+        export_menu.add_command(label="Export trace (Chrome/Perfetto)", command=self.export_trace)
+        menubar.add_cascade(label="Export", menu=export_menu)
+        self.root.config(menu=menubar)
+
+    def export_to_pdf(self, source_path=None):
+        try:
+            import reportlab # noqa: F401
+        except ImportError:
+            messagebox.showerror("Thiếu thư viện", "Vui lòng cài đặt reportlab: pip install reportlab")
+            return
+        self.start_export(".pdf", [("PDF files", "*.pdf"), ("All files", "*.*")], source_path)
+
+    def export_trace(self):
+        """Chuyển trace JSONL của một job sang file mở được bằng chrome://tracing hoặc Perfetto."""
+        trace_path = filedialog.askopenfilename(
+            title="Chọn trace của job",
+            initialdir=RESULTS_DIR if os.path.exists(RESULTS_DIR) else os.path.expanduser("~"),
+            filetypes=[("Job trace", "*.trace.jsonl"), ("All files", "*.*")]
+        )
+        if not trace_path:
+            return
+        try:
+            output_path = export_chrome_trace(trace_path)
+        except (OSError, ValueError) as e:
+            self.show_error(f"Không thể xuất trace: {str(e)}")
+            return
+        messagebox.showinfo("Xuất trace", f"Đã lưu: {output_path}\nMở bằng chrome://tracing hoặc https://ui.perfetto.dev")
+
+    def export_to_word(self, source_path=None):
+        try:
+            import docx # noqa: F401
+        except ImportError:
+            messagebox.showerror("Thiếu thư viện", "Vui lòng cài đặt python-docx: pip install python-docx")
+            return
+        self.start_export(".docx", [("Word files", "*.docx")], source_path)
+
+    def choose_result_file(self):
+        """Hỏi file kết quả cần export, mặc định chọn sẵn file của job mới nhất trong ResultsIndex."""
+        initial_dir, initial_file = os.path.expanduser("~"), ""
+        if os.path.isdir(RESULTS_DIR):
+            initial_dir = RESULTS_DIR
+        jobs = ResultsIndex().jobs()
+        if jobs:
+            initial_dir, initial_file = os.path.split(jobs[0]["result_file"])
+        return filedialog.askopenfilename(
+            title="Chọn file kết quả cần export",
+            initialdir=initial_dir,
+            initialfile=initial_file,
+            filetypes=[("Kết quả", "*.txt"), ("All files", "*.*")]
+        )
+
+    def start_export(self, extension, filetypes, source_path=None):
+        """Export một file kết quả (hỏi file nếu source_path None) ở luồng nền, hiện cửa sổ tiến độ có nút Hủy."""
+        source_path = source_path or self.choose_result_file()
+        if not source_path:
+            return
+        try:
+            source_size = os.path.getsize(source_path)
+        except OSError as e:
+            messagebox.showerror("Lỗi đọc file", f"Không thể đọc file kết quả: {str(e)}")
+            return
+        if not source_size:
+            messagebox.showwarning("Không có dữ liệu", "File kết quả rỗng.")
+            return
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=extension,
+            filetypes=filetypes,
+            initialdir=os.path.dirname(source_path),
+            initialfile=os.path.splitext(os.path.basename(source_path))[0] + extension,
+            title="Chọn nơi lưu file"
+        )
+        if not file_path:
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Đang export")
+        dialog.transient(self.root)
+        ttk.Label(dialog, text=f"{os.path.basename(source_path)} -> {os.path.basename(file_path)}").pack(padx=10, pady=(10, 5))
+        bar = ttk.Progressbar(dialog, orient="horizontal", length=320, mode="determinate", maximum=100)
+        bar.pack(padx=10, pady=5)
+        status = ttk.Label(dialog, text="0%")
+        status.pack(padx=10)
+        state_key = f"export:{file_path}" # Tiến độ và kết thúc dùng chung key: mỗi chu kỳ chỉ chạy cái mới nhất
+
+        def on_progress(done, total):
+            percent = done * 100 / total if total else 100
+            self.queue.set_state(state_key, lambda: (bar.configure(value=percent), status.configure(text=f"{percent:.0f}%")))
+
+        exporter = ResultExporter(source_path, file_path, on_progress)
+
+        def cancel():
+            exporter.cancel()
+            status.configure(text="Đang hủy...")
+
+        ttk.Button(dialog, text="Hủy", command=cancel).pack(pady=10)
+        dialog.protocol("WM_DELETE_WINDOW", cancel)
+
+        def finish(completed, error):
+            dialog.destroy()
+            if error is not None:
+                messagebox.showerror("Lỗi", f"Lỗi khi export: {error}")
+            elif completed:
+                messagebox.showinfo("Thành công", f"Đã export: {file_path}")
+            else:
+                messagebox.showinfo("Đã hủy", "Đã hủy export.")
+
+        def worker():
+            completed, error = False, None
+            try:
+                completed = exporter.export()
+            except Exception as e:
+                error = str(e)
+            self.queue.set_state(state_key, lambda: finish(completed, error))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def create_main_frame(self):
+        self.main_canvas = tk.Canvas(self.root)
+        self.scrollbar = ttk.Scrollbar(self.root, orient="vertical",
+                                     command=self.main_canvas.yview)
+        self.scrollable_frame = ttk.Frame(self.main_canvas)
+
+        self.scrollable_frame.bind(
+            "<Configure>",
+            lambda e: self.main_canvas.configure(scrollregion=self.main_canvas.bbox("all"))
+        )
+
+        self.main_canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
+        self.main_canvas.configure(yscrollcommand=self.scrollbar.set)
+
+        self.main_canvas.bind_all("<MouseWheel>",
+                                lambda e: self.main_canvas.yview_scroll(
+                                    int(-1*(e.delta/120)), "units"))
+
+        self.scrollbar.pack(side="right", fill="y")
+        self.main_canvas.pack(side="left", fill="both", expand=True)
+
+    def create_text_widget(self, parent, height=4):
+        text_widget = tk.Text(parent, height=height, font=('Arial', 12),
+                            wrap=tk.WORD)
+        scrollbar = ttk.Scrollbar(parent, orient="vertical", command=text_widget.yview)
+        text_widget.configure(yscrollcommand=scrollbar.set)
+        text_widget.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+        return text_widget
+
+    def create_widgets(self):
+        main_container = ttk.Frame(self.scrollable_frame, padding="10")
+        main_container.pack(fill="both", expand=True)
+
+        # Language & provider selection (row layout, fixed width)
+        lang_frame = ttk.LabelFrame(main_container, text="Chọn ngôn ngữ / Provider", padding="5")
+        lang_frame.pack(fill="x", pady=5)
+        lang_provider_frame = ttk.Frame(lang_frame)
+        lang_provider_frame.pack(fill="x")
+        self.language = ttk.Combobox(lang_provider_frame, values=["中文", "ENG", "Việt Nam"],
+                                   font=('Arial', 12), state="readonly", width=10)
+        self.language.set("中文")
+        self.language.pack(side="left", padx=(0, 5))
+        self.language.bind("<<ComboboxSelected>>", self.on_language_change)
+        self.provider_combo = ttk.Combobox(
+            lang_provider_frame,
+            textvariable=self.provider_var,
+            values=list(PROVIDER_CONFIG.keys()),
+            font=('Arial', 12),
+            state="readonly",
+            width=12
+        )
+        self.provider_combo.pack(side="left", padx=(0, 5))
+        self.provider_combo.bind("<<ComboboxSelected>>", self.on_provider_change)
+
+        # Model selection (row layout, fixed width)
+        model_frame = ttk.LabelFrame(main_container, text="Chọn model chính", padding="5")
+        model_frame.pack(fill="x", pady=5)
+        model_row = ttk.Frame(model_frame)
+        model_row.pack(fill="x")
+        self.model = ttk.Combobox(model_row, values=[], font=('Arial', 12), state="readonly", width=22)
+        self.update_model_options(self.provider_var.get())
+        self.model.pack(side="left", padx=(0, 5))
+
+        # API Key Frame (row layout, fixed width)
+        api_frame = ttk.LabelFrame(main_container, text="API Key", padding="5")
+        api_frame.pack(fill="x", pady=5)
+        api_row = ttk.Frame(api_frame)
+        api_row.pack(fill="x")
+        self.api_key_label = ttk.Label(api_row, text="Chưa có API Key nào được chọn", font=('Arial', 12), width=32, anchor="w")
+        self.api_key_label.pack(side="left", padx=(0, 5))
+        self.browse_api_key_button = ttk.Button(api_row, text="Chọn File API Key", command=self.browse_api_key_file, width=18)
+        self.browse_api_key_button.pack(side="left")
+
+        # Split method & length (row layout, fixed width)
+        split_row = ttk.Frame(main_container)
+        split_row.pack(fill="x", pady=5)
+        split_frame = ttk.LabelFrame(split_row, text="Phương thức chia văn bản", padding="5")
+        split_frame.pack(side="left", padx=(0, 5))
+        self.split_method = ttk.Combobox(split_frame,
+                    values=SPLIT_METHODS,
+                    font=('Arial', 12), width=20, state="readonly")
+        self.split_method.set(SPLIT_BY_CHAPTER)
+        self.split_method.pack()
+
+        split_length_frame = ttk.LabelFrame(split_row, text="Số ký tự/từ/token mỗi phần", padding="5")
+        split_length_frame.pack(side="left")
+        self.split_length_entry = ttk.Entry(split_length_frame, font=('Arial', 12), width=10)
+        self.split_length_entry.pack()
+        self.split_length_entry.insert(0, "10000")
+
+        concurrency_frame = ttk.LabelFrame(split_row, text="Số luồng song song", padding="5")
+        concurrency_frame.pack(side="left", padx=(5, 0))
+        self.concurrency_entry = ttk.Entry(concurrency_frame, font=('Arial', 12), width=6)
+        self.concurrency_entry.pack()
+        self.concurrency_entry.insert(0, str(DEFAULT_CONCURRENCY))
+
+        hedge_frame = ttk.LabelFrame(split_row, text="Hedging p (0 = tắt)", padding="5")
+        hedge_frame.pack(side="left", padx=(5, 0))
+        self.hedge_entry = ttk.Entry(hedge_frame, font=('Arial', 12), width=6)
+        self.hedge_entry.pack()
+        self.hedge_entry.insert(0, "0")
+
+        # Progress bar
+        self.progress_bar = ttk.Progressbar(main_container, orient="horizontal",
+                                          mode="determinate")
+        self.progress_bar.pack(fill="x", pady=5)
+
+        # Thống kê trực tiếp theo provider/model/key, cập nhật mỗi METRICS_REFRESH_MS
+        metrics_frame = ttk.LabelFrame(main_container, text="Thống kê", padding="5")
+        metrics_frame.pack(fill="x", pady=5)
+        self.metrics_label = ttk.Label(metrics_frame, text="Chưa chạy job", anchor="w")
+        self.metrics_label.pack(fill="x")
+        columns = ("provider", "model", "key", "in_flight", "success", "failure", "p50", "p95", "input_tps", "output_tps", "cache_hits")
+        headings = ("Provider", "Model", "Key", "Đang chạy", "OK", "Lỗi", "p50 (s)", "p95 (s)", "Token vào/s", "Token ra/s", "Cache")
+        self.metrics_tree = ttk.Treeview(metrics_frame, columns=columns, show="headings", height=4)
+        for column, heading in zip(columns, headings):
+            self.metrics_tree.heading(column, text=heading)
+            self.metrics_tree.column(column, width={"provider": 90, "model": 180}.get(column, 65),
+                                     anchor="w" if column in ("provider", "model", "key") else "e")
+        self.metrics_tree.pack(fill="x")
+
+        mode_frame = ttk.LabelFrame(main_container, text="Chọn phiên bản", padding="5")
+        mode_frame.pack(fill="x", pady=5)
+        self.context_mode = tk.StringVar(value=MODE_WITH_CONTEXT)
+        ttk.Radiobutton(
+            mode_frame,
+            text="1. With previous context",
+            variable=self.context_mode,
+            value=MODE_WITH_CONTEXT,
+            command=self.on_context_mode_change
+        ).pack(anchor="w")
+        ttk.Radiobutton(
+            mode_frame,
+            text="2. Without previous context",
+            variable=self.context_mode,
+            value=MODE_WITHOUT_CONTEXT,
+            command=self.on_context_mode_change
+        ).pack(anchor="w")
+        # Chế độ 2 pha: tóm tắt song song bằng model rẻ, sau đó dịch song song
+        self.two_phase_var = tk.BooleanVar(value=False)
+        self.two_phase_check = ttk.Checkbutton(
+            mode_frame,
+            text="Tóm tắt trước song song rồi dịch song song (2 pha, cho phiên bản 1)",
+            variable=self.two_phase_var
+        )
+        self.two_phase_check.pack(anchor="w")
+        self.batch_var = tk.BooleanVar(value=False)
+        self.batch_check = ttk.Checkbutton(
+            mode_frame,
+            text="Gửi qua Batch API của provider (rẻ hơn, kết quả về chậm; cho phiên bản 2)",
+            variable=self.batch_var
+        )
+        self.batch_check.pack(anchor="w")
+        self.use_cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(
+            mode_frame,
+            text="Dùng cache kết quả (chạy lại không tốn quota cho phần đã dịch)",
+            variable=self.use_cache_var
+        ).pack(anchor="w")
+
+        # Prompt input + context input
+        prompt_context_frame = ttk.Frame(main_container)
+        prompt_context_frame.pack(fill="x", pady=5)
+
+        prompt_frame = ttk.LabelFrame(prompt_context_frame, text="Nhập prompt", padding="5")
+        prompt_frame.pack(side="left", fill="both", expand=True)
+        self.prompt_text = self.create_text_widget(prompt_frame, height=4)
+
+        context_frame = ttk.LabelFrame(prompt_context_frame, text="Bối cảnh chương trước (tóm tắt)", padding="5")
+        context_frame.pack(side="left", fill="both", expand=True, padx=5)
+        self.prev_summary_text = self.create_text_widget(context_frame, height=4)
+        self.prev_summary_text.insert("1.0", "")
+        self.on_context_mode_change()
+
+        # Additional text input
+        additional_frame = ttk.LabelFrame(main_container,
+                                        text="Nhập văn bản cần xử lý", # Sửa label
+                                        padding="5")
+        additional_frame.pack(fill="x", pady=5)
+        # File lớn: đọc thẳng từ đĩa khi chia/gửi, không nạp vào ô nhập
+        input_file_row = ttk.Frame(additional_frame)
+        input_file_row.pack(fill="x", pady=(0, 5))
+        ttk.Button(input_file_row, text="Mở file văn bản...", command=self.open_input_file).pack(side="left")
+        ttk.Button(input_file_row, text="Bỏ file", command=self.clear_input_file).pack(side="left", padx=5)
+        self.input_file_label = ttk.Label(input_file_row, text="Chưa mở file (dán văn bản vào ô dưới)", anchor="w")
+        self.input_file_label.pack(side="left", fill="x", expand=True)
+        self.additional_text = self.create_text_widget(additional_frame, height=10) # Tăng chiều cao
+
+        # Buttons
+        button_frame = ttk.Frame(main_container)
+        button_frame.pack(fill="x", pady=10)
+        self.submit_button = ttk.Button(button_frame, text="Gửi yêu cầu",
+                                      command=self.start_processing)
+        self.submit_button.pack(side=tk.LEFT, padx=5)
+        self.stop_button = ttk.Button(button_frame, text="Dừng",
+                                    command=self.stop_processing, state='disabled') # Bắt đầu ở trạng thái disabled
+        self.stop_button.pack(side=tk.LEFT, padx=5)
+        self.load_button = ttk.Button(button_frame, text="Duyệt kết quả",
+                                    command=self.load_results)
+        self.load_button.pack(side=tk.LEFT, padx=5)
+        self.resume_button = ttk.Button(button_frame, text="Tiếp tục job",
+                                    command=self.resume_job)
+        self.resume_button.pack(side=tk.LEFT, padx=5)
+        self.batch_button = ttk.Button(button_frame, text="Xử lý hàng loạt",
+                                    command=self.start_batch)
+        self.batch_button.pack(side=tk.LEFT, padx=5)
+
+        # Progress display
+        progress_frame = ttk.LabelFrame(main_container, text="Tiến trình xử lý hiện tại",
+                                      padding="5")
+        progress_frame.pack(fill="x", pady=5)
+        self.progress_text = self.create_text_widget(progress_frame, height=2)
+
+        # Current result display
+        result_frame = ttk.LabelFrame(main_container, text="Kết quả xử lý phần hiện tại",
+                                    padding="5")
+        result_frame.pack(fill="x", pady=5)
+        self.result_text = self.create_text_widget(result_frame, height=4)
+
+        # Completion status
+        completion_frame = ttk.LabelFrame(main_container, text="Kết quả cuối cùng và trạng thái", # Sửa label
+                                        padding="5")
+        completion_frame.pack(fill="x", pady=5)
+        self.completion_text = self.create_text_widget(completion_frame, height=4) # Tăng chiều cao
+
+    def on_context_mode_change(self):
+        use_context = self.context_mode.get() == MODE_WITH_CONTEXT
+        state = "normal" if use_context else "disabled"
+        self.prev_summary_text.configure(state=state)
+        self.two_phase_check.configure(state=state)
+        self.batch_check.configure(state="disabled" if use_context else "normal")
+
+    def on_language_change(self, event):
+        """Update label when language changes."""
+        language = self.language.get()
+        if language == "ENG":
+            self.split_length_label.config(text="Số từ mỗi phần:")
+        elif language in ["中文", "Việt Nam"]:
+            self.split_length_label.config(text="Số ký tự mỗi phần:")
+        else:
+            self.split_length_label.config(text="Số ký tự/số từ mỗi phần:")
+
+    def on_provider_change(self, event):
+        """Refresh model list when provider changes."""
+        self.update_model_options()
+
+    def update_model_options(self, provider=None):
+        """Update model combobox based on selected provider."""
+        provider = provider or self.provider_var.get()
+        config = PROVIDER_CONFIG.get(provider, {})
+        models = config.get("models", [])
+        self.model["values"] = models
+        default_model = PROVIDER_DEFAULT_MODELS.get(provider)
+        if default_model in models:
+            self.model.set(default_model)
+        elif models:
+            self.model.set(models[0])
+        else:
+            self.model.set("")
+
+    def setup_periodic_queue_check(self):
+        def check_queue():
+            try:
+                # Mỗi ô chỉ được cập nhật một lần mỗi chu kỳ dù có bao nhiêu thông báo
+                updates, states = self.queue.drain()
+                for widget, clear, text in updates:
+                    if clear:
+                        widget.delete("1.0", tk.END)
+                    widget.insert(tk.END, text)
+                    # Giữ tối đa UI_LOG_MAX_LINES dòng cuối để ô log không phình theo độ dài job
+                    line_count = int(widget.index("end-1c").split(".")[0])
+                    if line_count > UI_LOG_MAX_LINES:
+                        widget.delete("1.0", f"{line_count - UI_LOG_MAX_LINES + 1}.0")
+                    widget.see(tk.END) # Auto scroll to bottom
+                for update_state in states:
+                    update_state()
+            except Exception as e:
+                print(f"Lỗi UI update: {e}") # Log lỗi UI
+            finally:
+                self.root.after(UI_UPDATE_INTERVAL_MS, check_queue)
+        self.root.after(UI_UPDATE_INTERVAL_MS, check_queue)
+
+    def refresh_metrics(self):
+        """Vẽ lại bảng thống kê từ JobMetrics của engine đang chạy (hoặc vừa chạy xong)."""
+        try:
+            metrics = self.engine.metrics
+            if metrics.total_parts:
+                self.metrics_label.config(text=metrics.format_progress())
+            rows = metrics.snapshot()
+            self.metrics_tree.delete(*self.metrics_tree.get_children())
+            for row in rows:
+                self.metrics_tree.insert("", tk.END, values=(
+                    row["provider"], row["model"], row["key"], row["in_flight"], row["success"], row["failure"],
+                    "-" if row["p50"] is None else f"{row['p50']:.1f}",
+                    "-" if row["p95"] is None else f"{row['p95']:.1f}",
+                    f"{row['input_tps']:.0f}", f"{row['output_tps']:.0f}", row["cache_hits"]))
+        except Exception as e:
+            print(f"Lỗi cập nhật thống kê: {e}")
+        finally:
+            self.root.after(METRICS_REFRESH_MS, self.refresh_metrics)
+
+    def update_ui(self, widget, message, clear=True):
+        # Hàm này có thể không cần thiết nữa vì logic đã chuyển vào check_queue
+        # Nhưng vẫn giữ lại nếu có chỗ khác dùng
+        self.queue.put((widget, message, clear))
+
+    def show_error(self, message):
+        # Hiển thị lỗi trên result_text và messagebox
+        self.queue.put((self.result_text, f"Lỗi: {message}\n", True))
+        messagebox.showerror("Lỗi", message)
+
+    def browse_api_key_file(self):
+        """Open file dialog to select API key file."""
+        file_path = filedialog.askopenfilename(
+            title="Chọn File API Key",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+        )
+        if file_path:
+            try:
+                keys = load_api_keys(file_path)
+                if not keys:
+                    self.api_key_label.config(text="File API Key không chứa key hợp lệ")
+                    self.api_key = None
+                    self.api_keys = []
+                else:
+                    self.api_key = keys[0]
+                    self.api_keys = keys
+                    self.api_key_index = 0
+                    self.api_key_label.config(text=f"Đã tải {len(keys)} API Key từ: {os.path.basename(file_path)}")
+            except Exception as e:
+                self.api_key_label.config(text=f"Lỗi đọc file API Key: {str(e)}")
+                self.api_key = None
+                self.api_keys = []
+
+    def open_input_file(self):
+        """Chọn file văn bản (UTF-8) để xử lý trực tiếp từ đĩa; ô nhập chỉ hiển thị INPUT_PREVIEW_CHARS ký tự đầu."""
+        file_path = filedialog.askopenfilename(
+            title="Chọn file văn bản cần xử lý",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+        )
+        if not file_path:
+            return
+        try:
+            input_file = InputFile(file_path)
+            input_file.fingerprint() # Đọc thử cả file một lượt để báo lỗi encoding ngay
+            preview = input_file.preview()
+        except (OSError, UnicodeDecodeError) as e:
+            self.show_error(f"Không đọc được file văn bản: {str(e)}")
+            return
+        self.input_file = input_file
+        self.input_file_label.config(text=f"{os.path.basename(file_path)}: {len(input_file):,} ký tự (đọc từ file, ô dưới chỉ xem trước)")
+        self.additional_text.configure(state="normal")
+        self.additional_text.delete("1.0", tk.END)
+        self.additional_text.insert("1.0", preview + ("\n..." if len(preview) < len(input_file) else ""))
+        self.additional_text.configure(state="disabled")
+
+    def clear_input_file(self):
+        """Bỏ file đang mở, quay lại dán văn bản vào ô nhập."""
+        self.input_file = None
+        self.input_file_label.config(text="Chưa mở file (dán văn bản vào ô dưới)")
+        self.additional_text.configure(state="normal")
+        self.additional_text.delete("1.0", tk.END)
+
+    def validate_inputs(self, require_text=True):
+        errors = []
+
+        if self.split_method.get() in (SPLIT_BY_CHARS, SPLIT_BY_TOKENS):
+            try:
+                int(self.split_length_entry.get())
+            except ValueError:
+                errors.append("Số ký tự/số từ/số token không hợp lệ")
+
+        try:
+            int(self.concurrency_entry.get())
+        except ValueError:
+            errors.append("Số luồng song song không hợp lệ")
+
+        try:
+            float(self.hedge_entry.get())
+        except ValueError:
+            errors.append("Percentile hedging không hợp lệ")
+
+        if errors:
+            return errors
+        return self.build_job_config().validate(require_text)
+
+    def build_job_config(self):
+        """Đọc thiết lập từ các widget (trên luồng giao diện) thành JobConfig cho engine."""
+        try:
+            split_length = int(self.split_length_entry.get())
+        except ValueError:
+            split_length = 0 # Chỉ dùng khi chia theo số ký tự/token, đã validate ở trên
+        use_context = self.context_mode.get() == MODE_WITH_CONTEXT
+        return JobConfig(
+            text=self.input_file or self.additional_text.get("1.0", tk.END).strip(),
+            prompt=self.prompt_text.get("1.0", tk.END).strip(),
+            api_keys=self.api_keys if self.api_keys else ([self.api_key] if self.api_key else []),
+            provider=self.provider_var.get(),
+            model=self.model.get(),
+            language=self.language.get(),
+            split_method=self.split_method.get(),
+            split_length=split_length,
+            context_mode=self.context_mode.get(),
+            initial_summary=self.prev_summary_text.get("1.0", tk.END).strip() if use_context else "",
+            two_phase=self.two_phase_var.get(),
+            concurrency=int(self.concurrency_entry.get()),
+            use_cache=self.use_cache_var.get(),
+            resume_manifest=self.resume_manifest,
+            hedge_percentile=float(self.hedge_entry.get()),
+            token_calibration=self.resume_manifest.header.get("token_calibration") if self.resume_manifest else None,
+            batch_mode=self.batch_var.get() and not use_context
+        )
+
+    def start_processing(self):
+        if self.processing:
+            messagebox.showwarning("Đang xử lý", "Một yêu cầu đang được xử lý. Vui lòng đợi.")
+            return
+
+        errors = self.validate_inputs()
+        if errors:
+            self.show_error("\n".join(errors))
+            return
+
+        config = self.build_job_config()
+        self.resume_manifest = None
+        self.engine = TranslationEngine(TkReporter(self))
+        self._start_worker(self.engine.run, config)
+
+    def start_batch(self):
+        """Xử lý mọi file .txt trong một thư mục bằng thiết lập hiện tại (prompt, key, model, cách chia...)."""
+        if self.processing:
+            messagebox.showwarning("Đang xử lý", "Một yêu cầu đang được xử lý. Vui lòng đợi.")
+            return
+        errors = self.validate_inputs(require_text=False)
+        if errors:
+            self.show_error("\n".join(errors))
+            return
+        folder = filedialog.askdirectory(title="Chọn thư mục chứa các file .txt cần xử lý")
+        if not folder:
+            return
+        input_files = find_input_files(folder)
+        if not input_files:
+            self.show_error(f"Thư mục {folder} không có file .txt nào.")
+            return
+        config = self.build_job_config()
+        batch_dir = os.path.join(config.results_dir, "batch_" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        self.engine = BatchRunner(TkReporter(self))
+        self._start_worker(self.engine.run, input_files, config, batch_dir)
+
+    def _start_worker(self, run, *args):
+        self.processing = True
+        self.submit_button.configure(state='disabled')
+        self.stop_button.configure(state='normal')
+        # Xóa các ô text trước khi bắt đầu
+        self.progress_text.delete("1.0", tk.END)
+        self.result_text.delete("1.0", tk.END)
+        self.completion_text.delete("1.0", tk.END)
+        self.progress_bar["value"] = 0
+
+        thread = threading.Thread(target=self._process_request_thread, args=(run,) + args, daemon=True)
+        thread.start()
+
+    def resume_job(self):
+        """Chọn manifest của job cũ, khôi phục thiết lập và chạy tiếp các phần chưa xong."""
+        if self.processing:
+            messagebox.showwarning("Đang xử lý", "Một yêu cầu đang được xử lý. Vui lòng đợi.")
+            return
+        results_dir = RESULTS_DIR
+        path = filedialog.askopenfilename(
+            title="Chọn job cần tiếp tục",
+            initialdir=results_dir if os.path.exists(results_dir) else os.path.expanduser("~"),
+            filetypes=[("Job manifest", "*" + JobManifest.SUFFIX), ("All files", "*.*")]
+        )
+        if not path:
+            return
+        try:
+            manifest = JobManifest.load(path)
+        except Exception as e:
+            self.show_error(f"Không đọc được manifest: {str(e)}")
+            return
+        header = manifest.header
+        text = self.input_file or self.additional_text.get("1.0", tk.END).strip()
+        if JobManifest.fingerprint(text) != header["input_fingerprint"]:
+            self.show_error("Văn bản đầu vào (file đã mở hoặc ô 'Nhập văn bản cần xử lý') không khớp với job đã lưu.\n"
+                            "Hãy mở hoặc dán lại đúng văn bản gốc của job rồi bấm 'Tiếp tục job'.")
+            return
+        # Khôi phục thiết lập của job để chia văn bản ra đúng các phần cũ
+        self.provider_var.set(header["provider"])
+        self.update_model_options(header["provider"])
+        self.model.set(header["model"])
+        self.language.set(header["language"])
+        self.split_method.set(header["split_method"])
+        self.split_length_entry.delete(0, tk.END)
+        self.split_length_entry.insert(0, str(header["split_length"]))
+        self.context_mode.set(header["context_mode"])
+        self.two_phase_var.set(header.get("two_phase", False))
+        self.batch_var.set(header.get("batch_mode", False))
+        self.prev_summary_text.configure(state="normal")
+        self.prev_summary_text.delete("1.0", tk.END)
+        self.prev_summary_text.insert("1.0", header.get("initial_summary", ""))
+        self.on_context_mode_change()
+        self.prompt_text.delete("1.0", tk.END)
+        self.prompt_text.insert("1.0", header["prompt"])
+        self.resume_manifest = manifest
+        self.start_processing()
+        if not self.processing:
+            self.resume_manifest = None # Không qua được validate_inputs
+
+    def stop_processing(self):
+        if not self.processing:
+            return
+        self.engine.stop()
+        self.queue.put((self.progress_text, "\nĐang yêu cầu dừng...", False)) # Ghi thêm, không xóa
+        self.stop_button.configure(state='disabled') # Vô hiệu hóa ngay khi bấm dừng
+
+    def _process_request_thread(self, run, *args):
+        try:
+            run(*args)
+        finally:
+            self.processing = False
+            self.root.after(0, lambda: self.submit_button.configure(state='normal'))
+            self.root.after(0, lambda: self.stop_button.configure(state='disabled'))
+            print("Processing thread finished.")
+
+    def load_results(self):
+        """Mở cửa sổ duyệt kết quả, chọn sẵn job mới nhất."""
+        try:
+            ResultsBrowser(self)
+        except Exception as e:
+            self.show_error(f"Lỗi khi mở danh sách kết quả: {str(e)}\n{traceback.format_exc()}")
+
+def cli_main(argv=None):
+    """Chạy một job không cần giao diện, ví dụ:
+
+    python gem5.py --input truyen.txt --prompt-file prompt.txt --key-file keys.txt --mode no-context --concurrency 8
+
+    --input là thư mục hoặc glob (ví dụ "truyen/*.txt") thì chạy hàng loạt bằng BatchRunner.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Xử lý văn bản dài theo từng phần bằng Gemini/OpenAI-compatible API, không cần giao diện.")
+    parser.add_argument("--input", required=True,
+                        help="File văn bản cần xử lý (UTF-8); thư mục hoặc glob để xử lý hàng loạt")
+    parser.add_argument("--prompt-file", help="File chứa prompt (không cần khi dùng --resume)")
+    parser.add_argument("--key-file", required=True, help="File API key, mỗi dòng một key")
+    parser.add_argument("--provider", default=DEFAULT_PROVIDER, choices=list(PROVIDER_CONFIG.keys()))
+    parser.add_argument("--model", help="Model chính (mặc định theo provider)")
+    parser.add_argument("--language", default="中文", choices=["中文", "ENG", "Việt Nam"])
+    parser.add_argument("--split", default="chapter", choices=["chapter", "chars", "tokens"],
+                        help="Chia theo chương, theo số ký tự (số từ với ENG) hoặc theo token")
+    parser.add_argument("--split-length", type=int,
+                        help="Số ký tự/số từ mỗi phần khi --split chars (mặc định 10000); "
+                             "số token mỗi phần khi --split tokens (mặc định 0 = tự tính theo giới hạn của model)")
+    parser.add_argument("--mode", default="context", choices=["context", "no-context"],
+                        help="context: gửi kèm tóm tắt phần trước (tuần tự); no-context: các phần độc lập")
+    parser.add_argument("--summary-file", help="Bối cảnh ban đầu cho phần đầu tiên (chế độ context)")
+    parser.add_argument("--two-phase", action="store_true", help="Chế độ context: tóm tắt song song trước rồi dịch song song")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Số phần gửi song song")
+    parser.add_argument("--no-cache", action="store_true", help="Không dùng cache kết quả")
+    parser.add_argument("--chrome-trace", action="store_true",
+                        help="Cuối job chuyển trace (.trace.jsonl) sang .trace.json để mở bằng chrome://tracing hoặc Perfetto")
+    parser.add_argument("--hedge-percentile", type=float, default=0,
+                        help="Gửi thêm request dự phòng khi request chậm hơn percentile này của các lần trước, ví dụ 90 (0 = tắt)")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="Chế độ no-context: gửi cả job qua Batch API bất đồng bộ của provider (rẻ hơn, kết quả về chậm)")
+    parser.add_argument("--output-dir", default=RESULTS_DIR, help="Thư mục lưu kết quả")
+    parser.add_argument("--resume", metavar="MANIFEST", help="Tiếp tục job từ file .manifest.jsonl (thiết lập lấy từ manifest)")
+    parser.add_argument("--batch-dir", help="Thư mục kết quả của batch; chạy lại với thư mục cũ để tiếp tục các file chưa xong")
+    parser.add_argument("--parallel-files", type=int, help="Số file xử lý cùng lúc khi chạy hàng loạt (mặc định bằng --concurrency)")
+    args = parser.parse_args(argv)
+
+    input_files = find_input_files(args.input)
+    if not input_files:
+        print(f"Lỗi: không tìm thấy file đầu vào: {args.input}", file=sys.stderr)
+        return 2
+    batch = os.path.isdir(args.input) or not os.path.isfile(args.input)
+    if batch and args.resume:
+        parser.error("--resume chỉ dùng cho một file; với batch hãy dùng lại --batch-dir")
+
+    try:
+        text = ""
+        if not batch:
+            text = InputFile(args.input)
+            text.fingerprint()
+        api_keys = load_api_keys(args.key_file)
+        if args.resume:
+            config = JobConfig.from_manifest(JobManifest.load(args.resume), text, api_keys,
+                                             concurrency=args.concurrency, use_cache=not args.no_cache,
+                                             hedge_percentile=args.hedge_percentile)
+        else:
+            if not args.prompt_file:
+                parser.error("cần --prompt-file (hoặc --resume)")
+            with open(args.prompt_file, 'r', encoding='utf-8') as f:
+                prompt = f.read().strip()
+            initial_summary = ""
+            if args.summary_file:
+                with open(args.summary_file, 'r', encoding='utf-8') as f:
+                    initial_summary = f.read().strip()
+            config = JobConfig(
+                text, prompt, api_keys,
+                provider=args.provider,
+                model=args.model,
+                language=args.language,
+                split_method={"chapter": SPLIT_BY_CHAPTER, "chars": SPLIT_BY_CHARS, "tokens": SPLIT_BY_TOKENS}[args.split],
+                split_length=args.split_length if args.split_length is not None else (0 if args.split == "tokens" else 10000),
+                context_mode=MODE_WITH_CONTEXT if args.mode == "context" else MODE_WITHOUT_CONTEXT,
+                initial_summary=initial_summary,
+                two_phase=args.two_phase,
+                concurrency=args.concurrency,
+                use_cache=not args.no_cache,
+                results_dir=args.output_dir,
+                hedge_percentile=args.hedge_percentile,
+                batch_mode=args.batch_api
+            )
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Lỗi: {e}", file=sys.stderr)
+        return 2
+
+    reporter = EngineReporter()
+    if batch:
+        engine = BatchRunner(reporter)
+        batch_dir = args.batch_dir or os.path.join(args.output_dir, "batch_" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        job = lambda: engine.run(input_files, config, batch_dir, args.parallel_files)
+    else:
+        engine = TranslationEngine(reporter)
+        job = lambda: engine.run(config)
+    outcome = []
+    # Chạy job ở luồng riêng để Ctrl+C dừng có kiểm soát (ghi manifest, giữ kết quả đã nhận)
+    worker = threading.Thread(target=lambda: outcome.append(job()), daemon=True)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.5)
+    except KeyboardInterrupt:
+        print("Đang dừng... (Ctrl+C lần nữa để thoát ngay)", file=sys.stderr)
+        engine.stop()
+        worker.join()
+    stats = outcome[0] if outcome else None
+    if stats is None:
+        return 2
+    print(reporter.last_completion)
+    if args.chrome_trace:
+        for job_stats in ([row["stats"] for row in stats] if batch else [stats]):
+            if job_stats and job_stats.get("trace"):
+                print(f"Chrome trace: {export_chrome_trace(job_stats['trace'])}")
+    if batch:
+        return 0 if all(row["status"] == "Hoàn thành" for row in stats) else 1
+    return 0 if stats["failed"] == 0 and not stats["stopped"] else 1
 
-# --- Cần import traceback ở đầu file ---
-import traceback
 
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(cli_main(sys.argv[1:]))
+    if tk is None:
+        sys.exit("Không có tkinter: hãy cài tkinter hoặc chạy chế độ dòng lệnh (python gem5.py --help).")
     root = tk.Tk()
     app = GeminiInterface(root)
     root.mainloop()
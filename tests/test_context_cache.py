@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gem5 import GEMINI_CONTEXT_CACHE_MIN_TOKENS, TranslationEngine
+
+
+class SlowCaches:
+    """caches của client Gemini: create() chờ tới khi release được set."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.created = []
+        self.deleted = []
+
+    def create(self, model, config):
+        self.started.set()
+        self.release.wait(5)
+        name = f"cachedContents/{len(self.created)}"
+        self.created.append(name)
+        return SimpleNamespace(name=name)
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+
+class ContextCacheTest(unittest.TestCase):
+    SYSTEM = "dịch " * (GEMINI_CONTEXT_CACHE_MIN_TOKENS * 2)
+
+    def setUp(self):
+        self.engine = TranslationEngine()
+        self.slow = SimpleNamespace(caches=SlowCaches())
+        self.fast = SimpleNamespace(caches=SlowCaches())
+        self.fast.caches.release.set()
+
+    def start(self, client, key_slot, results):
+        thread = threading.Thread(target=lambda: results.append(
+            self.engine._google_context_cache(client, "m", key_slot, self.SYSTEM)))
+        thread.start()
+        return thread
+
+    def test_create_does_not_block_other_keys(self):
+        results = []
+        slow = self.start(self.slow, 0, results)
+        self.assertTrue(self.slow.caches.started.wait(5))
+        self.assertEqual(self.engine._google_context_cache(self.fast, "m", 1, self.SYSTEM), "cachedContents/0")
+        self.assertTrue(slow.is_alive()) # Key 0 vẫn đang tạo cache
+        self.slow.caches.release.set()
+        slow.join(5)
+        self.assertEqual(results, ["cachedContents/0"])
+
+    def test_same_key_waits_and_creates_once(self):
+        results = []
+        threads = [self.start(self.slow, 0, results)]
+        self.assertTrue(self.slow.caches.started.wait(5))
+        threads += [self.start(self.slow, 0, results) for _ in range(3)]
+        self.slow.caches.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ["cachedContents/0"] * 4)
+        self.assertEqual(self.slow.caches.created, ["cachedContents/0"])
+
+    def test_cache_created_after_job_cleanup_is_deleted(self):
+        results = []
+        thread = self.start(self.slow, 0, results)
+        self.assertTrue(self.slow.caches.started.wait(5))
+        self.engine._delete_context_caches()
+        self.assertTrue(thread.is_alive())
+        self.slow.caches.release.set()
+        thread.join(5)
+        self.assertEqual(self.slow.caches.deleted, ["cachedContents/0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gem5 import InputFile, JobConfig, TranslationEngine, SPLIT_BY_CHAPTER
+
+
+class ChapterSplitTest(unittest.TestCase):
+    WORDS = ["第", "第", "章", "第十二章", "Chương 3", "Chapter IV", "chapter 7", "他说。", "anh ấy", " ", "…"]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def split(self, text):
+        engine = TranslationEngine()
+        engine.config = JobConfig(text, "", ["k"], provider="Open Router", split_method=SPLIT_BY_CHAPTER)
+        with contextlib.redirect_stdout(io.StringIO()):
+            chunks = engine.split_text(text)
+        return [chunks[i] for i in range(len(chunks))] if chunks else chunks
+
+    def assert_same_split(self, raw, name):
+        path = os.path.join(self.root, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(raw)
+        self.assertEqual(self.split(InputFile(path)), self.split(raw.strip()), repr(raw))
+
+    def test_heading_across_block_boundary(self):
+        # "chapter 7" nằm trọn trong khối đầu nhưng "第…章" bao quanh nó chỉ khớp khi đọc thêm
+        raw = "他说。" * 94 + "\n第 chapter 7………第十二章\n" + "他说。" * 20 + "\nChương 3\n" + "他说。" * 20
+        self.assertEqual(raw.index("章", raw.index("第 chapter")), 300)
+        with mock.patch.object(InputFile, "BLOCK_CHARS", 300), mock.patch.object(InputFile, "PATTERN_OVERLAP", 150):
+            self.assert_same_split(raw, "boundary.txt")
+
+    def test_small_blocks_match_pasted_text(self):
+        rng = random.Random(1)
+        with mock.patch.object(InputFile, "BLOCK_CHARS", 50), mock.patch.object(InputFile, "PATTERN_OVERLAP", 80):
+            for n in range(500):
+                # Mỗi dòng ngắn hơn PATTERN_OVERLAP để mọi match (không vượt qua xuống dòng) đều vừa
+                lines = ["".join(rng.choice(self.WORDS) for _ in range(rng.randint(0, 8)))
+                         for _ in range(rng.randint(1, 20))]
+                raw = "\n".join(lines)
+                if not raw.strip():
+                    continue
+                self.assert_same_split(raw, f"t{n}.txt")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gem5 import JobManifest
+
+
+class JobManifestOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.result_file = os.path.join(self.root, "gemini_result_2024-01-01-00-00-00_m.txt")
+        self.manifest = JobManifest.create(self.result_file, {"provider": "Google", "model": "m", "total_parts": 2})
+
+    def test_replayed_part_keeps_new_output_range(self):
+        self.manifest.record(1, "done", output=[0, 40], translation="a", summary="")
+        self.manifest.record(2, "done", output=[40, 90], translation="b", summary="")
+        # Lần tiếp tục job sinh lại file kết quả: phần 1 nằm ở vị trí khác
+        self.manifest.record_output(1, [0, 12])
+        loaded = JobManifest.load(self.manifest.path)
+        self.assertEqual(loaded.output_range(1), [0, 12])
+        self.assertEqual(loaded.output_range(2), [40, 90])
+        self.assertEqual(loaded.read(1)["translation"], "a")
+
+    def test_new_chunk_line_replaces_recorded_output(self):
+        self.manifest.record(1, "error", error="x")
+        self.manifest.record_output(1, None)
+        self.manifest.record(1, "done", output=[5, 9], translation="a", summary="")
+        self.assertEqual(self.manifest.output_range(1), [5, 9])
+        self.assertEqual(JobManifest.load(self.manifest.path).output_range(1), [5, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gem5 import JobManifest, ResultsIndex
+
+
+class ResultsIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.index_path = os.path.join(self.root, ".jobs.jsonl")
+
+    def make_result(self, name, header=None):
+        result_file = os.path.join(self.root, name)
+        with open(result_file, 'w', encoding='utf-8') as f:
+            f.write("## bản dịch\n\n")
+        if header is not None:
+            JobManifest.create(result_file, header)
+        return result_file
+
+    def test_first_add_keeps_existing_results(self):
+        legacy = self.make_result("gemini_result_2020-01-01-00-00-00_old.txt")
+        older_job = self.make_result("gemini_result_2021-01-01-00-00-00_m.txt",
+                                     {"provider": "Google", "model": "m", "total_parts": 3})
+        index = ResultsIndex(self.index_path)
+        index.add({"result_file": os.path.join(self.root, "new.txt"), "created": "2099-01-01T00:00:00",
+                   "status": "running"})
+        jobs = index.jobs()
+        self.assertEqual([job["result_file"] for job in jobs],
+                         [os.path.join(self.root, "new.txt"), older_job, legacy])
+        self.assertEqual(jobs[1]["total_parts"], 3)
+        self.assertEqual(jobs[1]["manifest"], JobManifest.path_for(older_job))
+
+    def test_later_entries_update_the_same_job(self):
+        result_file = self.make_result("gemini_result_2021-01-01-00-00-00_m.txt", {"total_parts": 2})
+        index = ResultsIndex(self.index_path)
+        index.add({"result_file": result_file, "status": "running", "done": 0})
+        index.add({"result_file": result_file, "status": "finished", "done": 2})
+        jobs = index.jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual((jobs[0]["status"], jobs[0]["done"], jobs[0]["total_parts"]), ("finished", 2, 2))
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(len([json.loads(line) for line in f]), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()